@@ -0,0 +1,200 @@
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Tuple, Union
+
+from write_queue import WriteQueue
+
+try:
+    import fcntl
+except ImportError:     # windows, only a single process may write to an archive there
+    fcntl = None
+
+
+class ArchivedResponse:
+    def __init__(self, url: str, status: int, headers: dict, content: bytes, encoding: str, fetched_at: float,
+                 truncated: bool, stop_after: Union[tuple, None] = None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.fetched_at = fetched_at
+        self.truncated = truncated
+        self.stop_after = stop_after
+
+
+def read_entry(path: str, offset: int, length: int) -> ArchivedResponse:
+    """
+    Function to read a single response from a segment of the archive, without the index. Used by the processes of
+    reextract.py, which can't share the sqlite connection.
+
+    :param path: segment file
+    :param offset: position of the entry in the segment
+    :param length: compressed size of the entry
+    :return: ArchivedResponse
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    header, _, content = data.partition(b"\n")
+    header = json.loads(header)
+    # the entries archived before stop_after was saved have none
+    stop_after = tuple(header["stop_after"]) if header.get("stop_after") else None
+    return ArchivedResponse(header["url"], header["status"], header["headers"], content, header["encoding"],
+                            header["fetched_at"], header["truncated"], stop_after)
+
+
+class ResponseArchive:
+    """
+    Append only archive of the raw responses, so the records can be extracted again after a selector changed
+    without crawling the sites again, see reextract.py.
+
+    The responses are appended to segment files of up to `max_segment_size` bytes. Every response is a gzip member
+    of its own, a json header line followed by the body, so it is read with a single seek and a segment is still a
+    valid gzip file, e.g. zcat data/archive/segment-00001.gz. A sqlite index keeps the url, segment, offset and time
+    of every response. Nothing is ever replaced, a page fetched again is appended again.
+
+    The responses are compressed and written by a thread of the archive, so `append` returns at once, e.g. on the
+    fetcher event loop. Several processes can append to the same archive, e.g. the daemon and a cron run: the
+    thread writes the responses waiting in its queue as a batch, holding an exclusive lock on the `write.lock` file
+    of the directory from taking the end of the current segment until the batch is indexed.
+
+    :param directory: directory of the segments and the index
+    :param max_segment_size: a new segment is started once the current one is this big, in bytes
+    """
+
+    def __init__(self, directory: str = "data/archive", max_segment_size: int = 256 * 1024 ** 2):
+        self.directory = directory
+        self.max_segment_size = max_segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.archived = 0
+        self.bytes_archived = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                id INTEGER PRIMARY KEY,
+                url TEXT,
+                segment TEXT,
+                offset INTEGER,
+                length INTEGER,
+                status INTEGER,
+                fetched_at REAL,
+                truncated INTEGER
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_url ON responses (url, fetched_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_segment ON responses (segment, offset)")
+        self._db.commit()
+        # the lock and the segment are only opened by the first write, reading the archive never changes it
+        self._lock_file = None
+        self._file = None
+        self._segment = None
+        self._writes = WriteQueue(self._write_batch, "archive")
+
+    def _open_segment(self, segment: str):
+        if self._file:
+            self._file.close()
+        self._segment = segment
+        self._file = open(os.path.join(self.directory, segment), "ab")
+
+    def _segment_end(self) -> int:
+        # must hold the write lock. an entry the writer did not index, because it crashed, is dropped: no other
+        # writer can be half way through an append while the lock is held
+        row = self._db.execute("SELECT offset + length FROM responses WHERE segment = ? ORDER BY offset DESC "
+                               "LIMIT 1", (self._segment,)).fetchone()
+        end = row[0] if row else 0
+        if os.fstat(self._file.fileno()).st_size > end:
+            self._file.truncate(end)
+        return end
+
+    def append(self, url: str, status: int, headers: dict, content: bytes, encoding: str, truncated: bool = False,
+               stop_after: tuple = None):
+        """
+        Function to add a response to the archive. It is written by the thread of the archive, see flush.
+
+        :param truncated: True if only the start of the body was downloaded, see Fetcher.fetch's stop_after
+        :param stop_after: the element the body was cut off after, if truncated
+        """
+        now = time.time()
+        header = json.dumps({"url": url, "status": status, "headers": headers, "encoding": encoding,
+                             "fetched_at": now, "truncated": truncated,
+                             "stop_after": list(stop_after) if truncated and stop_after else None})
+        self._writes.put((url, status, now, truncated, header.encode() + b"\n" + content))
+
+    def _write_batch(self, responses: list):
+        # runs in the thread of the write queue
+        entries = [(url, status, now, truncated, gzip.compress(data, mtime=0))
+                   for url, status, now, truncated, data in responses]
+        with self._lock:
+            if self._lock_file is None:
+                self._lock_file = open(os.path.join(self.directory, "write.lock"), "ab")
+            if fcntl:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                # another process may have started a new segment since the last batch
+                segments = sorted(name for name in os.listdir(self.directory) if name.startswith("segment-"))
+                segment = segments[-1] if segments else "segment-00001.gz"
+                if segment != self._segment:
+                    self._open_segment(segment)
+                offset = self._segment_end()
+                rows = []
+                for url, status, now, truncated, entry in entries:
+                    if offset and offset + len(entry) > self.max_segment_size:
+                        self._open_segment("segment-{:05d}.gz".format(int(self._segment[8:13]) + 1))
+                        offset = 0
+                    self._file.write(entry)
+                    rows.append((url, self._segment, offset, len(entry), status, now, truncated))
+                    offset += len(entry)
+                self._file.flush()
+                self._db.executemany("INSERT INTO responses (url, segment, offset, length, status, fetched_at, "
+                                     "truncated) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self._db.commit()
+            finally:
+                if fcntl:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self.archived += len(entries)
+        self.bytes_archived += sum(len(entry) for _, _, _, _, entry in entries)
+
+    def flush(self):
+        """
+        Function to wait until the responses appended so far are written and indexed.
+        """
+        self._writes.flush()
+
+    def lookup(self, url: str, before: float = None) -> Union[Tuple[str, int, int], None]:
+        """
+        Function to find the latest response of the url.
+
+        :param url:
+        :param before: only look at the responses fetched until this time, e.g. when the record was saved
+        :return: (segment file, offset, length) for read_entry, None if the url was not archived
+        """
+        with self._lock:
+            row = self._db.execute("SELECT segment, offset, length FROM responses WHERE url = ? AND fetched_at <= ? "
+                                   "ORDER BY fetched_at DESC LIMIT 1",
+                                   (url, before if before is not None else time.time())).fetchone()
+        if row:
+            return os.path.join(self.directory, row[0]), row[1], row[2]
+
+    def read(self, url: str, before: float = None) -> Union[ArchivedResponse, None]:
+        entry = self.lookup(url, before)
+        return read_entry(*entry) if entry else None
+
+    def print_report(self):
+        self.flush()
+        print(f"archive: {self.archived} responses archived ({self.bytes_archived / 1024 ** 2:.1f} MB)")
+
+    def close(self):
+        self._writes.close()
+        with self._lock:
+            if self._file:
+                self._file.close()
+            if self._lock_file:
+                self._lock_file.close()
+            self._db.close()
@@ -1,10 +1,32 @@
-import requests
-from bs4 import BeautifulSoup
-from tqdm import tqdm
-import pandas as pd
+import time
+from typing import Union
+from concurrent.futures import as_completed
+from archive import ResponseArchive
+from fetcher import get_fetcher, configure_fetcher
+from frontier import Frontier
+from http_cache import ResponseCache
+from metrics import get_metrics
+from record_store import update_store
+from retry_policy import HttpStatusError, retry_failed
+from utils import parse_html
+from writers import open_record_writer, convert_to_excel
 
 
-def get_products_overview(max_products=10_000):
+def get_products_overview(max_products=10_000, window=500, rounds=3):
+    """
+    Function to fetch the product alert datatable in windows of `window` rows. The first window tells how many
+    products there are, the rest of the windows are then fetched concurrently and yielded as soon as each one
+    arrives, so the product pages can be fetched while the overview is still downloading.
+
+    The windows which failed are requested again at the end, after the backoff of the fetcher's RetryPolicy. A
+    missing window would leave its products out of the frontier without a trace, so RuntimeError is raised once
+    the other windows were yielded if any is still missing.
+
+    :param max_products: max no of products to fetch
+    :param window: no of rows per request
+    :param rounds: max no of times the failed windows are requested again
+    :return: iterator of lists of rows [{}, {}]
+    """
     api = "https://www.aseanconsumer.org/product-alert-datatable"
     payload = "draw=1&columns%5B0%5D%5Bdata%5D=recall_date&columns%5B0%5D%5Bname%5D=recall_date" \
               "&columns%5B0%5D%5Bsearchable%5D=true&columns%5B0%5D%5Borderable%5D=true&columns" \
@@ -30,22 +52,61 @@ def get_products_overview(max_products=10_000):
               "%5D%5Bname%5D=original_alert&columns%5B7%5D%5Bsearchable%5D=true&columns%5B7%5D" \
               "%5Borderable%5D=true&columns%5B7%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B7%5D" \
               "%5Bsearch%5D%5Bregex%5D=false&order%5B0%5D%5Bcolumn%5D=0&order%5B0%5D%5Bdir%5D" \
-              "=desc&start=0&length=100000"
+              "=desc&start={start}&length={length}"
 
     headers = {
         'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
         'accept': 'application/json',
         'authority': 'www.aseanconsumer.org',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                      'Chrome/120.0.0.0 Safari/537.36'
     }
 
-    response = requests.post(api, data=payload, headers=headers)
+    fetcher = get_fetcher()
+    response = fetcher.post(api, data=payload.format(start=0, length=min(window, max_products)), headers=headers)
     if not response.ok:
-        print("unable to get 200 status from url..", response)
-        return
+        raise RuntimeError(f"unable to get the products overview.. {response}")
+
+    first_window = response.json()
+    yield first_window["data"]
+
+    total = min(int(first_window.get("recordsFiltered", first_window.get("recordsTotal", 0))), max_products)
+    failed = list(range(len(first_window["data"]), total, window))
+    del first_window
+
+    for round_no in range(rounds + 1):
+        if not failed:
+            return
+        if round_no:
+            delay = max(fetcher.retry.delay(round_no), fetcher.retry.open_for())
+            print(f"retrying {len(failed)} windows of the products overview in {delay:.0f} seconds..")
+            time.sleep(delay)
+        futures = {fetcher.submit(api, "POST", payload.format(start=start, length=min(window, total - start)),
+                                  headers): start
+                   for start in failed}
+        failed = []
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except Exception as e:
+                print("unable to get the products from", futures[future], e)
+                failed.append(futures[future])
+                continue
+            if not response.ok:
+                print("unable to get 200 status from url..", response, futures[future])
+                failed.append(futures[future])
+                continue
+            yield response.json()["data"]
+    raise RuntimeError(f"unable to get the products overview from rows {sorted(failed)}..")
 
-    return response.json()
+
+def get_product_url(row: dict) -> str:
+    return "https://www.aseanconsumer.org/product-" + row["slug"]
+
+
+# only the product alert tables of the product page are parsed
+PRODUCT_PAGE_TARGETS = [("table", "table-product-alert")]
+
+# the product pages have two alert tables, the product and the recall, nothing after them is downloaded
+PRODUCT_PAGE_END = ("table", "table-product-alert", 2)
 
 
 def parse_table(soup):
@@ -55,29 +116,126 @@ def parse_table(soup):
     return dict(zip(headers, values))
 
 
-if __name__ == "__main__":
-    EXPORT_EXCEL_FILENAME = "data/asean_consumers.xlsx"
-    overview = get_products_overview()
-    urls = ["https://www.aseanconsumer.org/product-" + row["slug"] for row in overview["data"]]
+def extract_product(content: bytes) -> dict:
+    """
+    Function to extract the record from the html of the product page.
+    """
+    soup = parse_html(content, PRODUCT_PAGE_TARGETS)
+    with get_metrics().timer("extract"):
+        data = dict()
+        for i in soup.find_all("table", class_="table-product-alert"):
+            data.update(parse_table(i))
+    return data
+
+
+def scrape_product(url: str) -> Union[dict, None]:
+    """
+    Function to fetch and extract a single product page, used to retry the failed ones.
+
+    :return: dict
+    :raises HttpStatusError: if the page came back with an error status
+    """
+    response = get_fetcher().get(url, stop_after=PRODUCT_PAGE_END)
+    if not response.ok:
+        raise HttpStatusError(response.status, url)
+    return extract_product(response.content)
+
+
+def run(output_filename: str, frontier_filename: str, export_excel_filename: str = None,
+        store_filename: str = None) -> int:
+    """
+    Function to scrape the product pages which are not in the frontier yet and save all the products scraped so
+    far to `output_filename`.
+
+    :param output_filename: .jsonl, .csv or .parquet file of the products
+    :param frontier_filename: sqlite file of the products scraped by the previous runs
+    :param export_excel_filename: Excel copy of the output, None to skip it
+    :param store_filename: sqlite file of the RecordStore the products are saved to, the Excel file is then
+        exported from the store. None to convert the output file instead
+    :return: no of products saved
+    """
+    # product pages scraped by a previous run are kept in the frontier and not fetched again
+    frontier = Frontier(frontier_filename)
+
+    # the output starts with the products scraped by the previous runs, then the new ones as they arrive
+    writer = open_record_writer(output_filename)
+    writer.write_many(record for _, record in frontier.records())
 
-    master_data = []
-    failed_urls = []
+    fetcher = get_fetcher()
+    futures = {}
+    overview_error = None
     try:
-        for url in tqdm(urls):
+        # the product pages of a window are requested as soon as the window arrives
+        try:
+            for rows in get_products_overview():
+                urls = [get_product_url(row) for row in rows]
+                frontier.add((url, url) for url in urls)
+                for url in urls:
+                    if not frontier.is_done(url):
+                        futures[fetcher.submit(url, stop_after=PRODUCT_PAGE_END)] = url
+        except Exception as e:
+            # the products of the windows which arrived are still scraped, the run fails after them
+            overview_error = e
+
+        for future in as_completed(futures):
+            url = futures[future]
             try:
-                response = requests.get(url)
+                response = future.result()
             except Exception as e:
-                failed_urls.append(url)
+                frontier.mark_failed(url, str(e), fetcher.retry.is_retryable(e))
                 print("error ", e, url)
                 continue
-            soup = BeautifulSoup(response.text, "html.parser")
-            data = dict()
-            for i in soup.find_all("table", class_="table-product-alert"):
-                data.update(parse_table(i))
-            master_data.append(data)
-    except Exception as e:
-        print(e)
+            if not response.ok:
+                frontier.mark_failed(url, str(response), fetcher.retry.is_retryable(response.status))
+                print("unable to get 200 status from url..", response, url)
+                continue
+            try:
+                data = extract_product(response.content)
+            except Exception as e:
+                frontier.mark_failed(url, str(e), retryable=False)
+                print("unable to extract the product data..", e, url)
+                continue
+            frontier.mark_done(url, data)
+            writer.write(data)
+
+        # the failed pages are tried again once the rest is done, the site may have recovered by then
+        retry_failed(frontier, scrape_product, writer.write, fetcher.retry, max_workers=fetcher.max_concurrency)
+        if overview_error:
+            raise overview_error
+    finally:
+        writer.close()
+        print(f"Saved the data to {output_filename}")
+        if store_filename:
+            update_store(store_filename, "asean", frontier.records(), export_excel_filename)
+        elif export_excel_filename and writer.count:
+            convert_to_excel(output_filename, export_excel_filename)
+            print(f"Saved the data to {export_excel_filename}")
+        print("Failed urls", [url for _, url, _ in frontier.failed()])
+        frontier.close()
+    return writer.count
+
+
+if __name__ == "__main__":
+    OUTPUT_FILENAME = "data/asean_consumers.jsonl"     # .jsonl, .csv or .parquet
+    EXPORT_EXCEL_FILENAME = "data/asean_consumers.xlsx"     # set None to skip the Excel conversion
+    HTTP_CACHE_FILENAME = "data/http_cache.sqlite"
+    FRONTIER_FILENAME = "data/asean_consumers_frontier.sqlite"
+    METRICS_FILENAME = "data/asean_consumers_metrics.json"
+    METRICS_PORT = None     # e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics during the run
+    STORE_FILENAME = "data/records.sqlite"     # set None to export the Excel file from the output file
+    ARCHIVE_DIRECTORY = "data/archive"     # raw copy of the pages for reextract.py, set None to skip it
+    configure_fetcher(cache=ResponseCache(HTTP_CACHE_FILENAME),
+                      archive=ResponseArchive(ARCHIVE_DIRECTORY) if ARCHIVE_DIRECTORY else None)
+
+    metrics = get_metrics()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    metrics.start_progress()
+    try:
+        run(OUTPUT_FILENAME, FRONTIER_FILENAME, EXPORT_EXCEL_FILENAME, STORE_FILENAME)
     finally:
-        pd.DataFrame(master_data).to_excel(EXPORT_EXCEL_FILENAME)
-        print(f"Saved the data to {EXPORT_EXCEL_FILENAME}")
-        print("Failed urls", failed_urls)
+        metrics.stop_progress()
+        get_fetcher().limiter.print_report()
+        get_fetcher().cache.print_report()
+        metrics.print_report()
+        metrics.dump(METRICS_FILENAME)
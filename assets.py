@@ -0,0 +1,186 @@
+import hashlib
+import mimetypes
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future, wait
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlsplit
+
+from fetcher import get_fetcher
+from writers import RecordWriter
+
+
+class AssetStore:
+    """
+    Store of the files linked from the records, e.g. the product images. Every file is named by the sha256 of its
+    content, so an image shared by many records, like a placeholder, is stored once. A sqlite index maps each url
+    to its file, so a url downloaded by a previous run is not fetched again.
+
+    :param directory: directory of the files, the index is stored in it too
+    """
+
+    def __init__(self, directory: str = "data/assets"):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, ".partial"), exist_ok=True)
+        # downloads cut off by a crash are started again from scratch
+        for name in os.listdir(os.path.join(directory, ".partial")):
+            os.remove(os.path.join(directory, ".partial", name))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                url TEXT PRIMARY KEY,
+                path TEXT,
+                content_hash TEXT,
+                size INTEGER,
+                downloaded_at REAL
+            )""")
+        self._db.commit()
+        self._in_flight: Dict[str, Tuple[Future, str]] = {}
+        self.downloaded = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_downloaded = 0
+
+    def path_of(self, url: str) -> Union[str, None]:
+        """
+        Function to get the file the url was downloaded to, None if it was not or the file is gone.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path FROM assets WHERE url = ?", (url,)).fetchone()
+        if row and os.path.exists(row[0]):
+            return row[0]
+
+    def submit(self, url: str) -> Future:
+        """
+        Function to start downloading the url into a partial file, or get the download already running.
+
+        :return: concurrent.futures.Future which resolves to Response, pass it on to `save` once it is done
+        """
+        if url not in self._in_flight:
+            partial = os.path.join(self.directory, ".partial", uuid.uuid4().hex)
+            self._in_flight[url] = (get_fetcher().download(url, partial), partial)
+        return self._in_flight[url][0]
+
+    def save(self, url: str) -> Union[str, None]:
+        """
+        Function to move the finished download of the url to its content addressed file.
+
+        :return: path of the file, None if the download failed
+        """
+        if url not in self._in_flight:
+            return self.path_of(url)
+        future, partial = self._in_flight.pop(url)
+        try:
+            response = future.result()
+        except Exception as e:
+            response = e
+        if isinstance(response, Exception) or not response.ok:
+            print("unable to download the asset..", response, url)
+            self.failed += 1
+            if os.path.exists(partial):
+                os.remove(partial)
+            return
+
+        content_hash = hashlib.sha256()
+        with open(partial, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                content_hash.update(chunk)
+        content_hash = content_hash.hexdigest()
+        size = os.path.getsize(partial)
+        extension = os.path.splitext(urlsplit(url).path)[1] or \
+            mimetypes.guess_extension(response.headers.get("Content-Type", "").split(";")[0]) or ""
+        path = os.path.join(self.directory, content_hash[:2], content_hash + extension.lower())
+
+        if os.path.exists(path):
+            self.duplicates += 1
+            os.remove(partial)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(partial, path)
+        self.downloaded += 1
+        self.bytes_downloaded += size
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO assets (url, path, content_hash, size, downloaded_at) "
+                             "VALUES (?, ?, ?, ?, ?)", (url, path, content_hash, size, time.time()))
+            self._db.commit()
+        return path
+
+    def print_report(self):
+        print(f"assets: {self.downloaded} downloaded ({round(self.bytes_downloaded / 1024 / 1024, 1)} MB, "
+              f"{self.duplicates} duplicates stored once), {self.skipped} already on disk, {self.failed} failed")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class AssetWriter:
+    """
+    Wrapper of a RecordWriter which downloads the asset of every record and writes the path of the file into the
+    record. The crawl does not wait for the downloads, a record is held back until its asset is on disk and then
+    written, so the images are fetched while the pages still are.
+
+    :param writer: RecordWriter the records are written to
+    :param store: AssetStore of the files
+    :param url_column: column of the asset url. e.g. "Image"
+    :param path_column: column the path of the file is written to
+    """
+
+    def __init__(self, writer: RecordWriter, store: AssetStore, url_column: str = "Image",
+                 path_column: str = "Image File"):
+        self.writer = writer
+        self.store = store
+        self.url_column = url_column
+        self.path_column = path_column
+        self._pending: List[Future] = []
+        # (record, url) of the finished downloads, appended by the fetcher thread
+        self._finished = deque()
+
+    @property
+    def count(self) -> int:
+        return self.writer.count
+
+    def write(self, record: dict):
+        url = record.get(self.url_column)
+        path = self.store.path_of(url) if url else None
+        if not url or path:
+            if path:
+                self.store.skipped += 1
+            self.writer.write({**record, self.path_column: path})
+        else:
+            future = self.store.submit(url)
+            future.add_done_callback(lambda _, entry=(record, url): self._finished.append(entry))
+            self._pending.append(future)
+        self._write_downloaded()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def _write_downloaded(self):
+        while self._finished:
+            record, url = self._finished.popleft()
+            self.writer.write({**record, self.path_column: self.store.save(url)})
+        if len(self._pending) > 1000:
+            self._pending = [future for future in self._pending if not future.done()]
+
+    def close(self):
+        wait(self._pending)
+        self._pending = []
+        self._write_downloaded()
+        self.writer.close()
+        self.store.print_report()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import html
+import json
+import os
+import random
+import threading
+import time
+from string import Template
+
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SGS_PAGE_SIZE = 10
+IMAGE_SIZE = 20 * 1024
+
+
+def load_fixture(name: str) -> Template:
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return Template(f.read())
+
+
+class FixtureServer:
+    """
+    Local stand-in for the SGS and ASEAN sites which serves the recorded pages of benchmarks/fixtures, so the
+    scrapers can be measured without hitting the live sites. Point the scrapers at it with SCRAPER_HOST_OVERRIDES,
+    see fetcher._environment_options.
+
+    :param records: no of records of each site
+    :param latency: seconds added to every response
+    :param jitter: up to this many random seconds added on top of the latency
+    :param error_rate: share of the requests answered with 503
+    :param throttle_rate: share of the requests answered with 429 and Retry-After
+    :param seed: seed of the random latency and errors, so runs are comparable
+    """
+
+    def __init__(self, records: int = 1000, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, seed: int = 0):
+        self.records = records
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+
+        self.sgs_listing = load_fixture("sgs_listing.html")
+        self.sgs_listing_row = load_fixture("sgs_listing_row.html")
+        self.sgs_listing_next = load_fixture("sgs_listing_next.html")
+        self.sgs_record = load_fixture("sgs_record.html")
+        self.asean_product = load_fixture("asean_product.html")
+        self.asean_datatable_row = load_fixture("asean_datatable_row.json")
+
+        self.latencies = []
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.url = None
+        self._loop = None
+        self._runner = None
+
+    def reset_stats(self):
+        self.latencies = []
+        self.statuses = {}
+        self.bytes_sent = 0
+
+    def stats(self) -> dict:
+        return {"latencies": list(self.latencies), "statuses": dict(self.statuses), "bytes_sent": self.bytes_sent}
+
+    @web.middleware
+    async def _inject(self, request, handler):
+        started = time.monotonic()
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        draw = self.random.random()
+        if draw < self.error_rate:
+            response = web.Response(status=503, text="Service Unavailable")
+        elif draw < self.error_rate + self.throttle_rate:
+            response = web.Response(status=429, text="Too Many Requests", headers={"Retry-After": "1"})
+        else:
+            response = await handler(request)
+
+        self.latencies.append(time.monotonic() - started)
+        self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+        self.bytes_sent += len(response.body or b"")
+        return response
+
+    async def sgs_listing_page(self, request):
+        offset = int(request.query.get("p", 0))
+        rows = "\n".join(self.sgs_listing_row.substitute(product=html.escape(f"Recalled product {position}"),
+                                                         page=offset - offset % SGS_PAGE_SIZE,
+                                                         rec=position % SGS_PAGE_SIZE)
+                         for position in range(offset, min(offset + SGS_PAGE_SIZE, self.records)))
+        next_link = ""
+        if offset + SGS_PAGE_SIZE < self.records:
+            next_link = self.sgs_listing_next.substitute(offset=offset + SGS_PAGE_SIZE)
+        page = self.sgs_listing.substitute(first=offset + 1, last=min(offset + SGS_PAGE_SIZE, self.records),
+                                           total=self.records, rows=rows, next=next_link)
+        return web.Response(text=page, content_type="text/html")
+
+    async def sgs_record_page(self, request):
+        position = int(request.query.get("p", 0)) + int(request.query.get("rec", 0))
+        if position >= self.records:
+            return web.Response(status=404, text="Not Found")
+        page = self.sgs_record.substitute(product=html.escape(f"Recalled product {position}"), position=position)
+        return web.Response(text=page, content_type="text/html")
+
+    async def asean_datatable(self, request):
+        form = await request.post()
+        start = int(form.get("start", 0))
+        length = int(form.get("length", 10))
+        rows = [json.loads(self.asean_datatable_row.substitute(slug=f"product-alert-{position}",
+                                                               name=f"Recalled product {position}"))
+                for position in range(start, min(start + length, self.records))]
+        return web.json_response({"draw": int(form.get("draw", 1)), "recordsTotal": self.records,
+                                  "recordsFiltered": self.records, "data": rows})
+
+    async def asean_product_page(self, request):
+        slug = request.match_info["slug"]
+        page = self.asean_product.substitute(slug=html.escape(slug), name=html.escape(slug.replace("-", " ")))
+        return web.Response(text=page, content_type="text/html")
+
+    async def sgs_image(self, request):
+        position = int(request.match_info["position"])
+        # every 4th record shows the same placeholder, like the records of the real site without a photo
+        seed = -1 if position % 4 == 0 else position
+        return web.Response(body=b"\xff\xd8\xff\xe0" + random.Random(seed).randbytes(IMAGE_SIZE),
+                            content_type="image/jpeg")
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject])
+        app.router.add_get("/en/vr/product-recalls-light", self.sgs_listing_page)
+        app.router.add_get("/en/vr/product-recalls-light/record", self.sgs_record_page)
+        app.router.add_get("/static/recalls/{position:\\d+}.jpg", self.sgs_image)
+        app.router.add_post("/product-alert-datatable", self.asean_datatable)
+        app.router.add_get("/product-{slug}", self.asean_product_page)
+        return app
+
+    async def _start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Function to run the server on a background thread.
+
+        :param host:
+        :param port: 0 to pick a free port
+        :return: base url of the server. e.g. http://127.0.0.1:43215
+        """
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="fixture-server", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(host, port), self._loop).result()
+        return self.url
+
+    def host_overrides(self) -> str:
+        """
+        Function to get the SCRAPER_HOST_OVERRIDES value which sends both sites to this server.
+        """
+        return f"campaigns.sgs.com={self.url},www.aseanconsumer.org={self.url}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--records", type=int, default=1000, help="no of records of each site")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random seconds added on top of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of the requests answered with 429")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the SGS and ASEAN fixture pages")
+    parser.add_argument("--port", type=int, default=8080)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = FixtureServer(args.records, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.seed)
+    url = server.start(port=args.port)
+    print(f"serving the fixtures at {url}, run the scrapers with")
+    print(f"    SCRAPER_HOST_OVERRIDES={server.host_overrides()}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,179 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fixture_server import FixtureServer, add_server_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = [
+    "sgs_scraper.py",
+    "sgs_scraper_v2.py",
+    "asean_consumer_scraper.py",
+    "experiments/sgs_scraper_v2.py",
+    "experiments/asean_consumer_scraper.py",
+    "run_all.py",
+]
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def count_records(data_dir: str) -> int:
+    """
+    Function to count the records in the jsonl outputs of a run.
+    """
+    count = 0
+    for path in glob.glob(os.path.join(data_dir, "*.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            count += sum(1 for line in f if line.strip())
+    return count
+
+
+def run_entry_point(script: str, server: FixtureServer, concurrency: int, timeout: float) -> dict:
+    """
+    Function to run one scraper as a subprocess against the fixture server and measure it. Every run starts in an
+    empty working directory, so there is no cache or frontier left from the previous one.
+
+    :param script: path of the scraper relative to the repo
+    :param server: running FixtureServer
+    :param concurrency: max no of requests in flight of the fetcher
+    :param timeout: seconds after which the scraper is killed
+    :return: dict of the measurements
+    """
+    env = dict(os.environ,
+               SCRAPER_HOST_OVERRIDES=server.host_overrides(),
+               SCRAPER_MAX_CONCURRENCY=str(concurrency),
+               SCRAPER_LIMIT_PER_HOST=str(concurrency),
+               PYTHONUNBUFFERED="1")
+    server.reset_stats()
+
+    with tempfile.TemporaryDirectory() as work_dir, open(os.path.join(work_dir, "output.log"), "w") as log:
+        os.mkdir(os.path.join(work_dir, "data"))
+        started = time.monotonic()
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, script)], cwd=work_dir, env=env,
+                                   stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+        # the experiments wait for a key press at the end
+        process.stdin.write(b"\n" * 10)
+        process.stdin.close()
+
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        # wait4 gives the cpu time and peak memory of this scraper alone, the parse pools included
+        _, exit_status, usage = os.wait4(process.pid, 0)
+        timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(exit_status)
+        elapsed = time.monotonic() - started
+        records = count_records(os.path.join(work_dir, "data"))
+        with open(os.path.join(work_dir, "output.log"), encoding="utf-8", errors="replace") as f:
+            output = f.read()
+        # the stage timings the scraper measured itself, see metrics.Metrics
+        stages = {}
+        for path in glob.glob(os.path.join(work_dir, "data", "*_metrics.json")):
+            with open(path) as f:
+                stages = json.load(f)["stages"]
+
+    stats = server.stats()
+    pages = stats["statuses"].get(200, 0)
+    return {
+        "script": script,
+        "concurrency": concurrency,
+        "exit_code": process.returncode,
+        "seconds": round(elapsed, 2),
+        "requests": len(stats["latencies"]),
+        "pages": pages,
+        "records": records,
+        "pages_per_second": round(pages / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(stats["latencies"], 0.5) * 1000, 1),
+        "p99_ms": round(percentile(stats["latencies"], 0.99) * 1000, 1),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 2),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "statuses": {str(status): count for status, count in sorted(stats["statuses"].items())},
+        "stages": stages,
+        # the end of the output tells why a scraper failed
+        "output": output[-2000:] if process.returncode else "",
+    }
+
+
+def print_results(results: list):
+    print(f"{'script':<40}{'conc':>6}{'exit':>6}{'pages':>8}{'records':>9}{'pages/s':>10}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'cpu s':>8}{'rss MB':>8}")
+    for result in results:
+        print(f"{result['script']:<40}{result['concurrency']:>6}{result['exit_code']:>6}{result['pages']:>8}"
+              f"{result['records']:>9}{result['pages_per_second']:>10}{result['p50_ms']:>9}{result['p99_ms']:>9}"
+              f"{result['cpu_seconds']:>8}{result['peak_rss_mb']:>8}")
+    for result in results:
+        if result["exit_code"]:
+            print(f"\n{result['script']} at concurrency {result['concurrency']} exited with {result['exit_code']}:")
+            print(result["output"])
+
+
+def compare_results(results: list, baseline: list, tolerance: float) -> list:
+    """
+    Function to find the runs which got slower than the same script and concurrency in the baseline.
+
+    :param results: measurements of this run
+    :param baseline: measurements of an earlier run
+    :param tolerance: allowed drop of pages/s, e.g. 0.1 for 10%
+    :return: list of messages, empty if nothing regressed
+    """
+    previous = {(result["script"], result["concurrency"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result["script"], result["concurrency"]))
+        if not old or not old["pages_per_second"]:
+            continue
+        change = result["pages_per_second"] / old["pages_per_second"] - 1
+        if change < -tolerance:
+            regressions.append(f"{result['script']} at concurrency {result['concurrency']}: "
+                               f"{old['pages_per_second']} -> {result['pages_per_second']} pages/s "
+                               f"({change:.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the scrapers against the local fixture server")
+    parser.add_argument("--scripts", nargs="+", default=ENTRY_POINTS, help="scrapers to run, relative to the repo")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[4, 16, 64])
+    parser.add_argument("--timeout", type=float, default=600, help="seconds after which a scraper is killed")
+    parser.add_argument("--output", help="json file to save the results to")
+    parser.add_argument("--baseline", help="json file of an earlier run to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed drop of pages/s against the baseline")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = FixtureServer(args.records, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.seed)
+    server.start()
+    print(f"fixture server running at {server.url} with {args.records} records per site")
+
+    results = []
+    try:
+        for script in args.scripts:
+            for concurrency in args.concurrency:
+                print(f"running {script} at concurrency {concurrency}..")
+                results.append(run_entry_point(script, server, concurrency, args.timeout))
+    finally:
+        server.stop()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f"regression: {message}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,74 @@
+import re
+
+# the last bytes of the body so far are only scanned with the next chunk, a tag name may be cut off in them
+TAIL = 16
+
+
+class ElementEndScanner:
+    """
+    Incremental scanner of an html body which tells when the target element has closed, so the rest of the page
+    does not have to be downloaded. It is fed the chunks as they arrive and only follows the opening and closing
+    tags of the target's tag name, which takes a few regex searches per chunk instead of parsing the page twice.
+
+    e.g. ElementEndScanner("div", "table-wrapper-pairs") is done at the </div> which closes
+    <div class="table-wrapper table-wrapper-pairs">, nested divs included.
+
+    :param tag: tag name of the target element
+    :param class_name: css class of the target element
+    :param count: no of target elements the page has, the scanner is done when the last one closed
+    """
+
+    def __init__(self, tag: str, class_name: str, count: int = 1):
+        # the end of a name is matched on the byte after it: the search stops short of the buffer end, where a
+        # negative lookahead or \b would also match "table-wrapper-pairs-old" or "<divider" cut off by a chunk
+        self.start = re.compile(rb"<%s(?=\W)[^>]*\bclass\s*=\s*[\"'][^\"']*(?<![\w-])%s(?=[^\w-])"
+                                % (re.escape(tag.encode()), re.escape(class_name.encode())), re.IGNORECASE)
+        self.tags = re.compile(rb"<(/?)%s(?=\W)" % re.escape(tag.encode()), re.IGNORECASE)
+        self.remaining = count
+        self.buffer = bytearray()
+        self.position = 0
+        self.depth = 0
+        self.done = False
+        # end of the last target element in the buffer, the rest of the buffer is not needed
+        self.end = None
+
+    def content(self) -> bytes:
+        """
+        Function to get the body up to the end of the last target element.
+        """
+        return bytes(self.buffer[:self.end] if self.done else self.buffer)
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Function to scan the next chunk of the body.
+
+        :return: True once the last target element has closed
+        """
+        self.buffer += chunk
+        end = len(self.buffer) - TAIL
+        while not self.done and self.position < end:
+            if not self.depth:
+                match = self.start.search(self.buffer, self.position, end)
+                if not match:
+                    self._skip_to(end)
+                    break
+                self.depth = 1
+                self.position = match.end()
+                continue
+
+            match = self.tags.search(self.buffer, self.position, end)
+            if not match:
+                self._skip_to(end)
+                break
+            self.position = match.end()
+            self.depth += -1 if match.group(1) else 1
+            if not self.depth:
+                self.remaining -= 1
+                self.done = not self.remaining
+                self.end = self.buffer.find(b">", self.position) + 1 or len(self.buffer)
+        return self.done
+
+    def _skip_to(self, end: int):
+        # a tag which starts before `end` and is cut off by it is scanned again with the next chunk
+        last_tag = self.buffer.rfind(b"<", self.position, end)
+        self.position = last_tag if last_tag >= 0 else end
@@ -1,55 +1,31 @@
+import multiprocessing
 import os
 import sys
 
-import requests
-from bs4 import BeautifulSoup
-from tqdm import tqdm
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor
-
-
-def get_products_overview(max_products=10_000):
-    api = "https://www.aseanconsumer.org/product-alert-datatable"
-    payload = "draw=1&columns%5B0%5D%5Bdata%5D=recall_date&columns%5B0%5D%5Bname%5D=recall_date" \
-              "&columns%5B0%5D%5Bsearchable%5D=true&columns%5B0%5D%5Borderable%5D=true&columns" \
-              "%5B0%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B0%5D%5Bsearch%5D%5Bregex%5D=false" \
-              "&columns%5B1%5D%5Bdata%5D=picture&columns%5B1%5D%5Bname%5D=picture&columns%5B1%5D" \
-              "%5Bsearchable%5D=false&columns%5B1%5D%5Borderable%5D=false&columns%5B1%5D%5Bsearch" \
-              "%5D%5Bvalue%5D=&columns%5B1%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B2%5D%5Bdata" \
-              "%5D=name&columns%5B2%5D%5Bname%5D=name&columns%5B2%5D%5Bsearchable%5D=true&columns" \
-              "%5B2%5D%5Borderable%5D=true&columns%5B2%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B2%5D" \
-              "%5Bsearch%5D%5Bregex%5D=false&columns%5B3%5D%5Bdata%5D=type&columns%5B3%5D%5Bname" \
-              "%5D=type&columns%5B3%5D%5Bsearchable%5D=true&columns%5B3%5D%5Borderable%5D=true" \
-              "&columns%5B3%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B3%5D%5Bsearch%5D%5Bregex%5D" \
-              "=false&columns%5B4%5D%5Bdata%5D=model_product&columns%5B4%5D%5Bname%5D" \
-              "=model_product&columns%5B4%5D%5Bsearchable%5D=true&columns%5B4%5D%5Borderable%5D" \
-              "=true&columns%5B4%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B4%5D%5Bsearch%5D%5Bregex%5D" \
-              "=false&columns%5B5%5D%5Bdata%5D=country&columns%5B5%5D%5Bname%5D=country&columns" \
-              "%5B5%5D%5Bsearchable%5D=true&columns%5B5%5D%5Borderable%5D=true&columns%5B5%5D" \
-              "%5Bsearch%5D%5Bvalue%5D=&columns%5B5%5D%5Bsearch%5D%5Bregex%5D=false&columns%5B6" \
-              "%5D%5Bdata%5D=jurisdiction_of_recall&columns%5B6%5D%5Bname%5D" \
-              "=jurisdiction_of_recall&columns%5B6%5D%5Bsearchable%5D=true&columns%5B6%5D" \
-              "%5Borderable%5D=true&columns%5B6%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B6%5D" \
-              "%5Bsearch%5D%5Bregex%5D=false&columns%5B7%5D%5Bdata%5D=original_alert&columns%5B7" \
-              "%5D%5Bname%5D=original_alert&columns%5B7%5D%5Bsearchable%5D=true&columns%5B7%5D" \
-              "%5Borderable%5D=true&columns%5B7%5D%5Bsearch%5D%5Bvalue%5D=&columns%5B7%5D" \
-              "%5Bsearch%5D%5Bregex%5D=false&order%5B0%5D%5Bcolumn%5D=0&order%5B0%5D%5Bdir%5D" \
-              "=desc&start=0&length=100000"
-
-    headers = {
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'accept': 'application/json',
-        'authority': 'www.aseanconsumer.org',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
-                      'Chrome/120.0.0.0 Safari/537.36'
-    }
-
-    response = requests.post(api, data=payload, headers=headers)
-    if not response.ok:
-        print("unable to get 200 status from url..", response)
-        return
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from archive import ResponseArchive  # noqa: E402
+from asean_consumer_scraper import get_products_overview  # noqa: E402
+from fetcher import get_fetcher, configure_fetcher  # noqa: E402
+from frontier import Frontier  # noqa: E402
+from http_cache import ResponseCache  # noqa: E402
+from metrics import get_metrics  # noqa: E402
+from retry_policy import HttpStatusError, retry_failed  # noqa: E402
+from utils import parse_html  # noqa: E402
+from work_queue import bounded_map  # noqa: E402
+from writers import open_record_writer, convert_to_excel  # noqa: E402
+
+
+def get_product_url(row: dict) -> str:
+    return "https://www.aseanconsumer.org/product-" + row["slug"]
 
-    return response.json()
+
+# only the product alert tables of the product page are parsed
+PRODUCT_PAGE_TARGETS = [("table", "table-product-alert")]
+
+# the product pages have two alert tables, the product and the recall, nothing after them is downloaded
+PRODUCT_PAGE_END = ("table", "table-product-alert", 2)
 
 
 def parse_table(soup):
@@ -59,49 +35,124 @@ def parse_table(soup):
     return dict(zip(headers, values))
 
 
-def get_data(url):
-    try:
-        response = requests.get(url)
-    except:
-        return url
-    soup = BeautifulSoup(response.text, "html.parser")
-    data = dict()
-    for i in soup.find_all("table", class_="table-product-alert"):
-        data.update(parse_table(i))
+def parse_product_page(content: bytes) -> dict:
+    """
+    Function to extract the record from the raw product page. Runs in the parse pool, so it only takes and returns
+    plain data which is cheap to send between processes.
+
+    :param content: body of the product page
+    :return: dict
+    """
+    soup = parse_html(content, PRODUCT_PAGE_TARGETS)
+    with get_metrics().timer("extract"):
+        data = dict()
+        for i in soup.find_all("table", class_="table-product-alert"):
+            data.update(parse_table(i))
     return data
 
 
+def get_data(url, parse_pool=None):
+    """
+    Function to download the product page and hand the body to the parse pool, the thread only holds the GIL for
+    the download.
+
+    :param url: url of the product page
+    :param parse_pool: ProcessPoolExecutor, the page is parsed in this thread if None
+    :return: dict
+    :raises HttpStatusError: if the page came back with an error status
+    """
+    response = get_fetcher().get(url, stop_after=PRODUCT_PAGE_END)
+    if not response.ok:
+        raise HttpStatusError(response.status, url)
+    if parse_pool is None:
+        return parse_product_page(response.content)
+    # the time the thread waits for the parse pool, the parse/extract timings of the pool stay in its processes
+    with get_metrics().timer("parse_pool"):
+        return parse_pool.submit(parse_product_page, response.content).result()
+
+
 if __name__ == "__main__":
     print("Script started..")
-    try:
-        max_worker = int(sys.argv[1])
-    except (IndexError, ValueError):
-        max_worker = 15
 
     if not os.path.exists("data"):
         os.mkdir("data")
 
-    EXPORT_EXCEL_FILENAME = "data/asean_consumers.xlsx"
-    overview = get_products_overview()
-    urls = ["https://www.aseanconsumer.org/product-" + row["slug"] for row in overview["data"]]
-
-    master_data = []
-    failed_urls = []
+    OUTPUT_FILENAME = "data/asean_consumers.jsonl"     # .jsonl, .csv or .parquet
+    EXPORT_EXCEL_FILENAME = "data/asean_consumers.xlsx"     # set None to skip the Excel conversion
+    HTTP_CACHE_FILENAME = "data/http_cache.sqlite"
+    FRONTIER_FILENAME = "data/asean_consumers_frontier.sqlite"
+    PARSE_PROCESSES = os.cpu_count()     # no of processes parsing the pages, set 0 to parse in the download threads
+    METRICS_FILENAME = "data/asean_consumers_metrics.json"
+    METRICS_PORT = None     # e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics during the run
+    ARCHIVE_DIRECTORY = "data/archive"     # raw copy of the pages for reextract.py, set None to skip it
+    configure_fetcher(cache=ResponseCache(HTTP_CACHE_FILENAME),
+                      archive=ResponseArchive(ARCHIVE_DIRECTORY) if ARCHIVE_DIRECTORY else None)
+
+    metrics = get_metrics()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    # product pages scraped by a previous run are kept in the frontier and not fetched again
+    frontier = Frontier(FRONTIER_FILENAME)
+
+    # the output starts with the products scraped by the previous runs, then the new ones as they arrive
+    writer = open_record_writer(OUTPUT_FILENAME)
+    writer.write_many(record for _, record in frontier.records())
+
+    # the pages are parsed in separate processes so parsing scales with the cores instead of queueing on the GIL.
+    # they are spawned, not forked, the fetcher thread is running already and a forked child could inherit its
+    # locks held
+    parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn")) \
+        if PARSE_PROCESSES else None
+    metrics.start_progress()
     try:
-        # for url in tqdm(urls):
-        with ThreadPoolExecutor(max_workers=max_worker) as executor:
-            futures = [executor.submit(get_data, url) for url in urls]
-
-            for future in tqdm(futures):
-                result = future.result()
-                if isinstance(result, dict):
-                    master_data.append(result)
+        # the fetcher decides how many requests actually run, threads only have to keep it busy
+        overview_errors = []
+
+        def pending_urls():
+            # the product pages of a window are requested as soon as the window arrives
+            try:
+                for rows in get_products_overview():
+                    urls = [get_product_url(row) for row in rows]
+                    frontier.add((url, url) for url in urls)
+                    for url in urls:
+                        if not frontier.is_done(url):
+                            yield url
+            except Exception as e:
+                # the products of the windows which arrived are still scraped, the run fails after them
+                overview_errors.append(e)
+
+        with ThreadPoolExecutor(max_workers=get_fetcher().max_concurrency) as executor:
+            # only twice as many pages as threads are queued, the results are handled in the order they complete
+            for url, result in bounded_map(executor, lambda product_url: get_data(product_url, parse_pool),
+                                           pending_urls(), max_in_flight=2 * get_fetcher().max_concurrency):
+                if isinstance(result, Exception):
+                    print(result, url)
+                    frontier.mark_failed(url, str(result), get_fetcher().retry.is_retryable(result))
                 else:
-                    failed_urls.append(result)
+                    frontier.mark_done(url, result)
+                    writer.write(result)
+
+            # the failed pages are tried again once the rest is done, the site may have recovered by then
+            retry_failed(frontier, lambda url: get_data(url, parse_pool), writer.write, get_fetcher().retry,
+                         max_workers=get_fetcher().max_concurrency)
+            if overview_errors:
+                raise overview_errors[0]
 
     except Exception as e:
         print(e)
     finally:
-        pd.DataFrame(master_data).to_excel(EXPORT_EXCEL_FILENAME)
-        print(f"Saved the data to {EXPORT_EXCEL_FILENAME}")
-        input("press any key to exit..")
+        if parse_pool:
+            parse_pool.shutdown()
+        metrics.stop_progress()
+        writer.close()
+        print(f"Saved the data to {OUTPUT_FILENAME}")
+        if EXPORT_EXCEL_FILENAME and writer.count:
+            convert_to_excel(OUTPUT_FILENAME, EXPORT_EXCEL_FILENAME)
+            print(f"Saved the data to {EXPORT_EXCEL_FILENAME}")
+        get_fetcher().limiter.print_report()
+        get_fetcher().cache.print_report()
+        metrics.print_report()
+        metrics.dump(METRICS_FILENAME)
+        if sys.stdin.isatty():     # no one to press a key under cron
+            input("press any key to exit..")
@@ -1,39 +1,20 @@
-from tqdm import tqdm
-from typing import Union
 from bs4 import BeautifulSoup
 import pandas as pd
-import requests
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import os
 import sys
 
-
-def get_soup(url: str) -> Union[BeautifulSoup, None]:
-    """
-    Function to fetch the url and convert it to BeautifulSoup object. If error while fetching return None
-    :param url:
-    :return: BeautifulSoup object or None
-    """
-    requests_header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/120.0.0.0 Safari/537.36"
-    }
-
-    try:
-        response = requests.get(url, headers=requests_header)
-
-        if not response.ok:
-            print("unable to get 200 status from url..", response)
-            return
-
-        return BeautifulSoup(response.content, "html.parser")
-
-    except KeyboardInterrupt:
-        raise KeyboardInterrupt
-
-    except Exception as e:
-        print(e)
-        return
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from archive import ResponseArchive  # noqa: E402
+from fetcher import get_fetcher, configure_fetcher  # noqa: E402
+from frontier import Frontier  # noqa: E402
+from http_cache import ResponseCache  # noqa: E402
+from metrics import get_metrics  # noqa: E402
+from retry_policy import HttpStatusError, retry_failed  # noqa: E402
+from utils import get_soup, parse_html, parse_total_record_count, sgs_record_key, LISTING_PAGE_TARGETS  # noqa: E402
+from work_queue import bounded_map  # noqa: E402
+from writers import open_record_writer, convert_to_excel  # noqa: E402
 
 
 def convert_to_date(dataframe: pd.DataFrame) -> pd.DataFrame:
@@ -68,6 +49,13 @@ def product_link_generator(end: int = 100) -> list:
     return links[:end]
 
 
+# elements of the record page used by get_product_data and the "Product Name"/"original recall notice url" columns
+RECORD_PAGE_TARGETS = [("div", "table-wrapper-pairs"), ("div", "page-header"), ("p", None)]
+
+# the extractors need nothing after the record table, the rest of the page is not downloaded
+RECORD_PAGE_END = ("div", "table-wrapper-pairs")
+
+
 def get_product_data(bs_soup: BeautifulSoup) -> dict:
     table = bs_soup.find("div", class_="table-wrapper table-wrapper-pairs")
 
@@ -83,77 +71,132 @@ def get_product_data(bs_soup: BeautifulSoup) -> dict:
 
 
 def get_total_record_count():
-    count = 12_421
     url = "https://campaigns.sgs.com/en/vr/product-recalls-light"
-    page_soup = get_soup(url)
-    record_count_info = page_soup.find("div", class_="grid grid--2").text.strip()
+    page_soup = get_soup(url, LISTING_PAGE_TARGETS)
+    return parse_total_record_count(page_soup)
+
 
-    for word in record_count_info.split(" "):
-        try:
-            count = int(word)
-        except ValueError:
-            pass
-    return count
+def parse_product_page(content: bytes, url: str) -> dict:
+    """
+    Function to extract the record from the raw product page. Runs in the parse pool, so it only takes and returns
+    plain data which is cheap to send between processes.
 
+    :param content: body of the product page
+    :param url: url of the product page
+    :return: dict
+    """
+    soup = parse_html(content, RECORD_PAGE_TARGETS, first_only=("p",))
+    with get_metrics().timer("extract"):
+        table_data = get_product_data(soup)
+        table_data["Product Name"] = soup.find("div", class_="page-header").text.strip()
+        table_data["original recall notice url"] = soup.find("p").a.attrs.get("href")
+        table_data["page_url"] = url
+    return table_data
 
-def get_data(url):
-    # print(url)
-    soup = get_soup(url)
 
-    if not soup:
-        return
+def get_data(url, parse_pool=None):
+    """
+    Function to download the product page and hand the body to the parse pool. The thread waits for the record
+    while the parsing runs in another process, so the GIL is only held for the download.
 
-    table_data = get_product_data(soup)
-    table_data["Product Name"] = soup.find("div", class_="page-header").text.strip()
-    table_data["original recall notice url"] = soup.find("p").a.attrs.get("href")
-    table_data["page_url"] = url
-    return table_data
+    :param url: url of the product page
+    :param parse_pool: ProcessPoolExecutor, the page is parsed in this thread if None
+    :return: dict
+    :raises HttpStatusError: if the page came back with an error status
+    """
+    response = get_fetcher().get(url, stop_after=RECORD_PAGE_END)
+    if not response.ok:
+        raise HttpStatusError(response.status, url)
+
+    if parse_pool is None:
+        return parse_product_page(response.content, url)
+    # the time the thread waits for the parse pool, the parse/extract timings of the pool stay in its processes
+    with get_metrics().timer("parse_pool"):
+        return parse_pool.submit(parse_product_page, response.content, url).result()
 
 
 if __name__ == "__main__":
     print("Script started..")
-    try:
-        max_worker = int(sys.argv[1])
-    except (IndexError, ValueError):
-        max_worker = 20
-
-    SLEEP_TIME = 0     # in seconds
-    EXPORT_EXCEL_FILENAME = "data/sgs_data_extended.xlsx"
-    requests_header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/120.0.0.0 Safari/537.36"
-    }
+    OUTPUT_FILENAME = "data/sgs_data_extended.jsonl"     # .jsonl, .csv or .parquet
+    EXPORT_EXCEL_FILENAME = "data/sgs_data_extended.xlsx"     # set None to skip the Excel conversion
+    HTTP_CACHE_FILENAME = "data/http_cache.sqlite"
+    FRONTIER_FILENAME = "data/sgs_data_extended_frontier.sqlite"
+    PARSE_PROCESSES = os.cpu_count()     # no of processes parsing the pages, set 0 to parse in the download threads
+    METRICS_FILENAME = "data/sgs_data_extended_metrics.json"
+    METRICS_PORT = None     # e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics during the run
+    ARCHIVE_DIRECTORY = "data/archive"     # raw copy of the pages for reextract.py, set None to skip it
 
     if not os.path.exists("data"):
         os.mkdir("data")
+    configure_fetcher(cache=ResponseCache(HTTP_CACHE_FILENAME),
+                      archive=ResponseArchive(ARCHIVE_DIRECTORY) if ARCHIVE_DIRECTORY else None)
 
-    total_number_of_records = get_total_record_count()
-    df = pd.DataFrame()
-    if os.path.exists(EXPORT_EXCEL_FILENAME):
-        df = pd.read_excel(EXPORT_EXCEL_FILENAME, index_col=0)
-        if df.shape[0] == int(total_number_of_records):
+    metrics = get_metrics()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    # every record scraped so far is kept in the frontier, only the new and failed ones are fetched
+    frontier = Frontier(FRONTIER_FILENAME)
+    writer = parse_pool = None
+    try:
+        total_number_of_records = get_total_record_count()
+        product_links = product_link_generator(total_number_of_records)
+        frontier.add((sgs_record_key(url, total_number_of_records), url) for url in product_links)
+
+        pending = frontier.pending()
+        if not pending:
             print("All data is up to date, No new data to scrape..")
-            input("press any key to exit..")
+            if sys.stdin.isatty():     # no one to press a key under cron
+                input("press any key to exit..")
             sys.exit()
-        total_number_of_records = int(total_number_of_records) - df.shape[0]
-    print(f"{total_number_of_records} new products found. scraping..")
-    product_links = product_link_generator(total_number_of_records)
-
-    master_data = []
-
-    with ThreadPoolExecutor(max_workers=max_worker) as executor:
-        futures = [executor.submit(get_data, url) for url in product_links]
-        for future in tqdm(futures):
-            try:
-                master_data.append(future.result())
-            except Exception:
-                pass
-
-    # Export the master data to excel
-    new_df = pd.DataFrame(master_data)
-    if not df.empty:
-        new_df = pd.concat([new_df, df]).reset_index(drop=True)
-    new_df = convert_to_date(new_df)
-    new_df.to_excel(EXPORT_EXCEL_FILENAME)
-    print(f"Data exported to {EXPORT_EXCEL_FILENAME}")
-    input("Press any key to exit..")
+        print(f"{len(pending)} new products found. scraping..")
+
+        # the output starts with the records of the previous runs, newest first, then the new ones as they arrive
+        writer = open_record_writer(OUTPUT_FILENAME, validate_func=convert_to_date)
+        writer.write_many(record for _, record in frontier.records(newest_first=True))
+
+        metrics.start_progress()
+        # the fetcher decides how many requests actually run, threads only have to keep it busy. the pages are
+        # parsed in separate processes so parsing scales with the cores instead of queueing on the GIL. they are
+        # spawned, not forked, the fetcher thread is running already and a forked child could inherit its locks held
+        parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                         mp_context=multiprocessing.get_context("spawn")) if PARSE_PROCESSES else None
+        with ThreadPoolExecutor(max_workers=get_fetcher().max_concurrency) as executor:
+            # only twice as many pages as threads are queued, the results are handled in the order they complete
+            for (key, url), data in bounded_map(executor, lambda entry: get_data(entry[1], parse_pool), pending,
+                                                max_in_flight=2 * get_fetcher().max_concurrency):
+                if isinstance(data, Exception):
+                    print(data)
+                    frontier.mark_failed(key, str(data), get_fetcher().retry.is_retryable(data))
+                else:
+                    frontier.mark_done(key, data)
+                    writer.write(data)
+
+        # the failed pages are tried again once the rest is done, the site may have recovered by then
+        retry_failed(frontier, lambda url: get_data(url, parse_pool), writer.write, get_fetcher().retry,
+                     max_workers=get_fetcher().max_concurrency)
+
+        counts = frontier.counts()
+        print(f"{counts['done']} products scraped, {counts['failed']} failed and will be retried on the next run")
+
+    except KeyboardInterrupt:
+        print("Received Keyboard interrupt, stopping the scrapper..")
+
+    finally:
+        if parse_pool:
+            parse_pool.shutdown(cancel_futures=True)
+        metrics.stop_progress()
+        if writer:
+            writer.close()
+            print(f"{writer.count} records saved to {OUTPUT_FILENAME}")
+            if EXPORT_EXCEL_FILENAME and writer.count:
+                convert_to_excel(OUTPUT_FILENAME, EXPORT_EXCEL_FILENAME, ["Publication Date"])
+                print(f"Data exported to {EXPORT_EXCEL_FILENAME}")
+        frontier.close()
+
+    get_fetcher().limiter.print_report()
+    get_fetcher().cache.print_report()
+    metrics.print_report()
+    metrics.dump(METRICS_FILENAME)
+    if sys.stdin.isatty():     # no one to press a key under cron
+        input("Press any key to exit..")
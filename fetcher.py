@@ -0,0 +1,354 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, as_completed
+from typing import Iterable, Iterator, Tuple, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from archive import ResponseArchive
+from element_scanner import ElementEndScanner
+from http_cache import ResponseCache
+from metrics import Metrics, get_metrics
+from rate_limiter import FairShare, RateLimiter, parse_retry_after
+from retry_policy import RetryPolicy
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/120.0.0.0 Safari/537.36"
+}
+
+
+class Response:
+    """
+    A fully read http response. It only keeps what the scrapers need, so it can be passed between threads.
+    """
+
+    def __init__(self, url: str, status: int, headers: dict, content: bytes, encoding: str = "utf-8"):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __repr__(self):
+        return f"<Response [{self.status}]>"
+
+
+class Fetcher:
+    """
+    Shared asyncio fetch engine. The event loop runs in a background thread, so the blocking scrapers can use it
+    through `get`/`post`/`map` while all the requests share one keep-alive connection pool.
+    How many requests go to each host is decided by the adaptive rate limiter, see rate_limiter.HostController,
+    and `max_concurrency` is shared fairly between the hosts, see rate_limiter.FairShare.
+
+    :param max_concurrency: max no of requests in flight across all the hosts
+    :param limit_per_host: max no of open connections to a single host
+    :param timeout: total timeout of a single request in seconds
+    :param headers: default headers sent with every request
+    :param limiter: RateLimiter, defaults to one that can use all the connections of a host
+    :param cache: ResponseCache for GET requests, None to always download the page
+    :param archive: ResponseArchive every downloaded page is appended to, None to keep no raw copy
+    :param retry: RetryPolicy of the failed requests, defaults to 5 attempts with exponential backoff
+    :param metrics: Metrics which get the connect/ttfb/download timings and the response counts, defaults to the
+        process wide one
+    :param host_overrides: {host: base url} to send the requests of a host somewhere else, e.g. to the local
+        benchmark server {"campaigns.sgs.com": "http://127.0.0.1:8080"}
+    """
+
+    def __init__(self, max_concurrency: int = 64, limit_per_host: int = 32, timeout: float = 60,
+                 headers: dict = None, limiter: RateLimiter = None, cache: ResponseCache = None,
+                 retry: RetryPolicy = None, metrics: Metrics = None, host_overrides: dict = None,
+                 archive: ResponseArchive = None):
+        self.max_concurrency = max_concurrency
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.headers = headers or DEFAULT_HEADERS
+        self.limiter = limiter or RateLimiter(max_concurrency=limit_per_host)
+        self.cache = cache
+        self.archive = archive
+        self.retry = retry or RetryPolicy()
+        self.metrics = metrics or get_metrics()
+        self.host_overrides = host_overrides or {}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="fetcher", daemon=True)
+        self._thread.start()
+        self._session = None
+        self._budget = None
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    async def _start(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.limit_per_host,
+                                         ttl_dns_cache=300)
+        self._budget = FairShare(self.max_concurrency)
+        self._session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                              trace_configs=[self._trace_config()])
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        # only new connections are timed, requests on a kept alive connection don't connect at all
+        async def on_connection_create_start(session, context, params):
+            context.connect_started = time.monotonic()
+
+        async def on_connection_create_end(session, context, params):
+            self.metrics.observe("connect", time.monotonic() - context.connect_started)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    def _request_url(self, url: str) -> str:
+        parts = urlsplit(url)
+        if parts.netloc not in self.host_overrides:
+            return url
+        base = urlsplit(self.host_overrides[parts.netloc])
+        return parts._replace(scheme=base.scheme, netloc=base.netloc).geturl()
+
+    async def fetch(self, url: str, method: str = "GET", data=None, headers: dict = None,
+                    save_to: str = None, stop_after: tuple = None) -> Response:
+        """
+        Coroutine to fetch the url and read the whole body, retrying connection errors and the retryable status
+        codes as the retry policy says. Must be awaited on the fetcher loop.
+
+        :param url:
+        :param method: GET or POST
+        :param data: request body
+        :param headers: extra headers for this request
+        :param save_to: file the body is streamed to instead of being kept in memory, rewritten on every attempt
+        :param stop_after: (tag name, css class) or (tag name, css class, count) of the element the page is needed
+            for. The body is only read until it closed and the connection is dropped, see ElementEndScanner. Saves
+            the download and the parsing of the rest of a long page, but the connection can't be used again
+        :return: Response, the last one if all the attempts got a retryable status
+        :raises CircuitOpenError: if the circuit breaker of the host is open
+        """
+        host = urlsplit(self._request_url(url)).netloc
+        breaker = self.retry.breaker(host)
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.check(host)
+            try:
+                response = await self._fetch_once(url, method, data, headers, save_to, stop_after)
+            except asyncio.CancelledError:
+                breaker.abandon()
+                raise
+            except Exception as e:
+                breaker.record_failure()
+                if attempt >= self.retry.max_attempts or not self.retry.is_retryable(e):
+                    raise
+                reason, delay = type(e).__name__, self.retry.delay(attempt)
+            else:
+                if response.status in self.retry.breaker_statuses:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if attempt >= self.retry.max_attempts or not self.retry.is_retryable(response.status):
+                    return response
+                reason = str(response.status)
+                delay = self.retry.delay(attempt, parse_retry_after(response.headers.get("Retry-After")))
+
+            self.metrics.increment("retries", labels={"reason": reason})
+            await asyncio.sleep(delay)
+
+    async def _fetch_once(self, url: str, method: str = "GET", data=None, headers: dict = None,
+                          save_to: str = None, stop_after: tuple = None) -> Response:
+        cached = None
+        # a page cut off after an element is only cached for the requests which stop after the same element
+        variant = "stop_after=" + ",".join(map(str, stop_after)) if stop_after else ""
+        if self.cache and method == "GET" and not save_to:
+            # the sqlite read and the decompression run in a thread, the loop keeps serving the other requests
+            cached = await asyncio.get_running_loop().run_in_executor(None, self.cache.lookup, url, variant)
+            if cached and cached.is_fresh:
+                self.cache.hits += 1
+                self.cache.bytes_saved += len(cached.content)
+                return Response(cached.url, cached.status, cached.headers, cached.content, cached.encoding)
+            if cached:
+                headers = {**cached.conditional_headers(), **(headers or {})}
+
+        request_url = self._request_url(url)
+        host = urlsplit(request_url).netloc
+        await self.limiter.acquire(host)
+        status = ttfb = retry_after = None
+        timed_out = stopped_early = False
+        try:
+            await self._budget.acquire(host)
+            try:
+                started = time.monotonic()
+                async with self._session.request(method, request_url, data=data, headers=headers) as response:
+                    ttfb = time.monotonic() - started
+                    status = response.status
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    encoding = response.charset or "utf-8"
+                    if save_to:
+                        content, size = b"", 0
+                        with open(save_to, "wb") as f:
+                            async for chunk in response.content.iter_chunked(64 * 1024):
+                                f.write(chunk)
+                                size += len(chunk)
+                    elif stop_after and status == 200:
+                        scanner = ElementEndScanner(*stop_after)
+                        async for chunk in response.content.iter_any():
+                            if scanner.feed(chunk):
+                                stopped_early = True
+                                response.close()
+                                break
+                        size = len(scanner.buffer)
+                        content = scanner.content()
+                    else:
+                        content = await response.read()
+                        size = len(content)
+                        encoding = response.get_encoding() if content else "utf-8"
+                    result = Response(str(response.url), response.status, dict(response.headers), content,
+                                      encoding)
+            finally:
+                await self._budget.release(host)
+            self.metrics.observe("ttfb", ttfb)
+            self.metrics.observe("download", time.monotonic() - started)
+            self.metrics.increment("downloaded_bytes", size)
+            self.metrics.increment("responses", labels={"status": status})
+            if stopped_early:
+                self.metrics.increment("stopped_early")
+        except Exception as e:
+            timed_out = isinstance(e, asyncio.TimeoutError)
+            self.metrics.increment("request_errors", labels={"error": type(e).__name__})
+            raise
+        finally:
+            # only a response or a timeout tells how loaded the host is, a request cancelled or failed on our side
+            # (e.g. dns) just gives its slot back
+            await self.limiter.release(host, status, ttfb, retry_after, feedback=status is not None or timed_out)
+
+        if cached and result.status == 304:
+            self.cache.revalidated += 1
+            self.cache.bytes_saved += len(cached.content)
+            self.cache.refresh(url, result.headers, variant)
+            return Response(cached.url, cached.status, cached.headers, cached.content, cached.encoding)
+
+        # a page served by the cache or not modified was archived when it was downloaded
+        if self.archive and method == "GET" and not save_to and result.status == 200:
+            self.archive.append(url, result.status, result.headers, result.content, result.encoding, stopped_early,
+                                stop_after)
+
+        if self.cache and method == "GET" and not save_to:
+            self.cache.misses += 1
+            if result.status == 200:
+                self.cache.store(url, result.status, result.headers, result.content, result.encoding, variant)
+        return result
+
+    def submit(self, url: str, method: str = "GET", data=None, headers: dict = None,
+               stop_after: tuple = None) -> Future:
+        """
+        Function to schedule the request on the fetcher loop without waiting for it.
+
+        :param stop_after: see fetch
+        :return: concurrent.futures.Future which resolves to Response
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, method, data, headers, stop_after=stop_after),
+                                                self._loop)
+
+    def download(self, url: str, path: str) -> Future:
+        """
+        Function to schedule the download of a large body, e.g. an image, straight into `path`.
+
+        :return: concurrent.futures.Future which resolves to Response, its content is empty
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, save_to=path), self._loop)
+
+    def get(self, url: str, headers: dict = None, stop_after: tuple = None) -> Response:
+        return self.submit(url, headers=headers, stop_after=stop_after).result()
+
+    def post(self, url: str, data=None, headers: dict = None) -> Response:
+        return self.submit(url, "POST", data, headers).result()
+
+    def map(self, urls: Iterable[str], stop_after: tuple = None) -> Iterator[Tuple[str, Union[Response, Exception]]]:
+        """
+        Function to fetch all the urls concurrently and yield them as they complete.
+
+        :param urls: list of urls
+        :param stop_after: see fetch
+        :return: iterator of (url, Response) or (url, Exception) if the request failed
+        """
+        futures = {self.submit(url, stop_after=stop_after): url for url in urls}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        if self.cache:
+            self.cache.close()
+        if self.archive:
+            self.archive.close()
+
+
+_fetcher = None
+_fetcher_options = {}
+_fetcher_lock = threading.Lock()
+
+
+def _environment_options() -> dict:
+    """
+    Function to read Fetcher arguments from the environment, used by the benchmarks to point the scrapers at the
+    local server without changing them. e.g.
+        SCRAPER_MAX_CONCURRENCY=16
+        SCRAPER_LIMIT_PER_HOST=16
+        SCRAPER_HOST_OVERRIDES=campaigns.sgs.com=http://127.0.0.1:8080,www.aseanconsumer.org=http://127.0.0.1:8080
+    """
+    options = {}
+    if os.environ.get("SCRAPER_MAX_CONCURRENCY"):
+        options["max_concurrency"] = int(os.environ["SCRAPER_MAX_CONCURRENCY"])
+    if os.environ.get("SCRAPER_LIMIT_PER_HOST"):
+        options["limit_per_host"] = int(os.environ["SCRAPER_LIMIT_PER_HOST"])
+    if os.environ.get("SCRAPER_HOST_OVERRIDES"):
+        options["host_overrides"] = dict(item.split("=", 1)
+                                         for item in os.environ["SCRAPER_HOST_OVERRIDES"].split(",") if item)
+    return options
+
+
+def configure_fetcher(**options):
+    """
+    Function to set the Fetcher arguments of the process wide fetcher. Must be called before the first get_fetcher.
+
+    :param options: keyword arguments of Fetcher
+    """
+    with _fetcher_lock:
+        if _fetcher is not None:
+            raise RuntimeError("fetcher is already running, configure it before the first request")
+        _fetcher_options.update(options)
+
+
+def get_fetcher() -> Fetcher:
+    """
+    Function to get the process wide fetcher, so all the scrapers share one connection pool.
+
+    :return: Fetcher
+    """
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = Fetcher(**{**_environment_options(), **_fetcher_options})
+            atexit.register(_fetcher.close)
+    return _fetcher
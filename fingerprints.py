@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Union
+
+NEW = "new"
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+
+
+def fingerprint(record: dict) -> str:
+    """
+    Function to get the content hash of a record, the same for records with the same values in any key order.
+    """
+    return hashlib.sha256(json.dumps(record, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+class FingerprintIndex:
+    """
+    Index of the records seen by the previous syncs: their key, the url of their page and the hash of their
+    content, stored in a sqlite file. A sync compares what the site shows now with it to find the new and the
+    updated records without fetching the unchanged ones.
+
+    :param path: sqlite file of the index
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                key TEXT PRIMARY KEY,
+                page_url TEXT,
+                content_hash TEXT,
+                first_seen REAL,
+                updated_at REAL
+            )""")
+        self._db.commit()
+
+    def get(self, key: str) -> Union[str, None]:
+        """
+        Function to get the content hash stored for the key.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT content_hash FROM fingerprints WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def classify(self, key: str, content_hash: str) -> str:
+        """
+        Function to compare a record with the index.
+
+        :return: NEW, UPDATED or UNCHANGED
+        """
+        known_hash = self.get(key)
+        if known_hash is None:
+            return NEW
+        return UNCHANGED if known_hash == content_hash else UPDATED
+
+    def update(self, key: str, page_url: str, content_hash: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO fingerprints (key, page_url, content_hash, first_seen, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET page_url = excluded.page_url, content_hash = excluded.content_hash,
+                    updated_at = excluded.updated_at""", (key, page_url, content_hash, now, now))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
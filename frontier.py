@@ -0,0 +1,193 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, List, Tuple, Union
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class Frontier:
+    """
+    Durable list of the urls of a crawl, stored in a sqlite file. Every url has a state (pending/done/failed) and
+    the record extracted from it, which is saved as soon as the page is scraped. A restarted run only has to fetch
+    the urls which are not done yet.
+
+    The key identifies the record and the url is where it is fetched from. They are the same for most pages, but
+    a key can stay the same while its url changes, e.g. the SGS records move to later pages as new ones are added.
+
+    :param path: sqlite file of the frontier
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS frontier (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                state TEXT,
+                record TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                updated_at REAL,
+                retryable INTEGER DEFAULT 1
+            )""")
+        # frontiers created before the column was added
+        if "retryable" not in [row[1] for row in self._db.execute("PRAGMA table_info(frontier)")]:
+            self._db.execute("ALTER TABLE frontier ADD COLUMN retryable INTEGER DEFAULT 1")
+        self._db.execute("CREATE INDEX IF NOT EXISTS frontier_state ON frontier (state)")
+        self._db.commit()
+
+    def add(self, entries: Iterable[Tuple[str, str]]):
+        """
+        Function to add (key, url) pairs as pending. Known keys keep their state, only the url of the ones which
+        are not done is updated. A done key keeps the url its record was extracted from, see reextract.py.
+
+        :param entries: iterable of (key, url)
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany("""
+                INSERT INTO frontier (key, url, state, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET url = excluded.url WHERE state != ?""",
+                                 ((key, url, PENDING, now, DONE) for key, url in entries))
+            self._db.commit()
+
+    def pending(self) -> List[Tuple[str, str]]:
+        """
+        Function to get the (key, url) pairs which still need to be fetched, failed ones included.
+        """
+        with self._lock:
+            return self._db.execute("SELECT key, url FROM frontier WHERE state != ? ORDER BY rowid",
+                                    (DONE,)).fetchall()
+
+    def get(self, key: str) -> Union[dict, list, None]:
+        """
+        Function to get the record of a key if it is done.
+
+        :return: the record or None
+        """
+        with self._lock:
+            row = self._db.execute("SELECT record FROM frontier WHERE key = ? AND state = ?",
+                                   (key, DONE)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def is_done(self, key: str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM frontier WHERE key = ? AND state = ?",
+                                    (key, DONE)).fetchone() is not None
+
+    def mark_done(self, key: str, record: Union[dict, list], url: str = None):
+        """
+        :param url: url the record was extracted from, if it is not the one the key was added with. e.g. an SGS
+            record fetched again after it moved to a later page
+        """
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO frontier (key, url, state, record, error, attempts, updated_at)
+                VALUES (?, ?, ?, ?, NULL, 1, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, record = excluded.record, error = NULL,
+                    attempts = attempts + 1, updated_at = excluded.updated_at, url = COALESCE(?, url)""",
+                             (key, url or key, DONE, json.dumps(record, default=str), time.time(), url))
+            self._db.commit()
+
+    def replace_records(self, entries: Iterable[Tuple[str, Union[dict, list]]]):
+        """
+        Function to replace the records of done keys, e.g. with the ones extracted again from the same pages. The
+        time they were saved is kept, it is still the time their page was fetched.
+
+        :param entries: iterable of (key, record)
+        """
+        with self._lock:
+            self._db.executemany("UPDATE frontier SET record = ? WHERE key = ? AND state = ?",
+                                 ((json.dumps(record, default=str), key, DONE) for key, record in entries))
+            self._db.commit()
+
+    def done(self) -> List[Tuple[str, str, float]]:
+        """
+        Function to get the (key, url, time the record was saved) of the done urls.
+        """
+        with self._lock:
+            return self._db.execute("SELECT key, url, updated_at FROM frontier WHERE state = ? ORDER BY rowid",
+                                    (DONE,)).fetchall()
+
+    def mark_failed(self, key: str, error: str, retryable: bool = True):
+        """
+        :param retryable: False if the page would fail the same way again, e.g. a 404 or an extraction error, see
+            RetryPolicy.is_retryable. retry_failed skips it, the next run still fetches it once
+        """
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO frontier (key, url, state, error, attempts, updated_at, retryable)
+                VALUES (?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET state = excluded.state, error = excluded.error,
+                    attempts = attempts + 1, updated_at = excluded.updated_at, retryable = excluded.retryable""",
+                             (key, key, FAILED, error, time.time(), retryable))
+            self._db.commit()
+
+    def records(self, newest_first: bool = False) -> Iterator[Tuple[str, Union[dict, list]]]:
+        """
+        Function to get the (key, record) pairs of all the done urls in the order they were added. The records are
+        held as json text and only parsed one at a time, which takes a fraction of the memory of the dicts.
+
+        :param newest_first: order by the key as a number instead, largest first. e.g. the SGS records whose key
+            counts from the oldest record, see utils.sgs_record_key
+        """
+        order = "CAST(key AS INTEGER) DESC" if newest_first else "rowid"
+        with self._lock:
+            rows = self._db.execute(f"SELECT key, record FROM frontier WHERE state = ? ORDER BY {order}",
+                                    (DONE,)).fetchall()
+        for key, record in rows:
+            yield key, json.loads(record)
+
+    def failed(self) -> List[Tuple[str, str, str]]:
+        """
+        Function to get the (key, url, error) of the urls which failed on their last attempt.
+        """
+        with self._lock:
+            return self._db.execute("SELECT key, url, error FROM frontier WHERE state = ? ORDER BY rowid",
+                                    (FAILED,)).fetchall()
+
+    def retryable(self, max_attempts: int = None) -> List[Tuple[str, str, str]]:
+        """
+        Function to get the (key, url, error) of the failed urls worth another attempt now, see mark_failed.
+
+        :param max_attempts: leave out the urls which failed this many times or more
+        """
+        with self._lock:
+            return self._db.execute("SELECT key, url, error FROM frontier WHERE state = ? AND retryable AND "
+                                    "attempts < ? ORDER BY rowid", (FAILED, max_attempts or 2 ** 31)).fetchall()
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM frontier GROUP BY state").fetchall()
+        return {PENDING: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def discard(self, keys: Iterable[str]):
+        """
+        Function to forget keys which are not done, e.g. keys generated by mistake whose page does not exist.
+        """
+        with self._lock:
+            self._db.executemany("DELETE FROM frontier WHERE key = ? AND state != ?", ((key, DONE) for key in keys))
+            self._db.commit()
+
+    def clear(self):
+        """
+        Function to forget every url, e.g. when a crawl is complete and the next one must start from scratch.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM frontier")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
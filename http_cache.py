@@ -0,0 +1,217 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Union
+
+from write_queue import WriteQueue
+
+
+def get_header(headers: dict, name: str, default: str = None) -> Union[str, None]:
+    """
+    Function to read a header from a plain dict ignoring the case of the name.
+    """
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+class CachedResponse:
+    def __init__(self, url: str, status: int, headers: dict, content: bytes, encoding: str, expires_at: float):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.expires_at = expires_at
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def conditional_headers(self) -> dict:
+        """
+        Function to build the headers which ask the server to answer 304 if the page did not change.
+        """
+        headers = {}
+        if get_header(self.headers, "ETag"):
+            headers["If-None-Match"] = get_header(self.headers, "ETag")
+        if get_header(self.headers, "Last-Modified"):
+            headers["If-Modified-Since"] = get_header(self.headers, "Last-Modified")
+        return headers
+
+
+class ResponseCache:
+    """
+    On disk cache of GET responses keyed by url, stored compressed in a sqlite file. Stored pages are revalidated
+    with If-None-Match/If-Modified-Since, so an unchanged page costs a 304 instead of the whole body. A page is
+    served without asking the server at all while it is fresh, i.e. for `fresh_for` seconds or the max-age the
+    server sent, whichever is longer.
+
+    A page whose download was stopped early, see Fetcher.fetch's stop_after, is stored as a `variant` of its url
+    and only served to the requests of the same variant, the others need the whole page.
+
+    The pages are compressed and written by a thread of the cache, a batch of them at a time with a single commit,
+    so `store` and `refresh` return at once. A page is only found by `lookup` once it was written.
+
+    :param path: sqlite file of the cache
+    :param max_age: entries stored longer ago than this are evicted, in seconds
+    :param max_size: max total size of the stored bodies in bytes, least recently used entries are evicted first
+    :param fresh_for: seconds a stored page is used without revalidation
+    """
+
+    def __init__(self, path: str = "data/http_cache.sqlite", max_age: float = 30 * 24 * 3600,
+                 max_size: int = 2 * 1024 ** 3, fresh_for: float = 0):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.fresh_for = fresh_for
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.bytes_saved = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                encoding TEXT,
+                size INTEGER,
+                stored_at REAL,
+                accessed_at REAL,
+                lifetime REAL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._db.commit()
+        self.evict()
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self._writes = WriteQueue(self._write_batch, "http cache")
+
+    @staticmethod
+    def _key(url: str, variant: str) -> str:
+        # a url never has a space in it
+        return f"{url} {variant}" if variant else url
+
+    def lookup(self, url: str, variant: str = "") -> Union[CachedResponse, None]:
+        """
+        :param variant: e.g. "stop_after=div,table-wrapper-pairs", empty for the whole page
+        """
+        key = self._key(url, variant)
+        with self._lock:
+            row = self._db.execute("SELECT status, headers, body, encoding, stored_at, lifetime FROM responses "
+                                   "WHERE url = ?", (key,)).fetchone()
+            if not row:
+                return
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), key))
+        status, headers, body, encoding, stored_at, lifetime = row
+        # lifetime is -1 when the server asked for revalidation on every use
+        expires_at = stored_at + max(self.fresh_for, lifetime) if lifetime >= 0 else stored_at
+        return CachedResponse(url, status, json.loads(headers), zlib.decompress(body), encoding, expires_at)
+
+    @staticmethod
+    def _server_lifetime(headers: dict) -> float:
+        cache_control = get_header(headers, "Cache-Control", "")
+        if "no-cache" in cache_control:
+            return -1
+        match = re.search(r"max-age=(\d+)", cache_control)
+        return int(match.group(1)) if match else 0
+
+    def store(self, url: str, status: int, headers: dict, content: bytes, encoding: str, variant: str = ""):
+        if "no-store" in get_header(headers, "Cache-Control", ""):
+            return
+        self._writes.put(("store", self._key(url, variant), time.time(), (status, headers, content, encoding)))
+
+    def refresh(self, url: str, headers: dict, variant: str = ""):
+        """
+        Function to mark the stored page as valid again after the server answered 304.
+
+        :param url:
+        :param headers: headers of the 304 response
+        :param variant: see lookup
+        """
+        self._writes.put(("refresh", self._key(url, variant), time.time(), headers))
+
+    def _write_batch(self, writes: list):
+        # runs in the thread of the write queue
+        rows = []
+        for operation, url, now, data in writes:
+            if operation == "store":
+                status, headers, content, encoding = data
+                rows.append((operation, url, now, (status, json.dumps(headers), zlib.compress(content), encoding,
+                                                   self._server_lifetime(headers))))
+            else:
+                rows.append((operation, url, now, self._server_lifetime(data)))
+        with self._lock:
+            for operation, url, now, data in rows:
+                if operation == "store":
+                    status, headers, body, encoding, lifetime = data
+                    previous = self._db.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+                    self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (url, status, headers, body, encoding, len(body), now, now, lifetime))
+                    self._size += len(body) - (previous[0] if previous else 0)
+                else:
+                    self._db.execute("UPDATE responses SET stored_at = ?, accessed_at = ?, lifetime = ? "
+                                     "WHERE url = ?", (now, now, data, url))
+            self._db.commit()
+        if self._size > self.max_size:
+            self.evict()
+
+    def flush(self):
+        """
+        Function to wait until the pages stored so far are written.
+        """
+        self._writes.flush()
+
+    def evict(self):
+        """
+        Function to remove the entries older than max_age, then the least recently used ones until the cache fits
+        in max_size.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - self.max_age,))
+            size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if size > self.max_size:
+                # free up 10% more than needed so we don't evict on every store
+                target = size - self.max_size * 0.9
+                freed = 0
+                urls = []
+                for url, entry_size in self._db.execute("SELECT url, size FROM responses ORDER BY accessed_at"):
+                    if freed >= target:
+                        break
+                    urls.append((url,))
+                    freed += entry_size
+                self._db.executemany("DELETE FROM responses WHERE url = ?", urls)
+                size -= freed
+            self._db.commit()
+            self._size = size
+
+    def report(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def print_report(self):
+        print(f"http cache: {self.hits} hits, {self.revalidated} not modified (304), {self.misses} misses, "
+              f"{self.bytes_saved / 1024 ** 2:.1f} MB not downloaded")
+
+    def close(self):
+        self._writes.close()
+        with self._lock:
+            self._db.commit()
+            self._db.close()
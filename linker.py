@@ -0,0 +1,370 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from datetime import date
+from typing import Dict, Set, Union
+
+import numpy as np
+
+from record_store import RecordStore
+from records import RecordColumns
+from writers import open_record_writer
+
+# source of the record store: fields of its records which name the product, the product name first
+PRODUCT_FIELDS = {
+    "sgs": ("Product Name", "Brand", "Type/Model"),
+    "asean": ("Product Name", "Model Product"),
+}
+
+# values of the fields which tell nothing about the product
+PLACEHOLDERS = {"", "unknown", "n a", "na", "none", "not specified", "various"}
+
+PRIME = 4294967311     # first prime above 2 ** 32
+MAX_HASH = 2 ** 32 - 1
+
+# the records changed this long before the last run are read again, their updates may have been committed late
+OVERLAP = 300
+
+
+def normalize_text(value) -> str:
+    """
+    Function to lower case the text and strip its accents and punctuation.
+    e.g. "Bébé-Car (2 pcs.)" -> "bebe car 2 pcs"
+    """
+    if not isinstance(value, str):
+        return ""
+    value = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode().lower()
+    return " ".join(re.findall(r"[a-z0-9]+", value))
+
+
+def model_numbers(source: str, record: dict) -> Set[str]:
+    """
+    Function to get the words of the brand and model of a record with a digit in them, e.g. "KX-200" -> {"200"}
+    and "model 2023a" -> {"2023a"}.
+    """
+    numbers = set()
+    for field in PRODUCT_FIELDS[source][1:]:
+        numbers.update(word for word in normalize_text(record.get(field)).split()
+                       if any(char.isdigit() for char in word))
+    return numbers
+
+
+def product_features(source: str, record: dict) -> Set[str]:
+    """
+    Function to get the features of the product of a record: the character 3-grams of its name, brand and model,
+    which still match when the sites spell or order the words differently, and its model numbers as a whole.
+
+    :param source: key of PRODUCT_FIELDS
+    :param record: record of the source
+    :return: set of str, empty if the record names no product
+    """
+    values = [normalize_text(record.get(field)) for field in PRODUCT_FIELDS[source]]
+    text = " ".join(value for value in values if value not in PLACEHOLDERS)
+    features = {text[i:i + 3] for i in range(len(text) - 2)}
+    features.update("#" + number for number in model_numbers(source, record))
+    return features
+
+
+class RecordLinker:
+    """
+    Index of the records of the record store which finds the ones describing the same product, on the same or on
+    different sites, and groups them into clusters.
+
+    Every record gets a MinHash signature of its product features, see product_features. The signature is split
+    into `bands`, and records which share a band land in the same bucket. Only records sharing a bucket are
+    compared, so linking n records takes about n lookups instead of n² comparisons. A pair is linked if the
+    signatures estimate a Jaccard similarity of at least `threshold`, their dates are at most `max_days` apart and
+    they share a model number, if both have one: "Heater KX-200" and "Heater KX-300" are different products.
+
+    The signatures and buckets are kept in a sqlite file. A run only indexes the records which were added or
+    changed in the store since the last one and compares them with the whole index. The clusters are the
+    connected groups of linked records. A cluster is identified by the smallest id of its records, so a cluster
+    keeps its id as records join it. When two clusters merge, the merged cluster takes the smaller of the two ids.
+
+    :param path: sqlite file of the index
+    :param num_perm: no of MinHash values of a record
+    :param bands: no of LSH bands, must divide num_perm. Pairs whose Jaccard similarity is about
+        (1 / bands) ** (bands / num_perm) have even chances of being compared, 0.42 by default
+    :param threshold: min estimated Jaccard similarity of two linked records
+    :param max_days: max no of days between the dates of two linked records, if both have one
+    :param max_bucket_size: buckets with more records are not used to find candidates, e.g. of a generic name
+    :param cross_source_only: only link records of different sources
+    :param seed: seed of the MinHash permutations, an index is only valid with the seed it was built with
+    """
+
+    def __init__(self, path: str = "data/links.sqlite", num_perm: int = 128, bands: int = 32, threshold: float = 0.5,
+                 max_days: int = 365, max_bucket_size: int = 200, cross_source_only: bool = False, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm {num_perm} is not a multiple of bands {bands}")
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.max_days = max_days
+        self.max_bucket_size = max_bucket_size
+        self.cross_source_only = cross_source_only
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, MAX_HASH, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, MAX_HASH, size=num_perm, dtype=np.uint64)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                key TEXT NOT NULL,
+                published TEXT,
+                models TEXT,
+                signature BLOB,
+                updated_at REAL,
+                cluster INTEGER,
+                UNIQUE (source, key)
+            );
+            CREATE INDEX IF NOT EXISTS records_cluster ON records (cluster);
+            CREATE TABLE IF NOT EXISTS buckets (band INTEGER, bucket INTEGER, record_id INTEGER);
+            CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (band, bucket);
+            CREATE INDEX IF NOT EXISTS buckets_record ON buckets (record_id);
+            CREATE TABLE IF NOT EXISTS links (
+                record_id INTEGER,
+                other_id INTEGER,
+                similarity REAL,
+                PRIMARY KEY (record_id, other_id)
+            );
+            CREATE INDEX IF NOT EXISTS links_other ON links (other_id);
+            CREATE TEMP TABLE pending (id INTEGER PRIMARY KEY);
+            CREATE TEMP TABLE touched (band INTEGER, bucket INTEGER, PRIMARY KEY (band, bucket));
+        """)
+        settings = {"num_perm": str(num_perm), "bands": str(bands), "seed": str(seed)}
+        stored = dict(self._db.execute("SELECT name, value FROM settings WHERE name IN ('num_perm', 'bands', 'seed')"))
+        if stored and stored != settings:
+            raise ValueError(f"{path} was built with {stored}, delete it to build it again with {settings}")
+        self._db.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)", settings.items())
+        self._db.commit()
+
+    def signature(self, features: Set[str]) -> Union[np.ndarray, None]:
+        """
+        Function to get the MinHash signature of a set of features.
+
+        :return: array of num_perm uint32, None if there are no features
+        """
+        if not features:
+            return None
+        hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in features), dtype=np.uint64,
+                             count=len(features))
+        # a and the hashes are below 2 ** 32, so a * hash + b never overflows 64 bits
+        values = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % np.uint64(PRIME)
+        return (values & np.uint64(MAX_HASH)).min(axis=1).astype(np.uint32)
+
+    def _buckets(self, signature: np.ndarray):
+        for band, values in enumerate(signature.reshape(self.bands, -1)):
+            yield band, int.from_bytes(hashlib.blake2b(values.tobytes(), digest_size=8).digest(), "little",
+                                       signed=True)
+
+    def _index(self, source: str, key: str, published: str, record: dict, updated_at: float) -> bool:
+        # returns False if the record is indexed already as it is
+        row = self._db.execute("SELECT id, updated_at FROM records WHERE source = ? AND key = ?",
+                               (source, key)).fetchone()
+        if row and row[1] == updated_at:
+            return False
+        signature = self.signature(product_features(source, record))
+        blob = signature.tobytes() if signature is not None else None
+        models = " ".join(sorted(model_numbers(source, record)))
+        if row:
+            record_id = row[0]
+            self._db.execute("UPDATE records SET published = ?, models = ?, signature = ?, updated_at = ? "
+                             "WHERE id = ?", (published, models, blob, updated_at, record_id))
+            self._db.execute("DELETE FROM buckets WHERE record_id = ?", (record_id,))
+            self._db.execute("DELETE FROM links WHERE record_id = ? OR other_id = ?", (record_id, record_id))
+        else:
+            record_id = self._db.execute("INSERT INTO records (source, key, published, models, signature, "
+                                         "updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                         (source, key, published, models, blob, updated_at)).lastrowid
+            self._db.execute("UPDATE records SET cluster = id WHERE id = ?", (record_id,))
+        if signature is not None:
+            self._db.executemany("INSERT INTO buckets (band, bucket, record_id) VALUES (?, ?, ?)",
+                                 ((band, bucket, record_id) for band, bucket in self._buckets(signature)))
+        self._db.execute("INSERT OR IGNORE INTO pending (id) VALUES (?)", (record_id,))
+        return True
+
+    def _is_link(self, record: tuple, other: tuple) -> bool:
+        # the rules checked after the similarity, on the few pairs which are similar enough
+        (source, published, models), (other_source, other_published, other_models) = record, other
+        if self.cross_source_only and source == other_source:
+            return False
+        if models and other_models and models.isdisjoint(other_models):
+            return False
+        if published and other_published:
+            return abs((date.fromisoformat(published) - date.fromisoformat(other_published)).days) <= self.max_days
+        return True
+
+    def link(self, store: RecordStore) -> Dict[str, int]:
+        """
+        Function to index the records added or changed in the store since the last run, link them with the
+        similar records of the index and update the clusters.
+
+        :param store: RecordStore of the records
+        :return: {"indexed": no of records indexed, "candidates": no of pairs compared, "links": no of new links,
+            "clusters": no of clusters with more than one record}
+        """
+        started = time.monotonic()
+        with self._lock:
+            since = float(dict(self._db.execute("SELECT name, value FROM settings")).get("indexed_until", 0))
+            self._db.execute("DELETE FROM pending")
+            self._db.execute("DELETE FROM touched")
+            indexed = 0
+            newest = since
+            for source, key, published, record, updated_at in store.updated_since(since - OVERLAP):
+                if source in PRODUCT_FIELDS and self._index(source, key, published, record, updated_at):
+                    indexed += 1
+                newest = max(newest, updated_at)
+
+            # the buckets of the pending records, the huge ones left out
+            self._db.execute("""
+                INSERT INTO touched SELECT buckets.band, buckets.bucket FROM buckets
+                JOIN (SELECT DISTINCT band, bucket FROM buckets WHERE record_id IN (SELECT id FROM pending)) AS new
+                    ON new.band = buckets.band AND new.bucket = buckets.bucket
+                GROUP BY buckets.band, buckets.bucket HAVING COUNT(*) BETWEEN 2 AND ?""", (self.max_bucket_size,))
+            # pairs of a pending record and any record sharing one of these buckets, as smaller id << 32 | larger id
+            pairs = np.fromiter((pair for (pair,) in self._db.execute("""
+                SELECT MIN(new.record_id, old.record_id) << 32 | MAX(new.record_id, old.record_id)
+                FROM touched
+                JOIN buckets new ON new.band = touched.band AND new.bucket = touched.bucket
+                JOIN buckets old ON old.band = touched.band AND old.bucket = touched.bucket
+                WHERE new.record_id IN (SELECT id FROM pending) AND old.record_id != new.record_id""")),
+                                dtype=np.int64)
+            pairs = np.unique(pairs)
+            pairs = np.stack([pairs >> 32, pairs & MAX_HASH], axis=1)
+
+            # the signatures of the pairs are compared with numpy, many pairs at a time
+            ids = np.unique(pairs)
+            records, signatures = {}, np.zeros((len(ids), self.num_perm), dtype=np.uint32)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500].tolist()
+                for record_id, source, published, models, blob in self._db.execute(
+                        f"SELECT id, source, published, models, signature FROM records WHERE id IN "
+                        f"({','.join('?' * len(chunk))})", chunk):
+                    records[record_id] = (source, published, set(models.split()))
+                    signatures[np.searchsorted(ids, record_id)] = np.frombuffer(blob, dtype=np.uint32)
+            links = []
+            for start in range(0, len(pairs), 20000):
+                chunk = pairs[start:start + 20000]
+                rows = np.searchsorted(ids, chunk)
+                similarities = (signatures[rows[:, 0]] == signatures[rows[:, 1]]).mean(axis=1)
+                for i in np.flatnonzero(similarities >= self.threshold):
+                    record_id, other_id = chunk[i].tolist()
+                    if self._is_link(records[record_id], records[other_id]):
+                        links.append((record_id, other_id, float(similarities[i])))
+            self._db.executemany("INSERT OR REPLACE INTO links VALUES (?, ?, ?)", links)
+
+            clusters = self._update_clusters()
+            self._db.execute("INSERT OR REPLACE INTO settings VALUES ('indexed_until', ?)", (str(newest),))
+            self._db.commit()
+        print(f"{indexed} records indexed, {len(pairs)} pairs compared, {len(links)} links, {clusters} clusters "
+              f"of duplicates ({time.monotonic() - started:.1f}s)")
+        return {"indexed": indexed, "candidates": len(pairs), "links": len(links), "clusters": clusters}
+
+    def _update_clusters(self) -> int:
+        # the links are far fewer than the records, the clusters are worked out from all of them every run
+        parent = {}
+
+        def find(record_id):
+            root = record_id
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while record_id != root:
+                parent[record_id], record_id = root, parent[record_id]
+            return root
+
+        for record_id, other_id in self._db.execute("SELECT record_id, other_id FROM links"):
+            root, other_root = find(record_id), find(other_id)
+            if root != other_root:
+                parent[max(root, other_root)] = min(root, other_root)
+        clusters = {record_id: find(record_id) for record_id in list(parent)}
+        clusters.update((root, root) for root in set(clusters.values()))
+
+        # records whose links were removed by a change are on their own again
+        self._db.execute("UPDATE records SET cluster = id WHERE cluster != id AND id NOT IN "
+                         "(SELECT record_id FROM links UNION SELECT other_id FROM links)")
+        self._db.executemany("UPDATE records SET cluster = ? WHERE id = ? AND cluster != ?",
+                             ((cluster, record_id, cluster) for record_id, cluster in clusters.items()))
+        return len(set(clusters.values()))
+
+    def cluster_of(self, source: str, key: str) -> Union[int, None]:
+        with self._lock:
+            row = self._db.execute("SELECT cluster FROM records WHERE source = ? AND key = ?",
+                                   (source, key)).fetchone()
+        return row[0] if row else None
+
+    def export(self, path: str, store: RecordStore, include_single: bool = False) -> int:
+        """
+        Function to export the records of the clusters with their cluster id, to an Excel, csv, jsonl or parquet
+        file.
+
+        :param path: output file, the format is taken from the extension
+        :param store: RecordStore the records are read from
+        :param include_single: True to export the records without a duplicate too
+        :return: no of records exported
+        """
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT records.cluster, sizes.size, records.source, records.key FROM records
+                JOIN (SELECT cluster, COUNT(*) AS size FROM records GROUP BY cluster) AS sizes
+                    ON sizes.cluster = records.cluster
+                WHERE sizes.size > ? ORDER BY sizes.size DESC, records.cluster, records.source, records.key""",
+                                   (0 if include_single else 1,)).fetchall()
+        records = RecordColumns(["Cluster ID", "Cluster Size", "Source", "Key"])
+        for cluster, size, source, key in rows:
+            records.append({"Cluster ID": cluster, "Cluster Size": size, "Source": source, "Key": key,
+                            **(store.get(source, key) or {})})
+        df = records.to_dataframe()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.lower().endswith(".xlsx"):
+            df.to_excel(path)
+        else:
+            with open_record_writer(path) as writer:
+                writer.write_frame(df)
+        return len(df)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="find the records of the same product across the sources")
+    parser.add_argument("--store", default="data/records.sqlite", help="sqlite file of the record store")
+    parser.add_argument("--index", default="data/links.sqlite", help="sqlite file of the index")
+    parser.add_argument("--threshold", type=float, default=0.5, help="min similarity of two linked records")
+    parser.add_argument("--max-days", type=int, default=365, help="max no of days between two linked records")
+    parser.add_argument("--cross-source-only", action="store_true", help="only link records of different sources")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("link", help="index the new and changed records of the store and link them")
+    export = commands.add_parser("export", help="export the clusters to .xlsx, .csv, .jsonl or .parquet")
+    export.add_argument("path")
+    export.add_argument("--all", action="store_true", help="export the records without a duplicate too")
+    args = parser.parse_args()
+
+    record_store = RecordStore(args.store)
+    linker = RecordLinker(args.index, threshold=args.threshold, max_days=args.max_days,
+                          cross_source_only=args.cross_source_only)
+    try:
+        if args.command == "link":
+            linker.link(record_store)
+        else:
+            print(f"{linker.export(args.path, record_store, args.all)} records exported to {args.path}")
+    finally:
+        linker.close()
+        record_store.close()
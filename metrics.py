@@ -0,0 +1,264 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+# upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stages timed by the fetcher, parse_html, the extractors and the writers, in pipeline order
+STAGES = ("connect", "ttfb", "download", "parse", "extract", "write")
+
+
+class Histogram:
+    """
+    Cumulative histogram of durations with fixed buckets, the same shape as a Prometheus histogram.
+
+    :param buckets: upper bounds of the buckets in seconds
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, share: float) -> float:
+        """
+        Function to estimate a quantile, the upper bound of the bucket it falls in.
+        """
+        if not self.count:
+            return 0.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= share * self.count:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_seconds": round(self.sum, 3),
+            "avg_ms": round(self.sum / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.5) * 1000, 2),
+            "p99_ms": round(self.quantile(0.99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class Metrics:
+    """
+    Timings of every stage of the scrapers and counters of the requests, e.g. connect/ttfb/parse/write durations,
+    responses by status code and retries. Read them at the end of the run with `dump`/`print_report`, or while it
+    is running from the http endpoint started by `serve`. Safe to use from any thread.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._progress_stopped = None
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Context manager to time the block as the given stage. e.g. with get_metrics().timer("parse"): ...
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def increment(self, name: str, value: float = 1, labels: dict = None):
+        """
+        Function to add to a counter.
+
+        :param name: e.g. responses
+        :param value:
+        :param labels: e.g. {"status": 200}
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name: str, labels: dict = None) -> float:
+        """
+        Function to get the value of a counter, the sum of all its labels if labels is None.
+        """
+        with self._lock:
+            if labels is not None:
+                return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            stages = {stage: histogram.to_dict() for stage, histogram in self._ordered_stages()}
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                if labels:
+                    counters.setdefault(name, {})[",".join(f"{key}={value}" for key, value in labels)] = value
+                else:
+                    counters[name] = value
+        return {"elapsed_seconds": round(time.time() - self.started, 2), "stages": stages, "counters": counters}
+
+    def _ordered_stages(self):
+        return sorted(self.stages.items(),
+                      key=lambda item: (STAGES.index(item[0]) if item[0] in STAGES else len(STAGES), item[0]))
+
+    def dump(self, path: str):
+        """
+        Function to save the metrics as json, e.g. at the end of the run.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def prometheus_text(self) -> str:
+        """
+        Function to render the metrics in the Prometheus text format.
+        """
+        lines = ["# TYPE scraper_stage_seconds histogram"]
+        with self._lock:
+            for stage, histogram in self._ordered_stages():
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'scraper_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'scraper_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'scraper_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f"# TYPE scraper_{name}_total counter")
+                for (counter_name, labels), value in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                    if counter_name != name:
+                        continue
+                    label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                    lines.append(f"scraper_{name}_total{{{label_text}}} {value}" if label_text
+                                 else f"scraper_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9100, host: str = "127.0.0.1"):
+        """
+        Function to serve the metrics over http from a background thread while the scraper runs.
+        /metrics returns the Prometheus text format and /stats the json.
+
+        :param port:
+        :param host: 0.0.0.0 to make it reachable from other machines
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.prometheus_text().encode(), "text/plain; version=0.0.4"
+                elif self.path == "/stats":
+                    body, content_type = json.dumps(metrics.to_dict()).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        print(f"metrics available at http://{host}:{self._server.server_port}/metrics")
+
+    def summary(self) -> str:
+        """
+        Function to get a one line summary of the run so far.
+        """
+        elapsed = time.time() - self.started
+        responses = self.counter("responses")
+        parts = [f"{responses:.0f} responses ({responses / elapsed if elapsed else 0:.1f}/s)",
+                 f"{self.counter('downloaded_bytes') / 1024 ** 2:.1f} MB"]
+        with self._lock:
+            for stage, histogram in self._ordered_stages():
+                parts.append(f"{stage} p50 {histogram.quantile(0.5) * 1000:.0f} ms")
+        errors = self.counter("request_errors")
+        retries = self.counter("retries")
+        if errors or retries:
+            parts.append(f"{errors:.0f} errors, {retries:.0f} retries")
+        return ", ".join(parts)
+
+    def start_progress(self, interval: float = 10):
+        """
+        Function to print the summary every `interval` seconds until stop_progress is called.
+        """
+        self._progress_stopped = threading.Event()
+
+        def report(stopped: threading.Event):
+            while not stopped.wait(interval):
+                print(self.summary())
+
+        threading.Thread(target=report, args=(self._progress_stopped,), name="progress", daemon=True).start()
+
+    def stop_progress(self):
+        if self._progress_stopped:
+            self._progress_stopped.set()
+
+    def print_report(self):
+        """
+        Function to print the time spent in every stage, to see whether the network, the parser or the export is
+        the bottleneck.
+        """
+        report = self.to_dict()
+        print(f"metrics after {report['elapsed_seconds']} seconds:")
+        for stage, stats in report["stages"].items():
+            print(f"  {stage:<10} {stats['count']:>8} times, {stats['total_seconds']:>9.2f} s total, "
+                  f"p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms")
+        for name, value in report["counters"].items():
+            print(f"  {name}: {value}")
+
+    def close(self):
+        self.stop_progress()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """
+    Function to get the process wide metrics, shared by the fetcher, the parser and the writers.
+
+    :return: Metrics
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+    return _metrics
+
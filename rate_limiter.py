@@ -0,0 +1,257 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Union
+
+
+def parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    """
+    Function to convert the Retry-After header into no of seconds to wait.
+
+    :param value: header value, either seconds or http date
+    :return: seconds or None if header is missing or invalid
+    """
+    if not value:
+        return
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return
+
+
+class TokenBucket:
+    """
+    Token bucket to cap the no of requests per second sent to a host. Allows a burst of one second worth of tokens.
+
+    :param rate: tokens added per second
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostController:
+    """
+    AIMD controller for a single host. Concurrency and the token bucket rate grow additively while the responses
+    are healthy and are cut multiplicatively on 429, 5xx, timeouts or when TTFB rises well above the baseline seen
+    so far.
+
+    :param concurrency: initial no of requests in flight
+    :param rate: initial max requests per second
+    :param min_concurrency: lower bound of concurrency
+    :param max_concurrency: upper bound of concurrency
+    :param min_rate: lower bound of requests per second
+    :param max_rate: upper bound of requests per second
+    :param rate_increase: req/s added to the rate for every second of healthy responses
+    :param decrease_factor: multiplier applied to concurrency and rate on back off
+    :param ttfb_tolerance: back off when TTFB average is this many times the baseline
+    """
+
+    def __init__(self, concurrency: int = 4, rate: float = 20.0, min_concurrency: int = 1,
+                 max_concurrency: int = 32, min_rate: float = 0.5, max_rate: float = 500.0,
+                 rate_increase: float = 5.0, decrease_factor: float = 0.5, ttfb_tolerance: float = 2.0):
+        self.concurrency = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.decrease_factor = decrease_factor
+        self.ttfb_tolerance = ttfb_tolerance
+        self.bucket = TokenBucket(rate)
+
+        self.in_flight = 0
+        self.ttfb = None
+        self.ttfb_baseline = None
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self._slot_freed = asyncio.Condition()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    async def acquire(self):
+        async with self._slot_freed:
+            await self._slot_freed.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+
+        try:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.bucket.acquire()
+        except asyncio.CancelledError:
+            # the request is never sent and release is never called, the slot is given back here
+            self.in_flight -= 1
+            async with self._slot_freed:
+                self._slot_freed.notify_all()
+            raise
+
+    async def release(self, status: Union[int, None], ttfb: Union[float, None], retry_after: float = None,
+                      feedback: bool = True):
+        """
+        Function to give the slot back and feed the outcome of the request to the controller.
+
+        :param status: http status, None if the request timed out before getting a response
+        :param ttfb: seconds until the response headers arrived
+        :param retry_after: seconds the server asked us to wait
+        :param feedback: False to only give the slot back, e.g. for a request which was cancelled or failed on our
+            side, such as a dns error, it tells nothing about the load of the host
+        """
+        self.in_flight -= 1
+        if feedback:
+            self.requests += 1
+            self._feedback(status, ttfb, retry_after)
+        async with self._slot_freed:
+            self._slot_freed.notify_all()
+
+    def _feedback(self, status, ttfb, retry_after):
+        now = time.monotonic()
+        if status is None or status == 429 or status >= 500:
+            if status == 429:
+                self.throttled += 1
+            else:
+                self.errors += 1
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            self._decrease(now)
+            return
+
+        if ttfb is not None:
+            self.ttfb = ttfb if self.ttfb is None else 0.8 * self.ttfb + 0.2 * ttfb
+            if self.ttfb_baseline is None or self.ttfb < self.ttfb_baseline:
+                self.ttfb_baseline = self.ttfb
+            else:
+                # let the baseline follow slowly if the server gets slower for good
+                self.ttfb_baseline += (self.ttfb - self.ttfb_baseline) * 0.01
+
+            if self.ttfb > self.ttfb_baseline * self.ttfb_tolerance:
+                self._decrease(now)
+                return
+
+        self._increase()
+
+    def _increase(self):
+        # +1 concurrency per round of `concurrency` responses, +rate_increase req/s per second of `rate` responses
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        self.bucket.rate = min(self.max_rate, self.bucket.rate + self.rate_increase / self.bucket.rate)
+
+    def _decrease(self, now: float):
+        # cut at most once per round trip, a burst of errors is a single congestion signal
+        if now - self.last_decrease < max(1.0, 2 * (self.ttfb or 0)):
+            return
+        self.last_decrease = now
+        self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease_factor)
+        self.bucket.rate = max(self.min_rate, self.bucket.rate * self.decrease_factor)
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "concurrency": round(self.concurrency, 2),
+            "rate_limit": round(self.rate, 2),
+            "throughput": round(self.requests / elapsed, 2) if elapsed else 0.0,
+            "ttfb_ms": round(self.ttfb * 1000, 1) if self.ttfb is not None else None,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "errors": self.errors,
+        }
+
+
+class FairShare:
+    """
+    Budget of requests in flight shared by all the hosts. While the budget is used up, a freed slot goes to the
+    waiting host with the fewest requests in flight, so a host with a long queue can't take the slots of the others.
+    Must only be used from the fetcher event loop.
+
+    :param budget: max no of requests in flight across all the hosts
+    """
+
+    def __init__(self, budget: int = 64):
+        self.budget = budget
+        self.total = 0
+        self.in_flight: Dict[str, int] = {}
+        self.waiting: Dict[str, int] = {}
+        self._slot_freed = asyncio.Condition()
+
+    def _is_turn_of(self, host: str) -> bool:
+        if self.total >= self.budget:
+            return False
+        fewest = min(self.in_flight.get(waiting_host, 0) for waiting_host in self.waiting)
+        return self.in_flight.get(host, 0) <= fewest
+
+    async def acquire(self, host: str):
+        async with self._slot_freed:
+            self.waiting[host] = self.waiting.get(host, 0) + 1
+            try:
+                await self._slot_freed.wait_for(lambda: self._is_turn_of(host))
+            finally:
+                self.waiting[host] -= 1
+                if not self.waiting[host]:
+                    del self.waiting[host]
+                # the hosts which waited behind this one may have their turn now
+                self._slot_freed.notify_all()
+            self.total += 1
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+
+    async def release(self, host: str):
+        async with self._slot_freed:
+            self.total -= 1
+            self.in_flight[host] -= 1
+            self._slot_freed.notify_all()
+
+
+class RateLimiter:
+    """
+    Keeps one HostController per host. Must only be used from the fetcher event loop.
+
+    :param controller_options: keyword arguments passed to every HostController
+    """
+
+    def __init__(self, **controller_options):
+        self.controller_options = controller_options
+        self.hosts: Dict[str, HostController] = {}
+
+    def get(self, host: str) -> HostController:
+        if host not in self.hosts:
+            self.hosts[host] = HostController(**self.controller_options)
+        return self.hosts[host]
+
+    async def acquire(self, host: str):
+        await self.get(host).acquire()
+
+    async def release(self, host: str, status: Union[int, None], ttfb: Union[float, None],
+                      retry_after: float = None, feedback: bool = True):
+        await self.get(host).release(status, ttfb, retry_after, feedback)
+
+    def report(self) -> dict:
+        return {host: controller.report() for host, controller in self.hosts.items()}
+
+    def print_report(self):
+        for host, report in self.report().items():
+            print(f"{host}: settled at {report['concurrency']} concurrent requests, "
+                  f"{report['rate_limit']} req/s limit, {report['throughput']} req/s achieved "
+                  f"({report['throttled']} throttled, {report['errors']} errors)")
@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import pandas as pd
+
+from records import RecordColumns
+from writers import open_record_writer
+
+# source: columns of its records which are indexed
+SOURCE_COLUMNS = {
+    "sgs": {"name": "Product Name", "date": "Publication Date", "country": "Country", "type": "Product Category"},
+    "asean": {"name": "Product Name", "date": "Recall Date", "country": "Country", "type": "Type"},
+}
+
+DATE_FORMATS = ("%Y-%m-%d", "%B %d, %Y", "%b %d, %Y", "%d %B %Y", "%d/%m/%Y")
+
+
+def normalize_date(value) -> Union[str, None]:
+    """
+    Function to convert the dates of the sites into yyyy-mm-dd, so they sort and compare as text.
+
+    :param value: e.g. "January 5, 2024" or "2024-01-05"
+    :return: str or None if the value is not a date
+    """
+    if not isinstance(value, str) or not value.strip():
+        return
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+
+
+class RecordStore:
+    """
+    Store of the scraped records of all the sources in a sqlite file, the system of record the Excel and csv files
+    are exported from. Every record is kept as json next to the columns it is looked up by: the publication date,
+    country and product type are indexed and the product name is full text searchable, so a query takes
+    milliseconds instead of loading a whole workbook.
+
+    :param path: sqlite file of the store
+    """
+
+    def __init__(self, path: str = "data/records.sqlite"):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        # the scrapers of run_all.py write to the same file at the same time
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                key TEXT NOT NULL,
+                product_name TEXT,
+                publication_date TEXT,
+                country TEXT,
+                product_type TEXT,
+                record TEXT,
+                first_seen REAL,
+                updated_at REAL,
+                UNIQUE (source, key)
+            );
+            CREATE INDEX IF NOT EXISTS records_date ON records (publication_date);
+            CREATE INDEX IF NOT EXISTS records_country ON records (country, publication_date);
+            CREATE INDEX IF NOT EXISTS records_type ON records (product_type, publication_date);
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS records_fts USING fts5 (
+                product_name, content='records', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS records_insert AFTER INSERT ON records BEGIN
+                INSERT INTO records_fts (rowid, product_name) VALUES (new.id, new.product_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_delete AFTER DELETE ON records BEGIN
+                INSERT INTO records_fts (records_fts, rowid, product_name)
+                VALUES ('delete', old.id, old.product_name);
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_update AFTER UPDATE ON records BEGIN
+                INSERT INTO records_fts (records_fts, rowid, product_name)
+                VALUES ('delete', old.id, old.product_name);
+                INSERT INTO records_fts (rowid, product_name) VALUES (new.id, new.product_name);
+            END;
+        """)
+        self._db.commit()
+
+    def upsert_many(self, source: str, records: Iterable[Tuple[str, dict]]) -> int:
+        """
+        Function to add the records of the source or update the stored ones. A record which did not change keeps
+        its updated_at.
+
+        :param source: key of SOURCE_COLUMNS
+        :param records: iterable of (key, record), e.g. Frontier.records()
+        :return: no of records added or changed
+        """
+        columns = SOURCE_COLUMNS[source]
+        now = time.time()
+        rows = ((source, key, record.get(columns["name"]), normalize_date(record.get(columns["date"])),
+                 record.get(columns["country"]), record.get(columns["type"]),
+                 json.dumps(record, ensure_ascii=False, default=str), now, now)
+                for key, record in records)
+        with self._lock:
+            self._db.executemany("""
+                INSERT INTO records (source, key, product_name, publication_date, country, product_type, record,
+                                     first_seen, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, key) DO UPDATE SET product_name = excluded.product_name,
+                    publication_date = excluded.publication_date, country = excluded.country,
+                    product_type = excluded.product_type, record = excluded.record, updated_at = excluded.updated_at
+                WHERE record != excluded.record""", rows)
+            self._db.commit()
+            # the records added or changed by this call are the ones stamped with its time
+            return self._db.execute("SELECT COUNT(*) FROM records WHERE source = ? AND updated_at = ?",
+                                    (source, now)).fetchone()[0]
+
+    def upsert(self, source: str, key: str, record: dict) -> bool:
+        return self.upsert_many(source, [(key, record)]) > 0
+
+    def get(self, source: str, key: str) -> Union[dict, None]:
+        with self._lock:
+            row = self._db.execute("SELECT record FROM records WHERE source = ? AND key = ?",
+                                   (source, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def updated_since(self, since: float = 0) -> Iterator[Tuple[str, str, Union[str, None], dict, float]]:
+        """
+        Function to get the records added or changed after `since`, oldest change first, e.g. to only link the
+        records which changed since the last run, see linker.py.
+
+        :param since: time.time() of the last run, 0 for all the records
+        :return: iterator of (source, key, publication date yyyy-mm-dd, record, updated_at)
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT source, key, publication_date, record, updated_at FROM records "
+                                    "WHERE updated_at > ? ORDER BY updated_at, id", (since,)).fetchall()
+        for source, key, publication_date, record, updated_at in rows:
+            yield source, key, publication_date, json.loads(record), updated_at
+
+    def _select(self, query: str, params: list) -> pd.DataFrame:
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        records = RecordColumns()
+        for (record,) in rows:
+            records.append(json.loads(record))
+        return records.to_dataframe()
+
+    def query(self, source: str = None, country: str = None, product_type: str = None, since: str = None,
+              until: str = None, limit: int = None) -> pd.DataFrame:
+        """
+        Function to get the records matching all the given filters, newest first.
+
+        :param source: key of SOURCE_COLUMNS
+        :param country: e.g. "Germany"
+        :param product_type: product category of SGS or type of ASEAN. e.g. "Toys"
+        :param since: first publication date, yyyy-mm-dd
+        :param until: last publication date, yyyy-mm-dd
+        :param limit: max no of records
+        :return: dataframe
+        """
+        filters = [("source = ?", source), ("country = ?", country), ("product_type = ?", product_type),
+                   ("publication_date >= ?", since), ("publication_date <= ?", until)]
+        filters = [(condition, value) for condition, value in filters if value is not None]
+        query = "SELECT record FROM records"
+        if filters:
+            query += " WHERE " + " AND ".join(condition for condition, _ in filters)
+        query += " ORDER BY publication_date DESC, id"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return self._select(query, [value for _, value in filters])
+
+    def search(self, text: str, source: str = None, limit: int = 50) -> pd.DataFrame:
+        """
+        Function to find the records whose product name contains all the words of `text`, best matches first.
+        """
+        words = " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+        if not words:
+            return pd.DataFrame()
+        query = "SELECT records.record FROM records_fts JOIN records ON records.id = records_fts.rowid " \
+                "WHERE records_fts MATCH ?"
+        params = [words]
+        if source:
+            query += " AND records.source = ?"
+            params.append(source)
+        return self._select(query + f" ORDER BY rank LIMIT {int(limit)}", params)
+
+    def stats(self) -> List[dict]:
+        """
+        Function to check how fresh the store is: no of records, newest publication date and the last time a
+        record was added or changed, per source.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT source, COUNT(*), MAX(publication_date), MAX(updated_at) FROM records "
+                                    "GROUP BY source ORDER BY source").fetchall()
+        return [{"source": source, "records": count, "newest_publication_date": newest,
+                 "last_updated": datetime.fromtimestamp(updated).isoformat(timespec="seconds")}
+                for source, count, newest, updated in rows]
+
+    def export(self, path: str, source: str = None, **filters) -> int:
+        """
+        Function to export the records to an Excel, csv, jsonl or parquet file.
+
+        :param path: output file, the format is taken from the extension
+        :param source: key of SOURCE_COLUMNS, None for all the sources
+        :param filters: see query
+        :return: no of records exported
+        """
+        df = self.query(source, **filters)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.lower().endswith(".xlsx"):
+            sources = [source] if source else SOURCE_COLUMNS
+            for column in {SOURCE_COLUMNS[name]["date"] for name in sources}:
+                if column in df.columns:
+                    df[column] = pd.to_datetime(df[column], errors="coerce").dt.date
+            df.to_excel(path)
+        else:
+            with open_record_writer(path) as writer:
+                writer.write_frame(df)
+        return len(df)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def update_store(path: str, source: str, records: Iterable[Tuple[str, dict]], excel_filename: str = None) -> int:
+    """
+    Function to upsert the records of a run into the store and export the Excel file of the source from it.
+
+    :param path: sqlite file of the store
+    :param source: key of SOURCE_COLUMNS
+    :param records: iterable of (key, record), e.g. Frontier.records()
+    :param excel_filename: None to skip the export
+    :return: no of records added or changed
+    """
+    store = RecordStore(path)
+    try:
+        changed = store.upsert_many(source, records)
+        print(f"{changed} {source} records added or changed in {path}")
+        if excel_filename:
+            print(f"{store.export(excel_filename, source)} records exported to {excel_filename}")
+    finally:
+        store.close()
+    return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="query and export the scraped records")
+    parser.add_argument("--store", default="data/records.sqlite", help="sqlite file of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("stats", help="no of records and freshness of every source")
+
+    search = commands.add_parser("search", help="full text search on the product name")
+    search.add_argument("text")
+    search.add_argument("--source", choices=sorted(SOURCE_COLUMNS))
+    search.add_argument("--limit", type=int, default=20)
+
+    export = commands.add_parser("export", help="export the records to .xlsx, .csv, .jsonl or .parquet")
+    export.add_argument("path")
+    export.add_argument("--source", choices=sorted(SOURCE_COLUMNS))
+    export.add_argument("--country")
+    export.add_argument("--type", dest="product_type")
+    export.add_argument("--since", help="first publication date, yyyy-mm-dd")
+    export.add_argument("--until", help="last publication date, yyyy-mm-dd")
+    args = parser.parse_args()
+
+    store = RecordStore(args.store)
+    if args.command == "stats":
+        for source_stats in store.stats():
+            print(source_stats)
+    elif args.command == "search":
+        with pd.option_context("display.max_columns", 8, "display.width", 200):
+            print(store.search(args.text, args.source, args.limit))
+    else:
+        count = store.export(args.path, args.source, country=args.country, product_type=args.product_type,
+                             since=args.since, until=args.until)
+        print(f"{count} records exported to {args.path}")
@@ -0,0 +1,54 @@
+from typing import Dict, Iterable, Iterator
+
+import pandas as pd
+
+
+class RecordColumns:
+    """
+    Columnar builder of records. The column names are stored once, not in every record like in a list of dicts,
+    and every column is a plain list of values. Short strings which repeat a lot, e.g. the country or the product
+    category, are kept once and shared by all the rows.
+
+    Records may have different columns, the missing values are None.
+
+    :param columns: column names known up front, they come first in the dataframe
+    :param share_up_to: strings up to this many characters are shared between the rows
+    """
+
+    def __init__(self, columns: Iterable[str] = (), share_up_to: int = 64):
+        self.columns: Dict[str, list] = {name: [] for name in columns}
+        self.share_up_to = share_up_to
+        self._length = 0
+        self._strings: Dict[str, str] = {}
+
+    def append(self, record: dict):
+        for name, value in record.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = [None] * self._length
+            if isinstance(value, str) and len(value) <= self.share_up_to:
+                value = self._strings.setdefault(value, value)
+            column.append(value)
+        self._length += 1
+        if len(record) < len(self.columns):
+            for column in self.columns.values():
+                if len(column) < self._length:
+                    column.append(None)
+
+    def extend(self, records: Iterable[dict]):
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self) -> Iterator[dict]:
+        names = list(self.columns)
+        for values in zip(*self.columns.values()):
+            yield dict(zip(names, values))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Function to build the dataframe column by column, the records are never turned into rows.
+        """
+        return pd.DataFrame(self.columns, columns=list(self.columns), index=pd.RangeIndex(self._length))
@@ -0,0 +1,434 @@
+import argparse
+import heapq
+import math
+import os
+import signal
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+import asean_consumer_scraper
+import sgs_scraper_v2
+from archive import ResponseArchive
+from fetcher import get_fetcher, configure_fetcher
+from fingerprints import fingerprint
+from frontier import Frontier
+from http_cache import ResponseCache
+from metrics import get_metrics
+from reextract import EXTRACTORS, rebuild_outputs
+from record_store import SOURCE_COLUMNS, RecordStore, normalize_date
+from run_all import SOURCES
+from sgs_delta_sync import listing_pages
+from utils import get_soup, parse_total_record_count, sgs_record_key, LISTING_PAGE_TARGETS
+
+SGS_LISTING_URL = "https://campaigns.sgs.com/en/vr/product-recalls-light"
+
+# source of run_all.py: element its pages are needed for, see Fetcher.fetch's stop_after
+PAGE_ENDS = {
+    "sgs_extended": sgs_scraper_v2.RECORD_PAGE_END,
+    "asean": asean_consumer_scraper.PRODUCT_PAGE_END,
+}
+
+
+class RecrawlSchedule:
+    """
+    Schedule of the records the daemon keeps fresh, stored in a sqlite file. Every record has the time it was last
+    checked and how often its content changed between the checks, from which the chance it changed since its last
+    check is estimated:
+
+        rate = (changes + prior rate * prior_days) / (days observed + prior_days)
+        chance it is stale = 1 - exp(-rate * days since the last check)
+
+    The prior rate falls with the age of the record, a recall published this week is expected to change
+    `base_rate` times a day and one published `age_scale_days` ago half as often. The more checks a record had, the
+    more its own history counts. A record which was never checked is always due first.
+
+    :param path: sqlite file of the schedule
+    :param base_rate: expected no of changes a day of a record published today
+    :param age_scale_days: age at which a record is expected to change half as often as a new one
+    :param prior_days: weight of the prior rate, in days of observation
+    """
+
+    def __init__(self, path: str = "data/recrawl.sqlite", base_rate: float = 0.1, age_scale_days: float = 30,
+                 prior_days: float = 30):
+        self.path = path
+        self.base_rate = base_rate
+        self.age_scale_days = age_scale_days
+        self.prior_days = prior_days
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS schedule (
+                source TEXT NOT NULL,
+                key TEXT NOT NULL,
+                url TEXT,
+                published TEXT,
+                content_hash TEXT,
+                first_checked REAL,
+                last_checked REAL,
+                checks INTEGER DEFAULT 0,
+                changes INTEGER DEFAULT 0,
+                PRIMARY KEY (source, key)
+            )""")
+        self._db.commit()
+
+    def add(self, source: str,
+            entries: Iterable[Tuple[str, str, Union[str, None], Union[str, None], Union[float, None]]]) -> int:
+        """
+        Function to add the records which are not scheduled yet, the scheduled ones are left as they are.
+
+        :param source: key of run_all.SOURCES
+        :param entries: iterable of (key, url, publication date yyyy-mm-dd, content hash, time it was fetched).
+            The time is None for a record which was never fetched
+        :return: no of records added
+        """
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany("""
+                INSERT OR IGNORE INTO schedule (source, key, url, published, content_hash, first_checked, last_checked)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                 ((source, key, url, published, content_hash, checked_at, checked_at)
+                                  for key, url, published, content_hash, checked_at in entries))
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def update_urls(self, source: str, entries: Iterable[Tuple[str, str]]):
+        """
+        Function to set the current url of scheduled records, e.g. of the SGS records after new ones were published.
+
+        :param entries: iterable of (key, url)
+        """
+        with self._lock:
+            self._db.executemany("UPDATE schedule SET url = ? WHERE source = ? AND key = ?",
+                                 ((url, source, key) for key, url in entries))
+            self._db.commit()
+
+    def keys(self, source: str) -> List[str]:
+        with self._lock:
+            return [key for (key,) in self._db.execute("SELECT key FROM schedule WHERE source = ?", (source,))]
+
+    def stale_chance(self, now: float, published: str, first_checked: float, last_checked: float,
+                     changes: int) -> float:
+        if last_checked is None:
+            return 1.0
+        day = 24 * 3600
+        try:
+            age_days = (date.fromtimestamp(now) - date.fromisoformat(published)).days
+        except (TypeError, ValueError):
+            age_days = (now - first_checked) / day
+        prior_rate = self.base_rate / (1 + max(age_days, 0) / self.age_scale_days)
+        rate = (changes + prior_rate * self.prior_days) / ((last_checked - first_checked) / day + self.prior_days)
+        return 1 - math.exp(-rate * max(now - last_checked, 0) / day)
+
+    def chances(self, now: float = None) -> Iterator[Tuple[float, str, str, str]]:
+        """
+        Function to estimate the chance every scheduled record is stale.
+
+        :return: iterator of (chance, source, key, url)
+        """
+        now = now or time.time()
+        with self._lock:
+            rows = self._db.execute("SELECT source, key, url, published, first_checked, last_checked, changes "
+                                    "FROM schedule").fetchall()
+        for source, key, url, published, first_checked, last_checked, changes in rows:
+            yield self.stale_chance(now, published, first_checked, last_checked, changes), source, key, url
+
+    def due(self, count: int, sources: Iterable[str] = None) -> List[Tuple[float, str, str, str]]:
+        """
+        Function to get the records most likely to be stale.
+
+        :param count: max no of records
+        :param sources: keys of run_all.SOURCES, None for all the sources
+        :return: list of (chance, source, key, url), most likely stale first
+        """
+        sources = set(sources) if sources else None
+        return heapq.nlargest(count, (entry for entry in self.chances() if not sources or entry[1] in sources))
+
+    def checked(self, source: str, key: str, content_hash: str = None, published: str = None):
+        """
+        Function to save the result of a check of a record.
+
+        :param content_hash: hash of the record fetched now, None if the page could not be fetched. The record is
+            then moved to the back of the schedule without counting as a check
+        :param published: publication date of the record, yyyy-mm-dd
+        """
+        now = time.time()
+        with self._lock:
+            if content_hash is None:
+                self._db.execute("UPDATE schedule SET last_checked = ?, first_checked = COALESCE(first_checked, ?) "
+                                 "WHERE source = ? AND key = ?", (now, now, source, key))
+            else:
+                # a change is only counted between two checks, the first fetch of a record is not one
+                self._db.execute("""
+                    UPDATE schedule SET checks = checks + 1,
+                        changes = changes + (content_hash IS NOT NULL AND content_hash != ?),
+                        content_hash = ?, published = COALESCE(?, published), last_checked = ?,
+                        first_checked = COALESCE(first_checked, ?)
+                    WHERE source = ? AND key = ?""",
+                                 (content_hash, content_hash, published, now, now, source, key))
+            self._db.commit()
+
+    def report(self) -> Dict[str, dict]:
+        """
+        Function to get the no of scheduled records, checks, changes found and the expected no of stale records
+        per source.
+        """
+        expected_stale = defaultdict(float)
+        for chance, source, _, _ in self.chances():
+            expected_stale[source] += chance
+        with self._lock:
+            rows = self._db.execute("SELECT source, COUNT(*), SUM(checks), SUM(changes) FROM schedule "
+                                    "GROUP BY source").fetchall()
+        return {source: {"records": count, "checks": checks, "changes": changes,
+                         "expected_stale": round(expected_stale[source], 1)}
+                for source, count, checks, changes in rows}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def seed(schedule: RecrawlSchedule, name: str, frontier: Frontier) -> int:
+    """
+    Function to schedule the records of the frontier which are not scheduled yet, e.g. the ones scraped by the
+    one shot scripts. They count as checked when they were fetched.
+
+    :param name: key of run_all.SOURCES
+    :return: no of records added
+    """
+    date_column = SOURCE_COLUMNS[EXTRACTORS[name][1]]["date"]
+    done = {key: (url, saved_at) for key, url, saved_at in frontier.done()}
+    scheduled = set(schedule.keys(name))
+    return schedule.add(name, ((key, done[key][0], normalize_date(record.get(date_column)), fingerprint(record),
+                                done[key][1])
+                               for key, record in frontier.records() if key not in scheduled))
+
+
+def discover_sgs(schedule: RecrawlSchedule, stop_after: int = 30) -> int:
+    """
+    Function to walk the SGS listing newest first until `stop_after` scheduled records in a row, schedule the new
+    records and update the url of all of them, they move to later pages as new records are published.
+
+    :return: no of new records
+    """
+    name = "sgs_extended"
+    scheduled = set(schedule.keys(name))
+    new = []
+    known_in_a_row = 0
+    total = None
+    for offset, rows, total in listing_pages(SGS_LISTING_URL):
+        for rec_no in range(len(rows)):
+            url = sgs_scraper_v2.RECORD_URL.format(pg_no=offset, rec_no=rec_no)
+            key = sgs_record_key(url, total)
+            if key in scheduled:
+                known_in_a_row += 1
+                continue
+            known_in_a_row = 0
+            new.append((key, url, None, None, None))
+        if known_in_a_row >= stop_after:
+            break
+    if total:
+        schedule.update_urls(name, ((key, sgs_scraper_v2.record_url(key, total)) for key in scheduled))
+    return schedule.add(name, new)
+
+
+def discover_asean(schedule: RecrawlSchedule, rows: int = 100) -> int:
+    """
+    Function to schedule the products of the `rows` latest ASEAN alerts which are not scheduled yet, one request.
+
+    :return: no of new products
+    """
+    latest = next(asean_consumer_scraper.get_products_overview(max_products=rows, window=rows), [])
+    return schedule.add("asean", ((url, url, None, None, None)
+                                  for url in map(asean_consumer_scraper.get_product_url, latest)))
+
+
+DISCOVERERS = {"sgs_extended": discover_sgs, "asean": discover_asean}
+
+
+def sgs_total_records() -> int:
+    """
+    Function to read the no of records the SGS listing has now, the url of every record follows from it, see
+    sgs_scraper_v2.record_url.
+    """
+    soup = get_soup(SGS_LISTING_URL, LISTING_PAGE_TARGETS)
+    if not soup:
+        raise RuntimeError(f"unable to get {SGS_LISTING_URL}")
+    total = parse_total_record_count(soup, default=None)
+    if total is None:
+        raise RuntimeError(f"no record count on {SGS_LISTING_URL}")
+    return total
+
+
+def check(schedule: RecrawlSchedule, due: List[Tuple[float, str, str, str]], frontiers: Dict[str, Frontier],
+          store: RecordStore = None) -> Dict[str, Dict[str, int]]:
+    """
+    Function to fetch the due records again, save the new and changed ones to their frontier and the record store,
+    and update the schedule.
+
+    An SGS record moves to the next position whenever a record is published, so the url of the schedule may show
+    another record by now. The urls are built from the no of records read right before the pages are fetched, and
+    if it changed by the time they arrived the pages are dropped and the records stay due.
+
+    :param due: see RecrawlSchedule.due
+    :param frontiers: {source: its Frontier}
+    :param store: RecordStore the changed records are saved to, None to skip it
+    :return: {source: {"checked": .., "new": .., "changed": .., "failed": ..}}
+    """
+    counts = defaultdict(lambda: {"checked": 0, "new": 0, "changed": 0, "failed": 0})
+    by_source = defaultdict(dict)
+    for _, source, key, url in due:
+        by_source[source][url] = key
+
+    fetcher = get_fetcher()
+    for source, keys in by_source.items():
+        extractor, store_source = EXTRACTORS[source][:2]
+        date_column = SOURCE_COLUMNS[store_source]["date"]
+        try:
+            if source == "sgs_extended":
+                total = sgs_total_records()
+                keys = {sgs_scraper_v2.record_url(key, total): key for key in keys.values()}
+            responses = list(fetcher.map(keys, stop_after=PAGE_ENDS[source]))
+            if source == "sgs_extended" and sgs_total_records() != total:
+                print("SGS records were published during the checks, they are checked again next time..")
+                continue
+        except Exception as e:
+            print(f"{source}: unable to check the records..", e)
+            continue
+
+        for url, response in responses:
+            key = keys[url]
+            try:
+                if isinstance(response, Exception) or not response.ok:
+                    raise RuntimeError(f"unable to get 200 status, {response}")
+                record = extractor(response.content)
+            except Exception as e:
+                print("unable to check the record..", e, url)
+                schedule.checked(source, key)
+                counts[source]["failed"] += 1
+                continue
+
+            counts[source]["checked"] += 1
+            known = frontiers[source].get(key)
+            if record != known:
+                counts[source]["new" if known is None else "changed"] += 1
+                frontiers[source].mark_done(key, record, url)
+                if store:
+                    store.upsert(store_source, key, record)
+            schedule.checked(source, key, fingerprint(record), normalize_date(record.get(date_column)))
+    return dict(counts)
+
+
+def requests_sent() -> float:
+    metrics = get_metrics()
+    return metrics.counter("responses") + metrics.counter("request_errors")
+
+
+def run_daemon(names: List[str], requests_per_hour: float, schedule: RecrawlSchedule, tick: float = 60,
+               discover_every: float = 3600, export_every: float = 3600, duration: float = None):
+    """
+    Function to keep the records of the sources fresh with a fixed no of requests an hour. Every `tick` seconds
+    the requests the budget allows are spent on the records most likely to be stale. Every `discover_every`
+    seconds the latest records are looked up to schedule the new ones, those requests come out of the budget too,
+    as do the retries. The outputs, record store and Excel files are rebuilt every `export_every` seconds if a
+    record changed.
+
+    :param names: keys of run_all.SOURCES which are in EXTRACTORS
+    :param requests_per_hour: budget of requests
+    :param schedule: RecrawlSchedule
+    :param tick: seconds between two rounds of checks
+    :param discover_every: seconds between two lookups of the new records
+    :param export_every: seconds between two rebuilds of the outputs
+    :param duration: seconds after which the daemon stops, None to run until it is stopped with SIGINT/SIGTERM
+    """
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    frontiers = {name: Frontier(SOURCES[name][1]["frontier_filename"]) for name in names}
+    store_filename = next((SOURCES[name][1]["store_filename"] for name in names
+                           if SOURCES[name][1].get("store_filename")), None)
+    store = RecordStore(store_filename) if store_filename else None
+
+    started = last_tick = time.monotonic()
+    last_discovery = last_export = None
+    budget = 0
+    changed_since_export = set()
+    try:
+        while not stopped.is_set() and (duration is None or time.monotonic() - started < duration):
+            now = time.monotonic()
+            # at most one tick of unused budget is kept, a long pause does not end in a burst
+            budget = min(budget + requests_per_hour * (now - last_tick) / 3600, max(requests_per_hour * tick / 3600, 1))
+            last_tick = now
+            sent = requests_sent()
+
+            if last_discovery is None or now - last_discovery >= discover_every:
+                last_discovery = now
+                for name in names:
+                    try:
+                        added = seed(schedule, name, frontiers[name]) + DISCOVERERS[name](schedule)
+                        print(f"{name}: {added} new records scheduled")
+                    except Exception as e:
+                        print(f"{name}: unable to look up the new records..", e)
+                for source, source_report in schedule.report().items():
+                    print(source, source_report)
+
+            count = int(budget - (requests_sent() - sent))
+            if count > 0:
+                due = schedule.due(count, names)
+                for source, counts in check(schedule, due, frontiers, store).items():
+                    if counts["new"] or counts["changed"]:
+                        changed_since_export.add(source)
+                    print(f"{source}: {counts['checked']} records checked, {counts['new']} new, "
+                          f"{counts['changed']} changed, {counts['failed']} failed")
+            budget -= requests_sent() - sent
+
+            if changed_since_export and (last_export is None or now - last_export >= export_every):
+                last_export = now
+                for name in sorted(changed_since_export):
+                    rebuild_outputs(name, frontiers[name])
+                changed_since_export.clear()
+            stopped.wait(tick)
+    except KeyboardInterrupt:
+        print("Received Keyboard interrupt, stopping the daemon..")
+    finally:
+        for name in sorted(changed_since_export):
+            rebuild_outputs(name, frontiers[name])
+        for source, source_report in schedule.report().items():
+            print(source, source_report)
+        for frontier in frontiers.values():
+            frontier.close()
+        if store:
+            store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="keep the records fresh with a fixed budget of requests")
+    parser.add_argument("--source", nargs="+", choices=sorted(EXTRACTORS), default=sorted(EXTRACTORS))
+    parser.add_argument("--requests-per-hour", type=float, default=300)
+    parser.add_argument("--schedule", default="data/recrawl.sqlite", help="sqlite file of the schedule")
+    parser.add_argument("--tick", type=float, default=60, help="seconds between two rounds of checks")
+    parser.add_argument("--discover-every", type=float, default=3600,
+                        help="seconds between two lookups of the new records")
+    parser.add_argument("--export-every", type=float, default=3600,
+                        help="seconds between two rebuilds of the outputs")
+    parser.add_argument("--duration", type=float, help="seconds after which the daemon stops, e.g. from cron")
+    parser.add_argument("--http-cache", default="data/http_cache.sqlite", help="sqlite file of the http cache")
+    parser.add_argument("--archive", default="data/archive",
+                        help="directory of the raw copy of the pages for reextract.py, empty to skip it")
+    args = parser.parse_args()
+
+    configure_fetcher(cache=ResponseCache(args.http_cache),
+                      archive=ResponseArchive(args.archive) if args.archive else None)
+    recrawl_schedule = RecrawlSchedule(args.schedule)
+    try:
+        run_daemon(args.source, args.requests_per_hour, recrawl_schedule, args.tick, args.discover_every,
+                   args.export_every, args.duration)
+    finally:
+        recrawl_schedule.close()
+        get_fetcher().limiter.print_report()
+        get_metrics().print_report()
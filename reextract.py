@@ -0,0 +1,141 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable, List, Tuple, Union
+
+import asean_consumer_scraper
+import sgs_scraper_v2
+from archive import ResponseArchive, read_entry
+from frontier import Frontier
+from record_store import update_store
+from run_all import SOURCES
+from utils import clean_df, convert_to_date
+from writers import open_record_writer
+
+# source of run_all.py: (extractor of its pages, its name in the record store, validate_func of its output,
+# its output is newest first, the element its pages are read until, see Fetcher.fetch's stop_after)
+EXTRACTORS = {
+    "sgs_extended": (sgs_scraper_v2.extract_record, "sgs", convert_to_date, True, sgs_scraper_v2.RECORD_PAGE_END),
+    "asean": (asean_consumer_scraper.extract_product, "asean", clean_df, False,
+              asean_consumer_scraper.PRODUCT_PAGE_END),
+}
+
+# error of extract_batch for a page cut off before what the extractor reads
+TRUNCATED = "truncated"
+
+
+def extract_batch(extractor: Callable[[bytes], dict], page_end: tuple,
+                  entries: List[Tuple[str, Tuple[str, int, int]]]) -> List[Tuple[str, Union[dict, None], str]]:
+    """
+    Function to extract the records of a batch of archived pages, runs in the processes of the pool. Each process
+    reads the pages from the segments itself, only the offsets and the records are sent between the processes.
+
+    A page whose download was stopped after another element than `page_end` is not extracted, it may end before
+    what the current extractor reads.
+
+    :param extractor: function extracting the record from the page content, e.g. sgs_scraper_v2.extract_record
+    :param page_end: stop_after of the scraper of the extractor, e.g. sgs_scraper_v2.RECORD_PAGE_END
+    :param entries: list of (key, (segment file, offset, length))
+    :return: list of (key, record, error), the record is None if the extraction failed and the error is TRUNCATED
+        if the page was cut off too early
+    """
+    results = []
+    for key, entry in entries:
+        try:
+            response = read_entry(*entry)
+            if response.truncated and response.stop_after != tuple(page_end):
+                results.append((key, None, TRUNCATED))
+                continue
+            results.append((key, extractor(response.content), None))
+        except Exception as e:
+            results.append((key, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def rebuild_outputs(name: str, frontier: Frontier):
+    """
+    Function to write the output file of the source again from its frontier and update its record store and
+    Excel file.
+
+    :param name: key of EXTRACTORS
+    :param frontier: Frontier of the source
+    """
+    _, store_source, validate_func, newest_first, _ = EXTRACTORS[name]
+    options = SOURCES[name][1]
+    with open_record_writer(options["output_filename"], validate_func=validate_func) as writer:
+        writer.write_many(record for _, record in frontier.records(newest_first=newest_first))
+    print(f"{writer.count} records saved to {options['output_filename']}")
+    if options.get("store_filename"):
+        update_store(options["store_filename"], store_source, frontier.records(), options.get("export_excel_filename"))
+
+
+def reextract(name: str, archive: ResponseArchive, workers: int = None, batch_size: int = 64) -> int:
+    """
+    Function to extract the records of a source again from the archived pages with the current extractor, and
+    rebuild its output, record store and Excel file. No request is sent, a record whose page was not archived, or
+    was cut off before what the extractor reads, see extract_batch, is kept as it is.
+
+    Every record is extracted from the page it was saved from: the latest response of its url archived until the
+    record was saved, so an SGS record gets its own page even if its url has shown another record since.
+
+    :param name: key of EXTRACTORS
+    :param archive: ResponseArchive the crawls saved the pages to
+    :param workers: no of processes, defaults to the no of cpus
+    :param batch_size: no of pages sent to a process at a time
+    :return: no of records which changed
+    """
+    extractor, page_end = EXTRACTORS[name][0], EXTRACTORS[name][4]
+    frontier = Frontier(SOURCES[name][1]["frontier_filename"])
+    started = time.monotonic()
+
+    entries, missing = [], 0
+    for key, url, saved_at in frontier.done():
+        entry = archive.lookup(url, saved_at)
+        if entry:
+            entries.append((key, entry))
+        else:
+            missing += 1
+    print(f"{name}: extracting {len(entries)} records again, {missing} records have no archived page..")
+
+    changed = failed = truncated = 0
+    batches = [entries[i:i + batch_size] for i in range(0, len(entries), batch_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results in executor.map(partial(extract_batch, extractor, page_end), batches):
+            updates = []
+            for key, record, error in results:
+                if error == TRUNCATED:
+                    truncated += 1
+                elif error:
+                    print("unable to extract the record again..", error, key)
+                    failed += 1
+                elif record != frontier.get(key):
+                    updates.append((key, record))
+            frontier.replace_records(updates)
+            changed += len(updates)
+    print(f"{name}: {changed} records changed, {failed} failed and were kept as they were "
+          f"({time.monotonic() - started:.1f}s)")
+    if truncated:
+        print(f"{name}: {truncated} archived pages were cut off before {page_end}, their records were kept as they "
+              f"were until the pages are fetched again, e.g. by recrawl.py")
+
+    try:
+        rebuild_outputs(name, frontier)
+    finally:
+        frontier.close()
+    return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extract the records again from the archived pages, offline")
+    parser.add_argument("--source", nargs="+", choices=sorted(EXTRACTORS), default=sorted(EXTRACTORS))
+    parser.add_argument("--archive", default="data/archive", help="directory of the archived pages")
+    parser.add_argument("--workers", type=int, help="no of processes, defaults to the no of cpus")
+    args = parser.parse_args()
+
+    response_archive = ResponseArchive(args.archive)
+    try:
+        for source in args.source:
+            reextract(source, response_archive, args.workers)
+    finally:
+        response_archive.close()
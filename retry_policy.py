@@ -0,0 +1,182 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Union
+
+import aiohttp
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending the request while the circuit breaker of the host is open.
+    """
+
+
+class HttpStatusError(Exception):
+    """
+    Raised by the scrapers when a page came back with an error status, so RetryPolicy.is_retryable can tell a 503
+    worth another attempt from a 404.
+    """
+
+    def __init__(self, status: int, url: str):
+        super().__init__(f"unable to get 200 status from url.. {status} {url}")
+        self.status = status
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a single host. After `failure_threshold` failures in a row the circuit opens and requests
+    fail right away without reaching the server. After `reset_timeout` seconds a single trial request is let
+    through, the circuit closes again if it succeeds and stays open for another `reset_timeout` if it fails.
+
+    :param failure_threshold: no of failures in a row which open the circuit
+    :param reset_timeout: seconds the circuit stays open before a trial request
+    """
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def open_for(self) -> float:
+        """
+        Seconds until the next trial request is let through, 0 if the circuit is closed.
+        """
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def check(self, host: str):
+        """
+        Function to raise CircuitOpenError if no request should be sent to the host now.
+        """
+        if self.opened_at is None:
+            return
+        if self.open_for > 0 or self.trial_in_flight:
+            raise CircuitOpenError(f"circuit of {host} is open, not sending the request")
+        self.trial_in_flight = True
+
+    def abandon(self):
+        """
+        Function to give up a trial request without an outcome, e.g. when it was cancelled.
+        """
+        self.trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+
+class RetryPolicy:
+    """
+    Shared retry policy of the fetcher. Failed requests are retried with exponential backoff and full jitter, a
+    Retry-After sent by the server is waited out, and every host has a circuit breaker so an outage is not
+    hammered with retries.
+
+    :param max_attempts: no of attempts per request, the first one included
+    :param base_delay: backoff of the first retry in seconds, doubled on every attempt
+    :param max_delay: max backoff in seconds
+    :param retry_statuses: http status codes which are retried
+    :param breaker_statuses: http status codes which count as failures for the circuit breaker
+    :param failure_threshold: see CircuitBreaker
+    :param reset_timeout: see CircuitBreaker
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 60,
+                 retry_statuses=(429, 500, 502, 503, 504), breaker_statuses=(500, 502, 503, 504),
+                 failure_threshold: int = 10, reset_timeout: float = 30):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = set(retry_statuses)
+        self.breaker_statuses = set(breaker_statuses)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self.breakers[host]
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """
+        Function to get the seconds to wait before the next attempt.
+
+        :param attempt: no of attempts which failed so far, starting at 1
+        :param retry_after: seconds the server asked us to wait
+        :return: seconds
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        return max(backoff, retry_after or 0.0)
+
+    def is_retryable(self, error: Union[int, Exception]) -> bool:
+        """
+        Function to check if a status code or an exception of the request is worth another attempt.
+        """
+        if isinstance(error, int):
+            return error in self.retry_statuses
+        if isinstance(error, HttpStatusError):
+            return error.status in self.retry_statuses
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError))
+
+    def open_for(self) -> float:
+        """
+        Seconds until all the open circuits let a trial request through.
+        """
+        return max((breaker.open_for for breaker in self.breakers.values()), default=0.0)
+
+
+def retry_failed(frontier, scrape: Callable, write: Callable, retry: RetryPolicy, rounds: int = 3,
+                 max_workers: int = 16, wait: float = 5, max_attempts: int = 5) -> int:
+    """
+    Function to drain the retry queue at the end of the run, i.e. scrape the failed urls of the frontier again.
+    Only the transient failures are retried, see Frontier.retryable: a 404 or a page the extractor can't read
+    fails the same way every time. Before every round it waits for the backoff, doubled every round, and for the
+    open circuits to let requests through again.
+
+    :param frontier: Frontier of the run
+    :param scrape: function(url) which returns the record, None if the page could not be fetched, or raises e.g.
+        HttpStatusError
+    :param write: function(record) called with every record scraped, e.g. writer.write
+    :param retry: RetryPolicy of the fetcher, for its circuit breakers and to tell the transient errors
+    :param rounds: max no of times the failed urls are retried
+    :param max_workers: no of urls scraped at the same time
+    :param wait: seconds to wait before the first round
+    :param max_attempts: urls which failed this many times, over all the runs, are not retried any more
+    :return: no of urls still failed
+    """
+    for round_no in range(rounds):
+        failed = frontier.retryable(max_attempts)
+        if not failed:
+            break
+        delay = max(wait * 2 ** round_no, retry.open_for())
+        print(f"retrying {len(failed)} failed urls in {delay:.0f} seconds..")
+        time.sleep(delay)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(scrape, url): key for key, url, _ in failed}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    frontier.mark_failed(key, str(e), retry.is_retryable(e))
+                    continue
+                if not isinstance(record, dict):
+                    frontier.mark_failed(key, "unable to get the page")
+                    continue
+                frontier.mark_done(key, record)
+                write(record)
+    return len(frontier.failed())
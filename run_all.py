@@ -0,0 +1,121 @@
+import argparse
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+
+import asean_consumer_scraper
+import sgs_scraper
+import sgs_scraper_v2
+from archive import ResponseArchive
+from fetcher import get_fetcher, configure_fetcher
+from frontier import Frontier
+from http_cache import ResponseCache
+from metrics import get_metrics
+
+# source: (function scraping it, its keyword arguments)
+SOURCES = {
+    "sgs": (sgs_scraper.run, {
+        "first_url": "https://campaigns.sgs.com/en/vr/product-recalls-light",
+        "output_filename": "data/sgs_data.jsonl",
+        "frontier_filename": "data/sgs_data_frontier.sqlite",
+        "export_excel_filename": "data/sgs_data.xlsx",
+    }),
+    "sgs_extended": (sgs_scraper_v2.run, {
+        "output_filename": "data/sgs_data_extended.jsonl",
+        "frontier_filename": "data/sgs_data_extended_frontier.sqlite",
+        "export_excel_filename": "data/sgs_data_extended.xlsx",
+        "assets_directory": None,     # e.g. "data/assets" to download the product images too
+        "store_filename": "data/records.sqlite",
+    }),
+    "asean": (asean_consumer_scraper.run, {
+        "output_filename": "data/asean_consumers.jsonl",
+        "frontier_filename": "data/asean_consumers_frontier.sqlite",
+        "export_excel_filename": "data/asean_consumers.xlsx",
+        "store_filename": "data/records.sqlite",
+    }),
+}
+
+
+def run_source(name: str) -> int:
+    """
+    Function to scrape a source. The urls still failed on a transient error after the retries of the run fail the
+    source too, its output is incomplete. The ones which fail for good, e.g. a 404, are only reported, they would
+    fail every run.
+
+    :param name: key of SOURCES
+    :return: no of records saved
+    :raises RuntimeError: if urls of the source are still failed on a transient error
+    """
+    run, options = SOURCES[name]
+    print(f"{name}: started..")
+    count = run(**options)
+    print(f"{name}: {count} records saved")
+
+    frontier = Frontier(options["frontier_filename"])
+    try:
+        failed, retryable = len(frontier.failed()), len(frontier.retryable())
+    finally:
+        frontier.close()
+    if failed > retryable:
+        print(f"{name}: {failed - retryable} urls failed for good, e.g. a 404, see {options['frontier_filename']}")
+    if retryable:
+        raise RuntimeError(f"{retryable} urls are still failed, see {options['frontier_filename']}")
+    return count
+
+
+def run_sources(names: List[str]) -> Dict[str, Union[int, Exception]]:
+    """
+    Function to scrape the sources at the same time. They all use the process wide fetcher, so they share its
+    connection pool and its request budget, which is split fairly between the hosts.
+
+    :param names: keys of SOURCES
+    :return: {name: no of records saved or the Exception which stopped the source}
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        futures = {name: executor.submit(run_source, name) for name in names}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print(f"{name}: failed, {e}")
+                results[name] = e
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scrape all the sources at the same time, e.g. from cron")
+    parser.add_argument("--source", nargs="+", choices=sorted(SOURCES), default=sorted(SOURCES))
+    parser.add_argument("--budget", type=int, help="max no of requests in flight across all the sources")
+    parser.add_argument("--http-cache", default="data/http_cache.sqlite", help="sqlite file of the http cache")
+    parser.add_argument("--archive", default="data/archive",
+                        help="directory of the raw copy of the pages for reextract.py, empty to skip it")
+    parser.add_argument("--metrics-file", default="data/run_all_metrics.json")
+    parser.add_argument("--metrics-port", type=int, help="e.g. 9100 to serve the metrics during the run")
+    args = parser.parse_args()
+
+    options = {"cache": ResponseCache(args.http_cache)}
+    if args.archive:
+        options["archive"] = ResponseArchive(args.archive)
+    if args.budget:
+        options["max_concurrency"] = args.budget
+    configure_fetcher(**options)
+
+    metrics = get_metrics()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    metrics.start_progress()
+    try:
+        results = run_sources(args.source)
+    finally:
+        metrics.stop_progress()
+        get_fetcher().limiter.print_report()
+        get_fetcher().cache.print_report()
+        if get_fetcher().archive:
+            get_fetcher().archive.print_report()
+        metrics.print_report()
+        metrics.dump(args.metrics_file)
+
+    # a non zero exit code tells cron that a source failed
+    if any(isinstance(result, Exception) for result in results.values()):
+        sys.exit(1)
@@ -0,0 +1,150 @@
+from typing import Callable, Iterator, List, Tuple
+
+from archive import ResponseArchive
+from fetcher import get_fetcher, configure_fetcher
+from fingerprints import FingerprintIndex, fingerprint, NEW, UNCHANGED, UPDATED
+from frontier import Frontier
+from metrics import get_metrics
+from record_store import update_store
+from sgs_scraper import get_page_rows, get_next_page_url, predict_page_urls, same_url
+from sgs_scraper_v2 import RECORD_URL, RECORD_PAGE_END, extract_record
+from utils import get_soup, parse_html, parse_total_record_count, sgs_record_key, convert_to_date, LISTING_PAGE_TARGETS
+from writers import open_record_writer, convert_to_excel
+
+
+def listing_pages(first_url: str, window: int = 10) -> Iterator[Tuple[int, list, int]]:
+    """
+    Function to walk the SGS listing newest first. The pages are fetched `window` at a time, so stopping early
+    only wastes the rest of a window.
+
+    :param first_url: url of the first listing page
+    :param window: no of pages fetched concurrently
+    :return: iterator of (offset of the page, rows of the page, total no of records)
+    """
+    soup = get_soup(first_url, LISTING_PAGE_TARGETS)
+    if not soup:
+        raise RuntimeError(f"unable to get {first_url}")
+    rows = get_page_rows(soup)
+    total = parse_total_record_count(soup)
+    yield 0, rows, total
+
+    next_page_url = get_next_page_url(first_url, soup)
+    if not next_page_url:
+        return
+    page_size = len(rows)
+    page_urls = predict_page_urls(next_page_url, page_size, total)
+
+    if not page_urls or not same_url(page_urls[0], next_page_url):
+        print("Unable to work out the page urls, following the next links..")
+        offset = 0
+        while next_page_url:
+            soup = get_soup(next_page_url, LISTING_PAGE_TARGETS)
+            if not soup:
+                raise RuntimeError(f"unable to get {next_page_url}")
+            offset += page_size
+            yield offset, get_page_rows(soup), total
+            next_page_url = get_next_page_url(next_page_url, soup)
+        return
+
+    for start in range(0, len(page_urls), window):
+        urls = page_urls[start:start + window]
+        pages = dict(get_fetcher().map(urls))
+        for page_no, url in enumerate(urls, start + 1):
+            response = pages[url]
+            if isinstance(response, Exception) or not response.ok:
+                raise RuntimeError(f"unable to get {url}, {response}")
+            yield page_no * page_size, get_page_rows(parse_html(response.content, LISTING_PAGE_TARGETS)), total
+
+
+def find_changes(first_url: str, index: FingerprintIndex, stop_after: int = 30,
+                 known: Callable[[str], bool] = None) -> List[Tuple[str, str, str, str]]:
+    """
+    Function to compare the listing with the fingerprint index, newest record first, until `stop_after` records in
+    a row are unchanged. Everything older is assumed unchanged too.
+
+    :param first_url: url of the first listing page
+    :param index: FingerprintIndex of the previous syncs
+    :param stop_after: no of unchanged records in a row which end the walk
+    :param known: function(key) which tells if a record the index does not have was scraped already, e.g.
+        Frontier.is_done. Such a record is taken as unchanged and its fingerprint is saved, so the first sync after
+        a full crawl only fetches the records published since
+    :return: list of (NEW or UPDATED, key, record page url, content hash)
+    """
+    changes = []
+    unchanged_in_a_row = 0
+    for offset, rows, total in listing_pages(first_url):
+        for rec_no, row in enumerate(rows):
+            url = RECORD_URL.format(pg_no=offset, rec_no=rec_no)
+            key = sgs_record_key(url, total)
+            content_hash = fingerprint(row)
+            status = index.classify(key, content_hash)
+            if status == NEW and known and known(key):
+                index.update(key, url, content_hash)
+                status = UNCHANGED
+            if status == UNCHANGED:
+                unchanged_in_a_row += 1
+                if unchanged_in_a_row >= stop_after:
+                    return changes
+                continue
+            unchanged_in_a_row = 0
+            changes.append((status, key, url, content_hash))
+    return changes
+
+
+if __name__ == "__main__":
+    PRODUCT_RECALLS_URL = "https://campaigns.sgs.com/en/vr/product-recalls-light"
+    STOP_AFTER = 30     # no of unchanged records in a row after which the rest of the listing is not checked
+    FINGERPRINTS_FILENAME = "data/sgs_fingerprints.sqlite"
+    FRONTIER_FILENAME = "data/sgs_data_extended_frontier.sqlite"     # the records of sgs_scraper_v2.py
+    OUTPUT_FILENAME = "data/sgs_data_extended.jsonl"     # .jsonl, .csv or .parquet
+    EXPORT_EXCEL_FILENAME = "data/sgs_data_extended.xlsx"     # set None to skip the Excel conversion
+    CHANGES_FILENAME = "data/sgs_changes.jsonl"     # the new and updated records of this sync
+    STORE_FILENAME = "data/records.sqlite"     # set None to export the Excel file from the output file
+    ARCHIVE_DIRECTORY = "data/archive"     # raw copy of the pages for reextract.py, set None to skip it
+    if ARCHIVE_DIRECTORY:
+        configure_fetcher(archive=ResponseArchive(ARCHIVE_DIRECTORY))
+
+    # the records scraped by sgs_scraper_v2.py are known too, the first sync stops at them like the next ones
+    index = FingerprintIndex(FINGERPRINTS_FILENAME)
+    frontier = Frontier(FRONTIER_FILENAME)
+    print(f"{len(index)} records known, looking for changes..")
+    changes = find_changes(PRODUCT_RECALLS_URL, index, STOP_AFTER, frontier.is_done)
+    print(f"{sum(status == NEW for status, *_ in changes)} new and "
+          f"{sum(status == UPDATED for status, *_ in changes)} updated records found..")
+
+    changed = {url: (status, key, content_hash) for status, key, url, content_hash in changes}
+    failed = 0
+    with open_record_writer(CHANGES_FILENAME, validate_func=convert_to_date) as changes_writer:
+        for url, response in get_fetcher().map(changed, stop_after=RECORD_PAGE_END):
+            status, key, content_hash = changed[url]
+            if isinstance(response, Exception) or not response.ok:
+                print("unable to get 200 status from url..", response, url)
+                failed += 1
+                continue
+            try:
+                record = extract_record(response.content)
+            except Exception as e:
+                print("unable to extract the product data..", e, url)
+                failed += 1
+                continue
+            frontier.mark_done(key, record, url)
+            # only saved once the record is, a failed page shows up as a change again on the next sync
+            index.update(key, url, content_hash)
+            if status == UPDATED:
+                print(f"updated: {record.get('Product Name')} ({url})")
+            changes_writer.write({"change": status, **record})
+    if failed:
+        print(f"{failed} changed records could not be fetched, they will be tried on the next sync")
+    print(f"{changes_writer.count} changes saved to {CHANGES_FILENAME}")
+
+    # the output is rebuilt from all the records scraped so far, newest first
+    with open_record_writer(OUTPUT_FILENAME, validate_func=convert_to_date) as writer:
+        writer.write_many(record for _, record in frontier.records(newest_first=True))
+    print(f"{writer.count} records saved to {OUTPUT_FILENAME}")
+    if STORE_FILENAME:
+        update_store(STORE_FILENAME, "sgs", frontier.records(), EXPORT_EXCEL_FILENAME)
+    elif EXPORT_EXCEL_FILENAME and writer.count:
+        convert_to_excel(OUTPUT_FILENAME, EXPORT_EXCEL_FILENAME, ["Publication Date"])
+        print(f"Data exported to {EXPORT_EXCEL_FILENAME}")
+    get_fetcher().limiter.print_report()
+    get_metrics().print_report()
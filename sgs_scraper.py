@@ -1,44 +1,233 @@
-from time import sleep
-from utils import (extract_table_data, export_to_excel, prepare_url, get_soup, convert_to_date,)
+import re
+import time
+from typing import Union
+from urllib.parse import parse_qsl, urlsplit
+from bs4 import BeautifulSoup
+from fetcher import get_fetcher
+from frontier import Frontier
+from metrics import get_metrics
+from utils import (extract_table_data, prepare_url, get_soup, convert_to_date, parse_html,
+                   parse_total_record_count, LISTING_PAGE_TARGETS,)
+from writers import RecordWriter, open_record_writer, convert_to_excel
 
 
-if __name__ == "__main__":
-    PRODUCT_RECALLS_URL = "https://campaigns.sgs.com/en/vr/product-recalls-light"
-    SLEEP_TIME = 0     # in seconds
-    EXPORT_EXCEL_FILENAME = "data/sgs_data.xlsx"
+def get_page_rows(soup: BeautifulSoup) -> list:
+    table_soup = soup.find("table", class_="table table--simple table--narrow")
+    return extract_table_data(table_soup)
 
-    current_url = PRODUCT_RECALLS_URL
-    master_data = []
 
-    try:
-        while True:
-            print(f"processing {current_url}")
-            soup = get_soup(current_url)
+def get_next_page_url(baseurl: str, soup: BeautifulSoup) -> Union[str, None]:
+    next_page = soup.find("li", class_="next")
+    if not next_page:
+        return
+    return prepare_url(baseurl, next_page.a.attrs.get("href"))
+
+
+def same_url(url: str, other_url: str) -> bool:
+    """
+    Function to compare two urls ignoring the order of query parameters.
+    """
+    url, other_url = urlsplit(url), urlsplit(other_url)
+    return (url.netloc, url.path) == (other_url.netloc, other_url.path) and \
+        sorted(parse_qsl(url.query, keep_blank_values=True)) == \
+        sorted(parse_qsl(other_url.query, keep_blank_values=True))
+
+
+def predict_page_urls(next_page_url: str, page_size: int, total_records: int) -> Union[list, None]:
+    """
+    Function to work out the url of every listing page from the link to the second page. The offset parameter is
+    the one whose value equals the no of rows on the first page, e.g. "?p=10" -> "?p=20", "?p=30"...
+
+    :param next_page_url: absolute url of the second page
+    :param page_size: no of rows on the first page
+    :param total_records: total no of records in the listing
+    :return: list of urls from the second page to the last one, None if the offset parameter is not found
+    """
+    url = urlsplit(next_page_url)
+    for key, value in parse_qsl(url.query, keep_blank_values=True):
+        if value == str(page_size):
+            break
+    else:
+        return
+
+    pattern = re.compile(rf"(^|&){re.escape(key)}={page_size}(?=&|$)")
+    return [url._replace(query=pattern.sub(rf"\g<1>{key}={offset}", url.query, count=1)).geturl()
+            for offset in range(page_size, total_records, page_size)]
+
+
+def scrape_listing_page(url: str, soup: BeautifulSoup, frontier: Frontier) -> dict:
+    """
+    Function to extract the rows and the next link of a listing page and save them in the frontier.
+
+    :return: dict {"rows": [{}, {}], "next": url or None}
+    """
+    with get_metrics().timer("extract"):
+        page = {"rows": get_page_rows(soup), "next": get_next_page_url(url, soup)}
+        if soup.find("div", class_="grid grid--2"):
+            page["total"] = parse_total_record_count(soup)
+    frontier.mark_done(url, page)
+    return page
+
+
+def follow_next_links(current_url: str, writer: RecordWriter, frontier: Frontier):
+    """
+    Function to scrape the listing one page at a time by following the "next" link until the last page. Pages
+    already in the frontier are not fetched again. A page which can't be fetched is tried again with backoff, if
+    it still fails the scraping stops and the next run continues from that page.
+
+    :param current_url: url of the first page to scrape
+    :param writer: RecordWriter to which the rows are added
+    :param frontier: Frontier of the listing pages
+    """
+    retry = get_fetcher().retry
+    attempt = 0
+    while True:
+        page = frontier.get(current_url)
+        if not page:
+            soup = get_soup(current_url, LISTING_PAGE_TARGETS)
 
             if not soup:
+                attempt += 1
+                if attempt >= retry.max_attempts:
+                    raise RuntimeError(f"unable to get {current_url}, run the scraper again to continue from there")
+                # the fetcher already retried the request, the backoff goes on from where it stopped. wait for the
+                # circuit of the site to close too, so an outage is not hammered
+                delay = max(retry.delay(retry.max_attempts + attempt), retry.open_for())
+                print(f"unable to get {current_url}, retrying in {delay:.1f} seconds..")
+                get_metrics().increment("retries", labels={"reason": "listing_page"})
+                time.sleep(delay)
                 continue
 
-            table_soup = soup.find("table", class_="table table--simple table--narrow")
-            data = extract_table_data(table_soup)
-            master_data.extend(data)
+            page = scrape_listing_page(current_url, soup, frontier)
+        attempt = 0
+
+        writer.write_many(page["rows"])
+
+        if not page["next"]:
+            print("Scrapped all the urls")
+            break
+
+        current_url = page["next"]
+
 
-            next_page = soup.find("li", class_="next")
+def fetch_pages_in_parallel(first_url: str, writer: RecordWriter, frontier: Frontier):
+    """
+    Function to scrape the listing by working out all the page urls from the first page and fetching them
+    concurrently. From the first page that failed or does not link to the url predicted for the page after it,
+    the rest of the listing is scraped by following the "next" links. Pages already in the frontier are not
+    fetched again.
 
-            if not next_page:
-                print("Scrapped all the urls")
+    :param first_url: url of the first page
+    :param writer: RecordWriter to which the rows are added
+    :param frontier: Frontier of the listing pages
+    """
+    page = frontier.get(first_url)
+    if not page:
+        print(f"processing {first_url}")
+        soup = get_soup(first_url, LISTING_PAGE_TARGETS)
+        if not soup:
+            return follow_next_links(first_url, writer, frontier)
+        page = scrape_listing_page(first_url, soup, frontier)
+
+    writer.write_many(page["rows"])
+    next_page_url = page["next"]
+    if not next_page_url:
+        print("Scrapped all the urls")
+        return
+
+    page_urls = predict_page_urls(next_page_url, len(page["rows"]), page.get("total", 0))
+    if not page_urls or not same_url(page_urls[0], next_page_url):
+        print("Unable to work out the page urls, following the next links..")
+        return follow_next_links(next_page_url, writer, frontier)
+
+    pages = {url: frontier.get(url) for url in page_urls}
+    missing_urls = [url for url in page_urls if not pages[url]]
+    print(f"fetching {len(missing_urls)} pages concurrently..")
+    for url, response in get_fetcher().map(missing_urls):
+        if isinstance(response, Exception) or not response.ok:
+            print("unable to get 200 status from url..", response, url)
+            continue
+        pages[url] = scrape_listing_page(url, parse_html(response.content, LISTING_PAGE_TARGETS), frontier)
+
+    # walk the pages in order, everything after the first page we can't trust is scraped from the "next" links
+    for index, url in enumerate(page_urls):
+        if not pages[url]:
+            return follow_next_links(url, writer, frontier)
+
+        writer.write_many(pages[url]["rows"])
+
+        actual_next_url = pages[url]["next"]
+        expected_next_url = page_urls[index + 1] if index + 1 < len(page_urls) else None
+        if actual_next_url is None and expected_next_url is None:
+            break
+        if actual_next_url is None or expected_next_url is None or not same_url(actual_next_url,
+                                                                                 expected_next_url):
+            print(f"{url} does not link to the predicted next page, following the next links..")
+            if not actual_next_url:
                 break
+            return follow_next_links(actual_next_url, writer, frontier)
+
+    print("Scrapped all the urls")
+
+
+def run(first_url: str, output_filename: str, frontier_filename: str, export_excel_filename: str = None,
+        parallel_pagination: bool = True) -> int:
+    """
+    Function to scrape the whole listing into `output_filename`.
 
-            next_page_url = prepare_url(PRODUCT_RECALLS_URL, next_page.a.attrs.get("href"))
-            current_url = next_page_url
-            sleep(SLEEP_TIME)
+    :param first_url: url of the first listing page
+    :param output_filename: .jsonl, .csv or .parquet file of the rows
+    :param frontier_filename: sqlite file which keeps the pages scraped before a crash until the listing is done
+    :param export_excel_filename: Excel copy of the output, None to skip it
+    :param parallel_pagination: False to follow the "next" links one page at a time
+    :return: no of rows saved
+    """
+    # pages scraped before a crash are kept here until the whole listing is exported
+    frontier = Frontier(frontier_filename)
+    writer = open_record_writer(output_filename, validate_func=convert_to_date)
+    completed = False
+
+    try:
+        if parallel_pagination:
+            fetch_pages_in_parallel(first_url, writer, frontier)
+        else:
+            follow_next_links(first_url, writer, frontier)
+        completed = True
 
     except KeyboardInterrupt:
         print("Received Keyboard interrupt, stopping the scrapper..")
 
-    except Exception as e:
-        print(e)
+    finally:
+        writer.close()
+        print(f"{writer.count} rows saved to {output_filename}")
+        if export_excel_filename and writer.count:
+            convert_to_excel(output_filename, export_excel_filename, ["Publication Date"])
+            print(f"Data exported to {export_excel_filename}")
+
+        # the rows move between the pages as new records are published, the next run must start over
+        if completed:
+            frontier.clear()
+        frontier.close()
+    return writer.count
+
 
+if __name__ == "__main__":
+    PRODUCT_RECALLS_URL = "https://campaigns.sgs.com/en/vr/product-recalls-light"
+    PARALLEL_PAGINATION = True     # set False to follow the "next" links one page at a time
+    OUTPUT_FILENAME = "data/sgs_data.jsonl"     # .jsonl, .csv or .parquet
+    EXPORT_EXCEL_FILENAME = "data/sgs_data.xlsx"     # set None to skip the Excel conversion
+    FRONTIER_FILENAME = "data/sgs_data_frontier.sqlite"
+    METRICS_FILENAME = "data/sgs_data_metrics.json"
+    METRICS_PORT = None     # e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics during the run
+
+    metrics = get_metrics()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    metrics.start_progress()
+    try:
+        run(PRODUCT_RECALLS_URL, OUTPUT_FILENAME, FRONTIER_FILENAME, EXPORT_EXCEL_FILENAME, PARALLEL_PAGINATION)
     finally:
-        # Export the master data to excel
-        export_to_excel(master_data, EXPORT_EXCEL_FILENAME, convert_to_date)
-        print(f"Data exported to {EXPORT_EXCEL_FILENAME}")
+        metrics.stop_progress()
+        get_fetcher().limiter.print_report()
+        metrics.print_report()
+        metrics.dump(METRICS_FILENAME)
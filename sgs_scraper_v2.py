@@ -1,5 +1,21 @@
+from typing import Union
 from bs4 import BeautifulSoup
-from utils import (export_to_excel, get_soup, convert_to_date,)
+from archive import ResponseArchive
+from assets import AssetStore, AssetWriter
+from fetcher import get_fetcher, configure_fetcher
+from frontier import Frontier
+from http_cache import ResponseCache
+from metrics import get_metrics
+from record_store import update_store
+from retry_policy import HttpStatusError, retry_failed
+from utils import (get_soup, convert_to_date, parse_html, parse_total_record_count, sgs_record_key,
+                   LISTING_PAGE_TARGETS,)
+from writers import open_record_writer, convert_to_excel
+
+
+# record page of the listing, p is the offset of the listing page and rec the row on it
+RECORD_URL = "https://campaigns.sgs.com/en/vr/product-recalls-light/record?p={pg_no}" \
+             "&d=0&id=18CD45C15541&dc=http&lb=&rec={rec_no}"
 
 
 def product_link_generator(end: int = 100) -> list:
@@ -9,14 +25,31 @@ def product_link_generator(end: int = 100) -> list:
     :param end: No of products. default is 100
     :return: list
     """
-    base_url = "https://campaigns.sgs.com/en/vr/product-recalls-light/record?p={pg_no}" \
-               "&d=0&id=18CD45C15541&dc=http&lb=&rec={rec_no}"
-
     links = []
-    for i in range(10, end, 10):
+    for i in range(0, end, 10):
         for rec in range(10):
-            links.append(base_url.format(pg_no=i, rec_no=rec))
-    return links
+            links.append(RECORD_URL.format(pg_no=i, rec_no=rec))
+    return links[:end]
+
+
+def record_url(key: str, total_records: int, page_size: int = 10) -> str:
+    """
+    Function to get the current url of the SGS record page of a key, the inverse of utils.sgs_record_key.
+
+    :param key: see utils.sgs_record_key
+    :param total_records: total no of records the site has now
+    :param page_size: no of records on a listing page
+    :return: str
+    """
+    position = total_records - 1 - int(key)
+    return RECORD_URL.format(pg_no=position - position % page_size, rec_no=position % page_size)
+
+
+# elements of the record page used by get_product_data and the "Product Name"/"original recall notice url" columns
+RECORD_PAGE_TARGETS = [("div", "table-wrapper-pairs"), ("div", "page-header"), ("p", None)]
+
+# the extractors need nothing after the record table, the rest of the page is not downloaded
+RECORD_PAGE_END = ("div", "table-wrapper-pairs")
 
 
 def get_product_data(bs_soup: BeautifulSoup) -> dict:
@@ -33,53 +66,128 @@ def get_product_data(bs_soup: BeautifulSoup) -> dict:
     return data
 
 
-def get_total_record_count():
-    count = 12_421
-    url = "https://campaigns.sgs.com/en/vr/product-recalls-light"
-    page_soup = get_soup(url)
-    record_count_info = page_soup.find("div", class_="grid grid--2").text.strip()
+def extract_record(content: bytes) -> dict:
+    """
+    Function to extract the record from the html of the product page.
+    """
+    soup = parse_html(content, RECORD_PAGE_TARGETS, first_only=("p",))
+    with get_metrics().timer("extract"):
+        table_data = get_product_data(soup)
+        table_data["Product Name"] = soup.find("div", class_="page-header").text.strip()
+        table_data["original recall notice url"] = soup.find("p").a.attrs.get("href")
+    return table_data
+
 
-    for word in record_count_info.split(" "):
-        try:
-            count = int(word)
-        except ValueError:
-            pass
-    return count
+def scrape_record(url: str) -> Union[dict, None]:
+    """
+    Function to fetch and extract a single product page, used to retry the failed ones.
 
+    :return: dict
+    :raises HttpStatusError: if the page came back with an error status
+    """
+    response = get_fetcher().get(url, stop_after=RECORD_PAGE_END)
+    if not response.ok:
+        raise HttpStatusError(response.status, url)
+    return extract_record(response.content)
 
-if __name__ == "__main__":
-    SLEEP_TIME = 0.1     # in seconds
-    EXPORT_EXCEL_FILENAME = "data/sgs_data_extended.xlsx"
-    requests_header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/120.0.0.0 Safari/537.36"
-    }
 
-    total_number_of_records = get_total_record_count()
-    product_links = product_link_generator(total_number_of_records)
+def get_total_record_count():
+    url = "https://campaigns.sgs.com/en/vr/product-recalls-light"
+    page_soup = get_soup(url, LISTING_PAGE_TARGETS)
+    return parse_total_record_count(page_soup)
 
-    master_data = []
 
+def run(output_filename: str, frontier_filename: str, export_excel_filename: str = None,
+        assets_directory: str = None, store_filename: str = None) -> int:
+    """
+    Function to scrape the record pages which are not in the frontier yet and save all the records scraped so far
+    to `output_filename`, newest first.
+
+    :param output_filename: .jsonl, .csv or .parquet file of the records
+    :param frontier_filename: sqlite file of the records scraped by the previous runs
+    :param export_excel_filename: Excel copy of the output, None to skip it
+    :param assets_directory: directory the product images are downloaded to, their path is saved in the
+        "Image File" column. None to keep only the image urls
+    :param store_filename: sqlite file of the RecordStore the records are saved to, the Excel file is then
+        exported from the store. None to convert the output file instead
+    :return: no of records saved
+    """
+    # records scraped by a previous run are kept in the frontier and not fetched again
+    frontier = Frontier(frontier_filename)
+    total_number_of_records = get_total_record_count()
+    product_links = product_link_generator(total_number_of_records)
+    frontier.add((sgs_record_key(link, total_number_of_records), link) for link in product_links)
+    # an earlier product_link_generator added keys past the end of the listing, their pages never existed
+    frontier.discard([key for key, _ in frontier.pending() if int(key) < 0])
+    keys = {url: key for key, url in frontier.pending()}
+
+    # the output starts with the records of the previous runs, newest first, then the new ones as they arrive
+    writer = open_record_writer(output_filename, validate_func=convert_to_date)
+    if assets_directory:
+        writer = AssetWriter(writer, AssetStore(assets_directory))
+    writer.write_many(record for _, record in frontier.records(newest_first=True))
+
+    retry = get_fetcher().retry
     try:
-        for link in product_links:
-            print(link)
-            soup = get_soup(link)
+        for link, response in get_fetcher().map(keys, stop_after=RECORD_PAGE_END):
+            if isinstance(response, Exception) or not response.ok:
+                print("unable to get 200 status from url..", response)
+                frontier.mark_failed(keys[link], str(response), retry.is_retryable(
+                    response if isinstance(response, Exception) else response.status))
+                continue
 
-            if not soup:
+            try:
+                table_data = extract_record(response.content)
+            except Exception as e:
+                print("unable to extract the product data..", e)
+                frontier.mark_failed(keys[link], str(e), retryable=False)
                 continue
+            frontier.mark_done(keys[link], table_data)
+            writer.write(table_data)
 
-            table_data = get_product_data(soup)
-            table_data["Product Name"] = soup.find("div", class_="page-header").text.strip()
-            table_data["original recall notice url"] = soup.find("p").a.attrs.get("href")
-            master_data.append(table_data)
+        # the failed pages are tried again once the rest is done, the site may have recovered by then
+        still_failed = retry_failed(frontier, scrape_record, writer.write, get_fetcher().retry,
+                                    max_workers=get_fetcher().max_concurrency)
+        if still_failed:
+            print(f"{still_failed} products failed and will be retried on the next run")
 
     except KeyboardInterrupt:
         print("Received Keyboard interrupt, stopping the scrapper..")
 
-    except Exception as e:
-        print(e)
+    finally:
+        writer.close()
+        print(f"{writer.count} records saved to {output_filename}")
+        if store_filename:
+            update_store(store_filename, "sgs", frontier.records(), export_excel_filename)
+        elif export_excel_filename and writer.count:
+            convert_to_excel(output_filename, export_excel_filename, ["Publication Date"])
+            print(f"Data exported to {export_excel_filename}")
+        frontier.close()
+    return writer.count
+
 
+if __name__ == "__main__":
+    OUTPUT_FILENAME = "data/sgs_data_extended.jsonl"     # .jsonl, .csv or .parquet
+    EXPORT_EXCEL_FILENAME = "data/sgs_data_extended.xlsx"     # set None to skip the Excel conversion
+    HTTP_CACHE_FILENAME = "data/http_cache.sqlite"
+    FRONTIER_FILENAME = "data/sgs_data_extended_frontier.sqlite"
+    METRICS_FILENAME = "data/sgs_data_extended_metrics.json"
+    METRICS_PORT = None     # e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics during the run
+    ASSETS_DIRECTORY = None     # e.g. "data/assets" to download the product images too
+    STORE_FILENAME = "data/records.sqlite"     # set None to export the Excel file from the output file
+    ARCHIVE_DIRECTORY = "data/archive"     # raw copy of the pages for reextract.py, set None to skip it
+    configure_fetcher(cache=ResponseCache(HTTP_CACHE_FILENAME),
+                      archive=ResponseArchive(ARCHIVE_DIRECTORY) if ARCHIVE_DIRECTORY else None)
+
+    metrics = get_metrics()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    metrics.start_progress()
+    try:
+        run(OUTPUT_FILENAME, FRONTIER_FILENAME, EXPORT_EXCEL_FILENAME, ASSETS_DIRECTORY, STORE_FILENAME)
     finally:
-        # Export the master data to excel
-        export_to_excel(master_data, EXPORT_EXCEL_FILENAME, convert_to_date)
-        print(f"Data exported to {EXPORT_EXCEL_FILENAME}")
+        metrics.stop_progress()
+        get_fetcher().limiter.print_report()
+        get_fetcher().cache.print_report()
+        metrics.print_report()
+        metrics.dump(METRICS_FILENAME)
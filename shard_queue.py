@@ -0,0 +1,195 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Tuple, Union
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class Shard:
+    def __init__(self, shard_id: int, source: str, entries: List[Tuple[str, str]], attempts: int):
+        self.id = shard_id
+        self.source = source
+        self.entries = entries
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"<Shard {self.id} [{self.source}, {len(self.entries)} urls]>"
+
+
+class ShardQueue:
+    """
+    Queue of the shards of a crawl shared by the coordinator and the workers, stored in a sqlite file. A worker
+    leases a shard for `lease_seconds` and has to renew the lease with heartbeats while it scrapes it. The shard
+    of a worker which stopped heartbeating is leased again to another worker once the lease expired.
+
+    The sqlite file has to be reachable by every worker, i.e. on the same machine or a network share with working
+    file locks.
+
+    :param path: sqlite file of the queue
+    :param max_attempts: a shard which was leased this many times without being completed is marked failed
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY,
+                source TEXT,
+                entries TEXT,
+                state TEXT,
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER DEFAULT 0,
+                output TEXT,
+                error TEXT,
+                updated_at REAL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS shards_state ON shards (state)")
+
+    def add(self, source: str, entries: Iterable[Tuple[str, str]], shard_size: int = 500,
+            attempts: int = 0) -> int:
+        """
+        Function to split the (key, url) pairs into pending shards of `shard_size` urls.
+
+        :return: no of shards added
+        """
+        entries = list(entries)
+        shards = [(source, json.dumps(entries[start:start + shard_size]), PENDING, attempts, time.time())
+                  for start in range(0, len(entries), shard_size)]
+        with self._lock:
+            self._db.executemany("INSERT INTO shards (source, entries, state, attempts, updated_at) "
+                                 "VALUES (?, ?, ?, ?, ?)", shards)
+        return len(shards)
+
+    def lease(self, worker: str, lease_seconds: float = 60) -> Union[Shard, None]:
+        """
+        Function to take the first pending shard, or a shard whose lease expired, for `lease_seconds`.
+
+        :param worker: name of the worker. e.g. host-pid
+        :return: Shard or None if there is nothing to do right now
+        """
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE locks the file, two workers can't lease the same shard
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("UPDATE shards SET state = ?, error = ?, updated_at = ? "
+                                 "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                                 (FAILED, "lease expired too many times", now, LEASED, now, self.max_attempts))
+                row = self._db.execute("SELECT id, source, entries, attempts FROM shards "
+                                       "WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                                       (PENDING, LEASED, now)).fetchone()
+                if row:
+                    self._db.execute("UPDATE shards SET state = ?, worker = ?, lease_expires = ?, "
+                                     "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                                     (LEASED, worker, now + lease_seconds, now, row[0]))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if not row:
+            return
+        shard_id, source, entries, attempts = row
+        return Shard(shard_id, source, [tuple(entry) for entry in json.loads(entries)], attempts + 1)
+
+    def heartbeat(self, shard_id: int, worker: str, lease_seconds: float = 60) -> bool:
+        """
+        Function to renew the lease of the shard.
+
+        :return: False if the lease was lost, i.e. it expired and another worker has the shard now
+        """
+        with self._lock:
+            cursor = self._db.execute("UPDATE shards SET lease_expires = ?, updated_at = ? "
+                                      "WHERE id = ? AND worker = ? AND state = ?",
+                                      (time.time() + lease_seconds, time.time(), shard_id, worker, LEASED))
+        return cursor.rowcount == 1
+
+    def complete(self, shard: Shard, worker: str, output: str, failed_entries: List[Tuple[str, str]] = ()) -> bool:
+        """
+        Function to mark the shard done. The urls which failed are added back to the queue as a new shard, until
+        they were tried `max_attempts` times.
+
+        :param shard: the leased Shard
+        :param worker: name of the worker
+        :param output: file the records of the shard were written to
+        :param failed_entries: (key, url) pairs which could not be scraped
+        :return: False if the lease was lost, the output must not be used then
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._db.execute("UPDATE shards SET state = ?, output = ?, updated_at = ? "
+                                          "WHERE id = ? AND worker = ? AND state = ?",
+                                          (DONE, output, now, shard.id, worker, LEASED))
+                completed = cursor.rowcount == 1
+                if completed and failed_entries:
+                    state = PENDING if shard.attempts < self.max_attempts else FAILED
+                    self._db.execute("INSERT INTO shards (source, entries, state, attempts, error, updated_at) "
+                                     "VALUES (?, ?, ?, ?, ?, ?)",
+                                     (shard.source, json.dumps(list(failed_entries)), state, shard.attempts,
+                                      f"{len(failed_entries)} urls of shard {shard.id} failed", now))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return completed
+
+    def release(self, shard: Shard, worker: str, error: str):
+        """
+        Function to give the shard back to the queue, e.g. when the worker is stopped.
+        """
+        with self._lock:
+            self._db.execute("UPDATE shards SET state = ?, worker = NULL, lease_expires = NULL, error = ?, "
+                             "updated_at = ? WHERE id = ? AND worker = ? AND state = ?",
+                             (PENDING, error, time.time(), shard.id, worker, LEASED))
+
+    def outputs(self, source: str = None) -> List[Tuple[int, str, str]]:
+        """
+        Function to get the (shard id, source, output file) of the done shards in the order they were added.
+        """
+        query = "SELECT id, source, output FROM shards WHERE state = ?"
+        params = [DONE]
+        if source:
+            query += " AND source = ?"
+            params.append(source)
+        with self._lock:
+            return self._db.execute(query + " ORDER BY id", params).fetchall()
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall()
+        return {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def workers(self) -> List[Tuple[str, int, float]]:
+        """
+        Function to get the (worker, shard id, seconds until the lease expires) of the leased shards.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT worker, id, lease_expires FROM shards WHERE state = ? ORDER BY id",
+                                    (LEASED,)).fetchall()
+        return [(worker, shard_id, round(expires - time.time(), 1)) for worker, shard_id, expires in rows]
+
+    def is_finished(self) -> bool:
+        counts = self.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM shards")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,232 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Callable, List, Tuple
+
+import pandas as pd
+
+import asean_consumer_scraper
+import sgs_scraper_v2
+from fetcher import get_fetcher
+from metrics import get_metrics
+from recrawl import sgs_total_records
+from shard_queue import FAILED, Shard, ShardQueue
+from utils import convert_to_date, clean_df, sgs_record_key
+from writers import open_record_writer, read_records, convert_to_excel
+
+
+def sgs_entries() -> List[Tuple[str, None]]:
+    # only the keys are stored, a record moves to a later page every time one is published, see sgs_urls
+    total_number_of_records = sgs_scraper_v2.get_total_record_count()
+    return [(sgs_record_key(link, total_number_of_records), None)
+            for link in sgs_scraper_v2.product_link_generator(total_number_of_records)]
+
+
+def sgs_urls(entries: List[Tuple[str, None]]) -> List[Tuple[str, str]]:
+    """
+    Function to build the urls of the SGS keys of a shard from the no of records the site has when the shard is
+    scraped, not when it was created.
+    """
+    total_number_of_records = sgs_total_records()
+    return [(key, sgs_scraper_v2.record_url(key, total_number_of_records)) for key, _ in entries]
+
+
+def asean_entries() -> List[Tuple[str, str]]:
+    urls = [asean_consumer_scraper.get_product_url(row)
+            for rows in asean_consumer_scraper.get_products_overview() for row in rows]
+    return [(url, url) for url in urls]
+
+
+# source: (function listing the (key, url) pairs of the crawl, function extracting the record from a page,
+# validate_func of the merged output, date columns of the Excel file, element after which the page is not read,
+# function building the urls of the entries of a shard when a worker scrapes it)
+SOURCES = {
+    "sgs": (sgs_entries, sgs_scraper_v2.extract_record, convert_to_date, ["Publication Date"],
+            sgs_scraper_v2.RECORD_PAGE_END, sgs_urls),
+    "asean": (asean_entries, asean_consumer_scraper.extract_product, clean_df, [],
+              asean_consumer_scraper.PRODUCT_PAGE_END, list),
+}
+
+
+def keep_lease(queue: ShardQueue, shard: Shard, worker: str, lease_seconds: float, stopped: threading.Event,
+               lost: threading.Event):
+    """
+    Function to renew the lease of the shard until `stopped` is set, run in a background thread. Sets `lost` if
+    the lease expired and the shard went to another worker.
+    """
+    while not stopped.wait(lease_seconds / 3):
+        if not queue.heartbeat(shard.id, worker, lease_seconds):
+            lost.set()
+            return
+
+
+def scrape_shard(entries: List[Tuple[str, str]], extract: Callable, output: str, lost: threading.Event,
+                 stop_after: tuple = None) -> List[Tuple[str, str]]:
+    """
+    Function to fetch all the urls of the shard concurrently and write the records to `output`.
+    `stop_after` is passed on to Fetcher.map.
+
+    :param entries: (key, url) pairs of the shard, with the urls built for this run
+    :return: (key, url) pairs which could not be scraped
+    """
+    keys = {url: key for key, url in entries}
+    failed = []
+    with open_record_writer(output) as writer:
+        for url, response in get_fetcher().map(keys, stop_after=stop_after):
+            if lost.is_set():
+                break
+            if isinstance(response, Exception) or not response.ok:
+                print("unable to get 200 status from url..", response, url)
+                failed.append((keys[url], url))
+                continue
+            try:
+                record = extract(response.content)
+            except Exception as e:
+                print("unable to extract the data..", e, url)
+                failed.append((keys[url], url))
+                continue
+            writer.write(record)
+    return failed
+
+
+def run_worker(queue: ShardQueue, output_dir: str, lease_seconds: float = 60, idle_timeout: float = 60):
+    """
+    Function to lease shards from the queue and scrape them until there is nothing left. Every shard is written to
+    its own file in `output_dir`, the coordinator merges them.
+
+    :param queue: ShardQueue shared with the coordinator
+    :param output_dir: directory of the shard outputs, must be reachable by the coordinator
+    :param lease_seconds: seconds the lease lasts without a heartbeat
+    :param idle_timeout: seconds to wait for new shards, e.g. the retries of other workers, before stopping
+    """
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    os.makedirs(output_dir, exist_ok=True)
+    idle_since = None
+    while True:
+        shard = queue.lease(worker, lease_seconds)
+        if not shard:
+            if queue.is_finished() and any(queue.counts().values()):
+                print(f"{worker}: no shards left, stopping..")
+                return
+            # the coordinator has not added the shards yet or other workers hold the rest, their shards come back
+            # if they die
+            idle_since = idle_since or time.time()
+            if time.time() - idle_since > idle_timeout:
+                print(f"{worker}: no shard available for {idle_timeout} seconds, stopping..")
+                return
+            time.sleep(min(5.0, lease_seconds / 3))
+            continue
+        idle_since = None
+
+        print(f"{worker}: scraping {shard}, attempt {shard.attempts}..")
+        output = os.path.join(output_dir, f"{shard.source}-shard-{shard.id}-{worker}.jsonl")
+        stopped, lost = threading.Event(), threading.Event()
+        threading.Thread(target=keep_lease, args=(queue, shard, worker, lease_seconds, stopped, lost),
+                         daemon=True).start()
+        try:
+            _, extract, _, _, stop_after, build_urls = SOURCES[shard.source]
+            failed = scrape_shard(build_urls(shard.entries), extract, output, lost, stop_after)
+            # the failed entries go back to the queue as they were stored, the next worker builds their urls again
+            stored = dict(shard.entries)
+            failed = [(key, stored[key]) for key, _ in failed]
+        except BaseException as e:
+            stopped.set()
+            queue.release(shard, worker, repr(e))
+            raise
+        stopped.set()
+
+        if lost.is_set() or not queue.complete(shard, worker, output, failed):
+            print(f"{worker}: lost the lease of {shard}, another worker scrapes it..")
+            continue
+        print(f"{worker}: {shard} done, {len(failed)} urls failed")
+
+
+def run_coordinator(queue: ShardQueue, sources: List[str], shard_size: int):
+    """
+    Function to list the urls of the sources and split them into shards for the workers.
+    """
+    for source in sources:
+        entries = SOURCES[source][0]()
+        count = queue.add(source, entries, shard_size)
+        print(f"{source}: {len(entries)} urls split into {count} shards of {shard_size}")
+
+
+def wait_for_workers(queue: ShardQueue, interval: float = 10):
+    while not queue.is_finished():
+        counts = queue.counts()
+        leases = ", ".join(f"{worker} has shard {shard_id} ({expires}s left)"
+                           for worker, shard_id, expires in queue.workers())
+        print(f"{counts['done']} shards done, {counts['pending']} pending, {counts['leased']} leased: {leases}")
+        time.sleep(interval)
+
+
+def merge_outputs(queue: ShardQueue, source: str, output: str, excel_filename: str = None) -> int:
+    """
+    Function to merge the outputs of the done shards of the source, in the order of the shards.
+
+    :return: no of records merged
+    """
+    validate_func, date_columns = SOURCES[source][2], SOURCES[source][3]
+    with open_record_writer(output, validate_func=validate_func) as writer:
+        for _, _, path in queue.outputs(source):
+            df = read_records(path)
+            writer.write_frame(df.astype(object).where(pd.notna(df), None))
+    print(f"{writer.count} {source} records merged into {output}")
+    if excel_filename and writer.count:
+        convert_to_excel(output, excel_filename, date_columns)
+        print(f"Data exported to {excel_filename}")
+    return writer.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="scrape the product pages with several workers sharing a queue")
+    parser.add_argument("--queue", default="data/shards.sqlite", help="sqlite file of the shared queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    coordinator = commands.add_parser("coordinator", help="split the crawl into shards, wait and merge")
+    coordinator.add_argument("--source", nargs="+", choices=sorted(SOURCES), default=sorted(SOURCES))
+    coordinator.add_argument("--shard-size", type=int, default=500, help="no of urls per shard")
+    coordinator.add_argument("--no-wait", action="store_true", help="only create the shards")
+
+    worker = commands.add_parser("worker", help="scrape shards until the queue is empty")
+    worker.add_argument("--output-dir", default="data/shards", help="directory of the shard outputs")
+    worker.add_argument("--lease", type=float, default=60, help="seconds the lease lasts without a heartbeat")
+
+    merge = commands.add_parser("merge", help="merge the outputs of the done shards")
+    merge.add_argument("--source", nargs="+", choices=sorted(SOURCES), default=sorted(SOURCES))
+
+    commands.add_parser("status", help="show the progress of the crawl")
+    args = parser.parse_args()
+
+    queue = ShardQueue(args.queue)
+    if args.command == "worker":
+        try:
+            run_worker(queue, args.output_dir, args.lease)
+        except KeyboardInterrupt:
+            print("Received Keyboard interrupt, the shard goes back to the queue..")
+        get_fetcher().limiter.print_report()
+        get_metrics().print_report()
+
+    elif args.command == "status":
+        print(queue.counts())
+        for worker_name, shard_id, expires in queue.workers():
+            print(f"{worker_name} has shard {shard_id}, lease expires in {expires}s")
+
+    else:
+        if args.command == "coordinator":
+            if not queue.is_finished():
+                print("the queue still has unfinished shards, start the workers or clear it first..")
+                sys.exit(1)
+            queue.clear()
+            run_coordinator(queue, args.source, args.shard_size)
+            if args.no_wait:
+                sys.exit()
+            wait_for_workers(queue)
+
+        if queue.counts()[FAILED]:
+            print(f"{queue.counts()[FAILED]} shards failed, their urls are missing from the output")
+        for source in args.source:
+            merge_outputs(queue, source, f"data/{source}_sharded.jsonl", f"data/{source}_sharded.xlsx")
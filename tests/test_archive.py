@@ -0,0 +1,87 @@
+import gzip
+import multiprocessing
+import os
+
+import pytest
+
+import archive
+from archive import ResponseArchive
+
+
+def append(target: ResponseArchive, url: str):
+    target.append(url, 200, {"content-type": "text/html"}, f"<html>{url}</html>".encode() * 20, "utf-8")
+
+
+def assert_readable(directory: str, urls):
+    reader = ResponseArchive(directory)
+    for url in urls:
+        assert reader.read(url).content == f"<html>{url}</html>".encode() * 20, url
+    reader.close()
+    # every segment is still a valid gzip file
+    for name in os.listdir(directory):
+        if name.startswith("segment-"):
+            with gzip.open(os.path.join(directory, name)) as segment:
+                segment.read()
+
+
+def test_two_writers_on_one_directory(tmp_path):
+    directory = str(tmp_path)
+    first, second = ResponseArchive(directory), ResponseArchive(directory)
+    urls = []
+    for i in range(20):
+        url = f"https://example.com/{i}"
+        writer = first if i % 3 else second
+        append(writer, url)
+        # each append is written before the other writer's next one, so the two interleave in the segment
+        writer.flush()
+        urls.append(url)
+    first.close()
+    second.close()
+    assert_readable(directory, urls)
+
+
+def test_entry_of_a_crashed_writer_is_dropped(tmp_path):
+    directory = str(tmp_path)
+    writer = ResponseArchive(directory)
+    append(writer, "https://example.com/1")
+    writer.flush()
+    with open(os.path.join(directory, "segment-00001.gz"), "ab") as segment:
+        segment.write(gzip.compress(b"half written")[:10])
+    next_writer = ResponseArchive(directory)
+    append(next_writer, "https://example.com/2")
+    next_writer.close()
+    writer.close()
+    assert_readable(directory, ["https://example.com/1", "https://example.com/2"])
+
+
+def append_many(directory: str, worker: int):
+    writer = ResponseArchive(directory, max_segment_size=4096)
+    for i in range(50):
+        append(writer, f"https://example.com/{worker}/{i}")
+    writer.close()
+
+
+@pytest.mark.skipif(archive.fcntl is None, reason="needs fcntl")
+def test_processes_rotating_segments(tmp_path):
+    directory = str(tmp_path)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=append_many, args=(directory, worker)) for worker in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    assert len([name for name in os.listdir(directory) if name.startswith("segment-")]) > 1
+    assert_readable(directory, [f"https://example.com/{worker}/{i}" for worker in range(3) for i in range(50)])
+
+
+def test_batch_rotates_segments(tmp_path):
+    directory = str(tmp_path)
+    writer = ResponseArchive(directory, max_segment_size=2048)
+    urls = [f"https://example.com/{i}" for i in range(100)]
+    for url in urls:
+        append(writer, url)
+    writer.close()
+    assert writer.archived == 100
+    assert len([name for name in os.listdir(directory) if name.startswith("segment-")]) > 1
+    assert_readable(directory, urls)
@@ -0,0 +1,49 @@
+import pytest
+
+from element_scanner import ElementEndScanner
+
+PAGE = (b"<html><head><title>Recall</title></head><body>"
+        b"<div class=\"table-wrapper-pairs-old\">not the target</div>"
+        b"<DIV id='x' class='table-wrapper table-wrapper-pairs'><div><div>nested</div></div>"
+        b"<divider>not a div</divider><div class=\"inner\">last</div></DIV>"
+        b"<div class=\"footer\">" + b"footer " * 40 + b"</div></body></html>")
+TARGET_END = PAGE.index(b"</DIV>") + len(b"</DIV>")
+
+TABLES = (b"<body><table class=\"table\"><tr><td>1</td></tr></table><p>between</p>"
+          b"<table class=\"table\"><tr><td><table><tr><td>2</td></tr></table></td></tr></table>"
+          b"<table class=\"table\">third</table>" + b"<p>rest</p>" * 20 + b"</body>")
+SECOND_TABLE_END = TABLES.index(b"</table></td></tr></table>") + len(b"</table></td></tr></table>")
+
+
+def scan(page: bytes, chunk_size: int, *args) -> ElementEndScanner:
+    scanner = ElementEndScanner(*args)
+    for start in range(0, len(page), chunk_size):
+        if scanner.feed(page[start:start + chunk_size]):
+            break
+    return scanner
+
+
+@pytest.mark.parametrize("page, args, end", [
+    (PAGE, ("div", "table-wrapper-pairs"), TARGET_END),
+    (TABLES, ("table", "table", 2), SECOND_TABLE_END),
+], ids=["nested divs", "second of three tables"])
+def test_same_end_for_every_chunk_size(page, args, end):
+    for chunk_size in range(1, len(page) + 1):
+        scanner = scan(page, chunk_size, *args)
+        assert scanner.done, chunk_size
+        assert scanner.content() == page[:end], chunk_size
+
+
+def test_body_without_the_target_is_kept_whole():
+    page = PAGE.replace(b"table-wrapper-pairs'", b"table-wrapper'")
+    for chunk_size in (1, 7, len(page)):
+        scanner = scan(page, chunk_size, "div", "table-wrapper-pairs")
+        assert not scanner.done
+        assert scanner.content() == page
+
+
+def test_unclosed_target_is_not_done():
+    page = PAGE[:TARGET_END - len(b"</DIV>")]
+    scanner = scan(page, 3, "div", "table-wrapper-pairs")
+    assert not scanner.done
+    assert scanner.content() == page
@@ -0,0 +1,42 @@
+import time
+
+from http_cache import ResponseCache
+
+
+def test_stored_pages_are_written_in_the_background(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    for i in range(100):
+        cache.store(f"https://example.com/{i}", 200, {"ETag": f'"{i}"'}, b"<html>%d</html>" % i, "utf-8")
+    cache.store("https://example.com/private", 200, {"Cache-Control": "no-store"}, b"secret", "utf-8")
+    cache.flush()
+
+    cached = cache.lookup("https://example.com/42")
+    assert cached.content == b"<html>42</html>"
+    assert cached.conditional_headers() == {"If-None-Match": '"42"'}
+    assert not cached.is_fresh
+    assert cache.lookup("https://example.com/private") is None
+
+    cache.refresh("https://example.com/42", {"Cache-Control": "max-age=60"})
+    cache.close()
+
+    reopened = ResponseCache(str(tmp_path / "cache.sqlite"))
+    assert reopened.lookup("https://example.com/42").expires_at > time.time() + 50
+    assert reopened.lookup("https://example.com/99").content == b"<html>99</html>"
+    reopened.close()
+
+
+def test_cut_off_page_is_only_served_to_the_same_variant(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    url = "https://example.com/record"
+    cache.store(url, 200, {}, b"<html><table>", "utf-8", variant="stop_after=table,table")
+    cache.flush()
+    assert cache.lookup(url) is None
+    assert cache.lookup(url, "stop_after=div,table-wrapper-pairs") is None
+    cached = cache.lookup(url, "stop_after=table,table")
+    assert (cached.url, cached.content) == (url, b"<html><table>")
+
+    cache.store(url, 200, {}, b"<html><table></table><p>rest</p></html>", "utf-8")
+    cache.flush()
+    assert cache.lookup(url).content == b"<html><table></table><p>rest</p></html>"
+    assert cache.lookup(url, "stop_after=table,table").content == b"<html><table>"
+    cache.close()
@@ -0,0 +1,60 @@
+from linker import RecordLinker, product_features
+from record_store import RecordStore
+
+
+def sgs(name, model, date="2024-03-01"):
+    return {"Product Name": name, "Brand": "Acme", "Type/Model": model, "Publication Date": date}
+
+
+def asean(name, model, date="2024-03-05"):
+    return {"Product Name": name, "Model Product": model, "Recall Date": date}
+
+
+def test_product_features_ignore_case_and_punctuation():
+    assert product_features("sgs", sgs("Baby-Stroller", "KX-200")) == \
+        product_features("sgs", sgs("baby stroller", "kx 200"))
+
+
+def test_links_near_duplicates_incrementally(tmp_path):
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+    store.upsert("sgs", "1", sgs("Baby Stroller Deluxe Foldable", "KX-200"))
+    store.upsert("asean", "a", asean("ACME baby stroller deluxe, foldable", "Acme KX 200"))
+    store.upsert("sgs", "2", sgs("Baby Stroller Deluxe Foldable", "KX-300"))
+    store.upsert("sgs", "3", sgs("Electric Kettle", "EK-1"))
+    store.upsert("sgs", "4", sgs("Baby Stroller Deluxe Foldable", "KX-200", date="2019-01-01"))
+
+    linker = RecordLinker(str(tmp_path / "links.sqlite"))
+    assert linker.link(store)["indexed"] == 5
+    cluster = linker.cluster_of("sgs", "1")
+    assert linker.cluster_of("asean", "a") == cluster
+    # a different model number or a date years apart is another product
+    assert linker.cluster_of("sgs", "2") != cluster
+    assert linker.cluster_of("sgs", "4") != cluster
+    assert linker.cluster_of("sgs", "3") not in (cluster, linker.cluster_of("sgs", "2"))
+
+    store.upsert("asean", "b", asean("Electric kettle", "EK 1"))
+    stats = linker.link(store)
+    assert stats["indexed"] == 1
+    assert linker.cluster_of("asean", "b") == linker.cluster_of("sgs", "3")
+    assert linker.cluster_of("sgs", "1") == cluster
+    assert linker.link(store)["indexed"] == 0
+    linker.close()
+    store.close()
+
+
+def test_cross_source_only(tmp_path):
+    store = RecordStore(str(tmp_path / "records.sqlite"))
+    store.upsert("sgs", "1", sgs("Baby Stroller Deluxe Foldable", "KX-200"))
+    store.upsert("sgs", "2", sgs("Baby Stroller Deluxe Foldable", "KX-200"))
+    store.upsert("asean", "a", asean("Baby stroller deluxe foldable", "KX-200"))
+
+    linker = RecordLinker(str(tmp_path / "links.sqlite"), cross_source_only=True)
+    linker.link(store)
+    # the sgs records are only in one cluster through the asean one
+    assert linker.cluster_of("sgs", "1") == linker.cluster_of("sgs", "2") == linker.cluster_of("asean", "a")
+    rows = linker._db.execute("SELECT records.source, others.source FROM links "
+                              "JOIN records ON records.id = links.record_id "
+                              "JOIN records AS others ON others.id = links.other_id").fetchall()
+    assert rows and all(source != other_source for source, other_source in rows)
+    linker.close()
+    store.close()
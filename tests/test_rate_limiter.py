@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from rate_limiter import FairShare, HostController
+
+
+def test_fair_share_gives_the_freed_slot_to_the_host_with_fewest_in_flight():
+    async def scenario():
+        fair = FairShare(budget=2)
+        await fair.acquire("a")
+        await fair.acquire("a")
+        acquired = []
+
+        async def take(host):
+            await fair.acquire(host)
+            acquired.append(host)
+
+        tasks = [asyncio.create_task(take("a")) for _ in range(3)] + [asyncio.create_task(take("b"))]
+        await asyncio.sleep(0.01)
+        assert acquired == []
+        assert fair.waiting == {"a": 3, "b": 1}
+
+        await fair.release("a")
+        await asyncio.sleep(0.01)
+        assert acquired == ["b"]
+
+        await fair.release("a")
+        await asyncio.sleep(0.01)
+        assert acquired == ["b", "a"]
+        assert fair.total == 2
+        assert fair.in_flight == {"a": 1, "b": 1}
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert fair.waiting == {}
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_acquire_gives_the_slot_back():
+    async def scenario():
+        controller = HostController(concurrency=1)
+        controller.paused_until = time.monotonic() + 60
+        task = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0.01)
+        assert controller.in_flight == 1
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert controller.in_flight == 0
+
+        controller.paused_until = 0
+        await asyncio.wait_for(controller.acquire(), 1)
+        assert controller.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+def test_release_without_feedback_keeps_the_limits():
+    async def scenario():
+        controller = HostController(concurrency=8, rate=20)
+        for _ in range(3):
+            await controller.acquire()
+        await controller.release(None, None, feedback=False)
+        assert (controller.in_flight, controller.concurrency, controller.rate) == (2, 8, 20)
+        assert (controller.requests, controller.errors) == (0, 0)
+
+        # a timeout is a congestion signal
+        await controller.release(None, None)
+        assert controller.in_flight == 1
+        assert controller.concurrency == 4 and controller.rate == 10
+        assert controller.errors == 1
+
+    asyncio.run(scenario())
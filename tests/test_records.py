@@ -0,0 +1,31 @@
+from records import RecordColumns
+
+
+def test_missing_values_are_padded_with_none():
+    records = RecordColumns(["Key"])
+    records.append({"Key": "1", "Country": "Malaysia"})
+    records.append({"Key": "2"})
+    records.append({"Key": "3", "Type": "Toys"})
+    records.append({"Type": "Toys", "Country": "Malaysia", "Key": "4"})
+
+    assert len(records) == 4
+    assert list(records.columns) == ["Key", "Country", "Type"]
+    assert all(len(column) == 4 for column in records.columns.values())
+    assert list(records) == [
+        {"Key": "1", "Country": "Malaysia", "Type": None},
+        {"Key": "2", "Country": None, "Type": None},
+        {"Key": "3", "Country": None, "Type": "Toys"},
+        {"Key": "4", "Country": "Malaysia", "Type": "Toys"},
+    ]
+
+    df = records.to_dataframe()
+    assert list(df.columns) == ["Key", "Country", "Type"]
+    assert df["Type"].isna().tolist() == [True, True, False, False]
+
+
+def test_short_strings_are_shared():
+    records = RecordColumns(share_up_to=8)
+    records.append({"Country": "".join(["Malay", "sia"]), "Name": "".join(["x"] * 9)})
+    records.append({"Country": "".join(["Mala", "ysia"]), "Name": "".join(["x"] * 9)})
+    assert records.columns["Country"][0] is records.columns["Country"][1]
+    assert records.columns["Name"][0] is not records.columns["Name"][1]
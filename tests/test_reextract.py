@@ -0,0 +1,27 @@
+from archive import ResponseArchive
+from reextract import TRUNCATED, extract_batch
+
+PAGE_END = ("div", "table-wrapper-pairs")
+
+
+def extract(content: bytes) -> dict:
+    return {"Page": content.decode()}
+
+
+def test_pages_cut_off_after_another_element_are_skipped(tmp_path):
+    archive = ResponseArchive(str(tmp_path))
+    archive.append("https://example.com/whole", 200, {}, b"whole", "utf-8")
+    archive.append("https://example.com/same", 200, {}, b"same", "utf-8", True, PAGE_END)
+    archive.append("https://example.com/other", 200, {}, b"other", "utf-8", True, ("table", "table"))
+    archive.append("https://example.com/unknown", 200, {}, b"unknown", "utf-8", True)
+    archive.close()
+
+    reader = ResponseArchive(str(tmp_path))
+    entries = [(name, reader.lookup(f"https://example.com/{name}")) for name in ("whole", "same", "other", "unknown")]
+    reader.close()
+    assert extract_batch(extract, PAGE_END, entries) == [
+        ("whole", {"Page": "whole"}, None),
+        ("same", {"Page": "same"}, None),
+        ("other", None, TRUNCATED),
+        ("unknown", None, TRUNCATED),
+    ]
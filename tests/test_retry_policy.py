@@ -0,0 +1,28 @@
+from frontier import Frontier
+from retry_policy import HttpStatusError, RetryPolicy, retry_failed
+
+
+def test_only_transient_failures_are_retried(tmp_path):
+    frontier = Frontier(str(tmp_path / "frontier.sqlite"))
+    retry = RetryPolicy()
+    frontier.add([(key, key) for key in ("gone", "broken", "busy", "flaky")])
+    frontier.mark_failed("gone", "404", retry.is_retryable(HttpStatusError(404, "gone")))
+    frontier.mark_failed("broken", "no table", retryable=False)
+    frontier.mark_failed("busy", "503", retry.is_retryable(HttpStatusError(503, "busy")))
+    frontier.mark_failed("flaky", "timeout", retry.is_retryable(TimeoutError()))
+
+    scraped, written = [], []
+
+    def scrape(url):
+        scraped.append(url)
+        if url == "busy":
+            raise HttpStatusError(503, url)
+        return {"Key": url}
+
+    assert retry_failed(frontier, scrape, written.append, retry, rounds=5, wait=0, max_attempts=3) == 3
+    # busy failed 3 times in all, 1 in the run and 2 in the retries
+    assert sorted(scraped) == ["busy", "busy", "flaky"]
+    assert written == [{"Key": "flaky"}]
+    assert sorted(key for key, _, _ in frontier.failed()) == ["broken", "busy", "gone"]
+    assert frontier.retryable(3) == []
+    frontier.close()
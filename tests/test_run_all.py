@@ -0,0 +1,26 @@
+import pytest
+
+import run_all
+from frontier import Frontier
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    frontier_filename = str(tmp_path / "frontier.sqlite")
+    monkeypatch.setitem(run_all.SOURCES, "test", (lambda **options: 2, {"frontier_filename": frontier_filename}))
+    frontier = Frontier(frontier_filename)
+    frontier.mark_done("1", {"Key": "1"})
+    frontier.mark_failed("gone", "404", retryable=False)
+    yield frontier
+    frontier.close()
+
+
+def test_permanent_failures_do_not_fail_the_source(source, capsys):
+    assert run_all.run_source("test") == 2
+    assert "1 urls failed for good" in capsys.readouterr().out
+
+
+def test_transient_failures_fail_the_source(source):
+    source.mark_failed("busy", "503")
+    with pytest.raises(RuntimeError, match="1 urls are still failed"):
+        run_all.run_source("test")
@@ -0,0 +1,27 @@
+import sgs_delta_sync
+from fingerprints import NEW, FingerprintIndex, fingerprint
+
+TOTAL = 100
+
+
+def fake_listing_pages(first_url):
+    for offset in range(0, TOTAL, 10):
+        yield offset, [{"Product Name": f"Recalled product {offset + rec_no}"} for rec_no in range(10)], TOTAL
+
+
+def test_records_of_the_frontier_are_not_fetched_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(sgs_delta_sync, "listing_pages", fake_listing_pages)
+    index = FingerprintIndex(str(tmp_path / "fingerprints.sqlite"))
+    # the full crawl scraped every record but the 5 newest ones
+    scraped = {str(key) for key in range(TOTAL - 5)}
+
+    changes = sgs_delta_sync.find_changes("https://example.com", index, stop_after=30, known=scraped.__contains__)
+    assert [(status, key) for status, key, _, _ in changes] == [(NEW, str(key)) for key in range(99, 94, -1)]
+    # the walk stopped after 30 known records, which are in the index now
+    assert len(index) == 30
+    assert index.get("94") == fingerprint({"Product Name": "Recalled product 5"})
+
+    # without the frontier every record is new
+    changes = sgs_delta_sync.find_changes("https://example.com", FingerprintIndex(str(tmp_path / "empty.sqlite")))
+    assert len(changes) == TOTAL
+    index.close()
@@ -0,0 +1,45 @@
+import time
+
+from shard_queue import DONE, FAILED, ShardQueue
+
+ENTRIES = [(str(i), f"https://example.com/{i}") for i in range(4)]
+
+
+def test_expired_lease_goes_to_another_worker(tmp_path):
+    queue = ShardQueue(str(tmp_path / "shards.sqlite"))
+    queue.add("sgs", ENTRIES, shard_size=2)
+
+    first = queue.lease("w1", lease_seconds=0.05)
+    second = queue.lease("w2")
+    assert (first.id, second.id) == (1, 2)
+    assert queue.lease("w3") is None
+
+    time.sleep(0.1)
+    taken = queue.lease("w3")
+    assert taken.id == first.id
+    assert taken.entries == ENTRIES[:2]
+    assert taken.attempts == 2
+
+    # the first worker lost its lease, its output must not be merged
+    assert not queue.heartbeat(first.id, "w1")
+    assert not queue.complete(first, "w1", "w1.jsonl")
+    assert queue.heartbeat(taken.id, "w3")
+    assert queue.complete(taken, "w3", "w3.jsonl")
+    assert queue.complete(second, "w2", "w2.jsonl")
+    assert queue.counts()[DONE] == 2
+    assert queue.is_finished()
+    queue.close()
+
+
+def test_shard_fails_after_max_attempts(tmp_path):
+    queue = ShardQueue(str(tmp_path / "shards.sqlite"), max_attempts=2)
+    queue.add("asean", ENTRIES)
+
+    assert queue.lease("w1", lease_seconds=0.01).attempts == 1
+    time.sleep(0.05)
+    assert queue.lease("w2", lease_seconds=0.01).attempts == 2
+    time.sleep(0.05)
+    assert queue.lease("w3") is None
+    assert queue.counts()[FAILED] == 1
+    assert queue.is_finished()
+    queue.close()
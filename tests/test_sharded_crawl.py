@@ -0,0 +1,10 @@
+import sharded_crawl
+from utils import sgs_record_key
+
+
+def test_sgs_urls_are_built_from_the_current_total(monkeypatch):
+    monkeypatch.setattr(sharded_crawl, "sgs_total_records", lambda: 55)
+    entries = sharded_crawl.sgs_urls([("0", None), ("49", None)])
+    assert [key for key, _ in entries] == ["0", "49"]
+    assert all(sgs_record_key(url, 55) == key for key, url in entries)
+    assert "p=50&" in entries[0][1] and "rec=4" in entries[0][1]
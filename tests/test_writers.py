@@ -0,0 +1,23 @@
+import pytest
+
+from writers import open_record_writer, read_records
+
+RECORDS = [{"Key": "1", "Name": "Kettle"}, {"Key": "2", "Name": "Heater"},
+           {"Key": "3", "Name": "Stroller", "Country": "Malaysia"}, {"Key": "4", "Name": "Toy"}]
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".csv", ".parquet"])
+def test_columns_of_a_later_batch_are_kept(tmp_path, extension):
+    if extension == ".parquet":
+        pytest.importorskip("pyarrow")
+    path = str(tmp_path / f"records{extension}")
+    with open_record_writer(path, batch_size=2, validate_func=lambda df: df) as writer:
+        writer.write_many(RECORDS)
+    assert writer.count == 4
+
+    df = read_records(path)
+    assert list(df.columns) == ["Key", "Name", "Country"]
+    assert df["Key"].astype(str).tolist() == ["1", "2", "3", "4"]
+    countries = df["Country"].tolist()
+    assert countries[2] == "Malaysia"
+    assert all(country in ("", None) or country != country for country in countries[:2] + countries[3:])
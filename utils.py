@@ -1,8 +1,16 @@
-from typing import Union, Callable
-from urllib.parse import urlsplit
-from bs4 import BeautifulSoup
+import os
+from typing import Union, Callable, Iterable, Tuple
+from urllib.parse import urlsplit, parse_qsl
+from bs4 import BeautifulSoup, SoupStrainer
 import pandas as pd
-import requests
+from fetcher import get_fetcher
+from metrics import get_metrics
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = os.environ.get("SCRAPER_HTML_PARSER", "lxml")
+except ImportError:
+    HTML_PARSER = os.environ.get("SCRAPER_HTML_PARSER", "html.parser")
 
 
 def extract_table_data(table_soup: BeautifulSoup) -> list:
@@ -52,6 +60,45 @@ def prepare_url(baseurl: str, join_url: str) -> str:
     return f"{splitted_url.scheme}://{splitted_url.netloc}{join_url}"
 
 
+# elements of the SGS listing page used by parse_total_record_count and the listing scraper
+LISTING_PAGE_TARGETS = [("div", "grid--2"), ("table", "table--simple"), ("li", "next")]
+
+
+def parse_total_record_count(page_soup: BeautifulSoup, default: int = 12_421) -> int:
+    """
+    Function to read the total no of records from the SGS listing page. e.g. "Showing 1 to 10 of 12421 records"
+    the last number in the text is the total.
+
+    :param page_soup: bs4 object of the listing page
+    :param default: value returned if the count is not found
+    :return: int
+    """
+    count = default
+    record_count_info = page_soup.find("div", class_="grid grid--2").text.strip()
+
+    for word in record_count_info.split(" "):
+        try:
+            count = int(word)
+        except ValueError:
+            pass
+    return count
+
+
+def sgs_record_key(url: str, total_records: int) -> str:
+    """
+    Function to get a key for the SGS record page which does not change when new records are published. The
+    listing is newest first, so a record moves to a later page every time, but its position counted from the
+    oldest record stays the same.
+
+    :param url: record page url. e.g. .../record?p=20&d=0&id=18CD45C15541&dc=http&lb=&rec=3
+    :param total_records: total no of records the url was generated for
+    :return: str
+    """
+    query = dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
+    position = int(query["p"]) + int(query["rec"])
+    return str(total_records - 1 - position)
+
+
 def clean_df(dataframe: pd.DataFrame) -> pd.DataFrame:
     """
     Function to manipulate the dataframe before saving it.
@@ -77,25 +124,82 @@ def export_to_excel(data: list, excel_filename: str, validate_func: Callable = c
     return True
 
 
-def get_soup(url: str) -> Union[BeautifulSoup, None]:
+class TargetStrainer(SoupStrainer):
+    """
+    SoupStrainer which only builds the subtrees of the given target tags, everything else in the page is skipped
+    while parsing. A new one is needed for every page because of `first_only`.
+
+    :param targets: list of (tag name, css class) tuples. css class None matches every tag with that name
+    :param first_only: tag names for which only the first match is kept. e.g. ("p",) for soup.find("p")
+    """
+
+    def __init__(self, targets: Iterable[Tuple[str, Union[str, None]]], first_only: Iterable[str] = ()):
+        super().__init__()
+        self.targets = list(targets)
+        self.first_only = set(first_only)
+        self._found = set()
+
+    def is_target(self, name: str, attrs: dict) -> bool:
+        if name in self._found:
+            return False
+
+        classes = (attrs or {}).get("class") or ""
+        if isinstance(classes, str):
+            classes = classes.split()
+
+        for tag, css_class in self.targets:
+            if name == tag and (css_class is None or css_class in classes):
+                if name in self.first_only:
+                    self._found.add(name)
+                return True
+        return False
+
+    # bs4 < 4.13
+    def search_tag(self, markup_name=None, markup_attrs=None):
+        return self.is_target(markup_name, markup_attrs)
+
+    # bs4 >= 4.13
+    def allow_tag_creation(self, nsprefix, name, attrs) -> bool:
+        return self.is_target(name, attrs)
+
+    def allow_string_creation(self, string) -> bool:
+        return False
+
+
+def parse_html(content: Union[bytes, str], targets: Iterable[Tuple[str, Union[str, None]]] = None,
+               first_only: Iterable[str] = ()) -> BeautifulSoup:
+    """
+    Function to convert the html into BeautifulSoup object. If targets are given, only those elements are built
+    so the extractors get the same result as with the full page for a fraction of the parse time.
+
+    :param content: html body of the page
+    :param targets: list of (tag name, css class) tuples to keep, None to keep the whole page
+    :param first_only: tag names for which only the first match is kept
+    :return: BeautifulSoup object
+    """
+    parse_only = TargetStrainer(targets, first_only) if targets else None
+    with get_metrics().timer("parse"):
+        return BeautifulSoup(content, HTML_PARSER, parse_only=parse_only)
+
+
+def get_soup(url: str, targets: Iterable[Tuple[str, Union[str, None]]] = None,
+             first_only: Iterable[str] = (), stop_after: tuple = None) -> Union[BeautifulSoup, None]:
     """
     Function to fetch the url and convert it to BeautifulSoup object. If error while fetching return None
     :param url:
+    :param targets: see parse_html
+    :param first_only: see parse_html
+    :param stop_after: element after which the rest of the page is not downloaded, see Fetcher.fetch
     :return: BeautifulSoup object or None
     """
-    requests_header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/120.0.0.0 Safari/537.36"
-    }
-
     try:
-        response = requests.get(url, headers=requests_header)
+        response = get_fetcher().get(url, stop_after=stop_after)
 
         if not response.ok:
             print("unable to get 200 status from url..", response)
             return
 
-        return BeautifulSoup(response.content, "html.parser")
+        return parse_html(response.content, targets, first_only)
 
     except KeyboardInterrupt:
         raise KeyboardInterrupt
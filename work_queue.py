@@ -0,0 +1,34 @@
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, Tuple
+
+
+def bounded_map(executor: Executor, func: Callable, items: Iterable, max_in_flight: int
+                ) -> Iterator[Tuple[Any, Any]]:
+    """
+    Function to run func(item) on the executor for every item with at most `max_in_flight` tasks submitted at a
+    time. The next item is only taken from `items` when a task finished, so a generator of urls is read as the
+    work goes on, and every result is yielded as soon as its task completed, one slow task does not hold back the
+    others. Memory stays the same however many items there are.
+
+    :param executor: ThreadPoolExecutor or ProcessPoolExecutor
+    :param func: function called with a single item
+    :param items: iterable of the items, e.g. a generator
+    :param max_in_flight: max no of tasks submitted and not handed back yet. e.g. twice the no of workers, so a
+        worker never waits for the next task
+    :return: iterator of (item, result) or (item, Exception) if the task raised, in the order they complete
+    """
+    items = iter(items)
+    in_flight = {executor.submit(func, item): item for item in islice(items, max_in_flight)}
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        # the workers get new tasks before the finished ones are handled
+        for item in islice(items, len(done)):
+            in_flight[executor.submit(func, item)] = item
+        for future in done:
+            item = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield item, result
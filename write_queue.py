@@ -0,0 +1,67 @@
+import queue
+import threading
+from typing import Callable
+
+
+class WriteQueue:
+    """
+    Queue of writes done by a thread of its own, so a slow disk, a commit or a lock held by another process never
+    blocks the caller, e.g. the fetcher event loop. The thread takes all the items waiting in the queue at once, up
+    to `max_batch`, and hands them to `write_batch`, so a burst of writes costs a single commit.
+
+    :param write_batch: function(list of items) which writes them
+    :param name: name of the thread, also printed with its errors
+    :param max_batch: max no of items handed to write_batch at a time
+    """
+
+    def __init__(self, write_batch: Callable[[list], None], name: str, max_batch: int = 256):
+        self.write_batch = write_batch
+        self.name = name
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, item):
+        with self._lock:
+            if self._thread is None:
+                # started by the first write, a process which only reads never needs it
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        self._queue.put(item)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is put by close, after the last write
+            items = [item for item in batch if item is not None]
+            try:
+                if items:
+                    self.write_batch(items)
+            except Exception as e:
+                print(f"{self.name}: unable to write {len(items)} items..", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if len(items) < len(batch):
+                return
+
+    def flush(self):
+        """
+        Function to wait until everything put so far is written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
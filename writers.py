@@ -0,0 +1,254 @@
+import csv
+import os
+from typing import Callable, Iterable
+
+import pandas as pd
+
+from metrics import get_metrics
+from records import RecordColumns
+from utils import clean_df
+
+
+class RecordWriter:
+    """
+    Base class of the streaming writers. Records are collected in batches, every batch goes through validate_func
+    and is appended to the file, so the data is on disk while the scraper is still running and memory only ever
+    holds one batch. The batch is kept by column, see records.RecordColumns.
+
+    :param path: output file, overwritten if it exists
+    :param batch_size: no of records per batch
+    :param validate_func: expects a function which will take dataframe as argument and return dataframe.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, validate_func: Callable = clean_df):
+        self.path = path
+        self.batch_size = batch_size
+        self.validate_func = validate_func
+        self.count = 0
+        self._batch = RecordColumns()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, record: dict):
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, records: Iterable[dict]):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if not self._batch:
+            return
+        with get_metrics().timer("write"):
+            df = self.validate_func(self._batch.to_dataframe())
+            self._write_batch(df)
+        self.count += len(self._batch)
+        self._batch = RecordColumns()
+
+    def write_frame(self, df: pd.DataFrame):
+        """
+        Function to write a whole dataframe as one batch, without turning it into a dict per row.
+        """
+        self.flush()
+        with get_metrics().timer("write"):
+            self._write_batch(self.validate_func(df))
+        self.count += len(df)
+
+    def _write_batch(self, df: pd.DataFrame):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JsonLinesWriter(RecordWriter):
+    """
+    Writes one json object per line. Records can have different columns.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, validate_func: Callable = clean_df):
+        super().__init__(path, batch_size, validate_func)
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _write_batch(self, df: pd.DataFrame):
+        lines = df.to_json(orient="records", lines=True, date_format="iso", default_handler=str, force_ascii=False)
+        if lines and not lines.endswith("\n"):
+            lines += "\n"
+        self._file.write(lines)
+        self._file.flush()
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+
+class CsvWriter(RecordWriter):
+    """
+    Writes a csv file. Columns which only show up in a later batch are added after the others, the rows written
+    before are left shorter and the header is written again at close.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, validate_func: Callable = clean_df):
+        super().__init__(path, batch_size, validate_func)
+        self._file = open(path, "w", encoding="utf-8", newline="")
+        self.columns = None
+        self._header_columns = 0
+
+    def _write_batch(self, df: pd.DataFrame):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self._header_columns = len(self.columns)
+            df.to_csv(self._file, index=False)
+        else:
+            self.columns += [column for column in df.columns if column not in self.columns]
+            df.reindex(columns=self.columns).to_csv(self._file, index=False, header=False)
+        self._file.flush()
+
+    def _rewrite_header(self):
+        # the rows are copied one by one below the full header, the short ones padded
+        temp_path = self.path + ".tmp"
+        with open(self.path, encoding="utf-8", newline="") as source, \
+                open(temp_path, "w", encoding="utf-8", newline="") as target:
+            rows = csv.reader(source)
+            next(rows)
+            output = csv.writer(target)
+            output.writerow(self.columns)
+            for row in rows:
+                output.writerow(row + [""] * (len(self.columns) - len(row)))
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        super().close()
+        self._file.close()
+        if self.columns and len(self.columns) > self._header_columns:
+            self._rewrite_header()
+
+
+class ParquetWriter(RecordWriter):
+    """
+    Writes every batch as a row group of a parquet file. Needs pyarrow. A parquet file has a single schema, when
+    a batch brings new columns the file written so far is set aside as a part and a new one is started with the
+    wider schema. The parts are merged into the output at close, a row group at a time.
+    """
+
+    def __init__(self, path: str, batch_size: int = 5000, validate_func: Callable = clean_df):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is required to write parquet files, pip install pyarrow")
+        super().__init__(path, batch_size, validate_func)
+        self._pa = pyarrow
+        self._writer = None
+        self._schema = None
+        self._parts = []
+
+    def _fields(self, df: pd.DataFrame) -> list:
+        # a column which is empty in its first batch can't stay untyped
+        pa = self._pa
+        return [pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                for field in pa.Schema.from_pandas(df, preserve_index=False)]
+
+    def _write_batch(self, df: pd.DataFrame):
+        pa = self._pa
+        if self._schema is None:
+            self._schema = pa.schema(self._fields(df))
+            self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+        elif not set(df.columns) <= set(self._schema.names):
+            new_columns = df[[column for column in df.columns if column not in self._schema.names]]
+            self._writer.close()
+            part = f"{self.path}.part{len(self._parts)}"
+            os.replace(self.path, part)
+            self._parts.append(part)
+            self._schema = pa.schema(list(self._schema) + self._fields(new_columns))
+            self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+        table = pa.Table.from_pandas(df.reindex(columns=self._schema.names), schema=self._schema,
+                                     preserve_index=False, safe=False)
+        self._writer.write_table(table)
+
+    def _merge_parts(self):
+        pa = self._pa
+        last = f"{self.path}.part{len(self._parts)}"
+        os.replace(self.path, last)
+        with pa.parquet.ParquetWriter(self.path, self._schema) as writer:
+            for part in self._parts + [last]:
+                source = pa.parquet.ParquetFile(part)
+                for i in range(source.num_row_groups):
+                    table = source.read_row_group(i)
+                    for field in self._schema:
+                        if field.name not in table.column_names:
+                            table = table.append_column(field, pa.nulls(len(table), field.type))
+                    writer.write_table(table.select(self._schema.names))
+                os.remove(part)
+
+    def close(self):
+        super().close()
+        if self._writer:
+            self._writer.close()
+            if self._parts:
+                self._merge_parts()
+
+
+WRITERS = {
+    ".jsonl": JsonLinesWriter,
+    ".csv": CsvWriter,
+    ".parquet": ParquetWriter,
+}
+
+
+def open_record_writer(path: str, batch_size: int = None, validate_func: Callable = clean_df) -> RecordWriter:
+    """
+    Function to get the writer for the file extension. e.g. data/sgs_data.jsonl, data/sgs_data.csv
+
+    :param path: output file
+    :param batch_size: no of records per batch, default of the writer if None
+    :param validate_func: expects a function which will take dataframe as argument and return dataframe.
+    :return: RecordWriter
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f"unsupported output file {path}, use one of {', '.join(WRITERS)}")
+    writer_class = WRITERS[extension]
+    if batch_size:
+        return writer_class(path, batch_size, validate_func)
+    return writer_class(path, validate_func=validate_func)
+
+
+def read_records(path: str) -> pd.DataFrame:
+    """
+    Function to load the file written by a RecordWriter into dataframe.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".jsonl":
+        return pd.read_json(path, orient="records", lines=True, dtype=False, convert_dates=False)
+    if extension == ".csv":
+        return pd.read_csv(path, dtype=str, keep_default_na=False)
+    if extension == ".parquet":
+        return pd.read_parquet(path)
+    raise ValueError(f"unsupported file {path}, use one of {', '.join(WRITERS)}")
+
+
+def convert_to_excel(path: str, excel_filename: str, date_columns: Iterable[str] = ()) -> bool:
+    """
+    Function to convert the file written by a RecordWriter into Excel file at the end of the run. The batches
+    were validated when they were written, only the date columns have to be read back as dates.
+
+    :param path: jsonl, csv or parquet file
+    :param excel_filename: sgs_data.xlsx
+    :param date_columns: columns saved as dates by the validate_func of the writer
+    :return: True
+    """
+    df = read_records(path)
+    for column in date_columns:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], errors="coerce").dt.date
+    df.to_excel(excel_filename)
+    return True